@@ -1,10 +1,17 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import importlib
+import os
+import threading
+import time
 import tomllib
 from pathlib import Path
 # from PIL import Image
 import sys
 
-from litestar import Litestar, Request, Response, get
+from litestar import Litestar, Request, Response, get, post
+from litestar.response import Stream
 # from litestar.response import Template
 
 import util
@@ -19,6 +26,24 @@ from util import wms
 
 WMS_VERSION = '1.3.0'
 WMS_FORMAT = 'image/png'
+WMS_INFO_FORMATS = ['application/json', 'text/xml']
+
+# Limits on the size of GetMap images, advertised in the capabilities.
+# Images larger than STREAM_PIXELS are rendered in strips of at most STRIP_PIXELS
+# and streamed; these can be changed in the [render] section of config.toml.
+#
+MAX_WIDTH = 16384
+MAX_HEIGHT = 16384
+STREAM_PIXELS = 4096 * 4096
+STRIP_PIXELS = 16384 * 256
+
+# The maximum number of tiles in a batch request.
+#
+BATCH_MAX_TILES = 256
+
+# Render the tiles that were served as drafts again at full quality, and cache them.
+#
+REFINE_DRAFTS = True
 
 # Config keys.
 #
@@ -28,17 +53,112 @@ WMS_DATABASE = 'WMS_DATABASE'
 def startup(app: Litestar):
     with open('config.toml', 'rb') as f:
         config = tomllib.load(f)
+    util.config = config
+
+    # Numba reads NUMBA_CACHE_DIR when it is imported, so set it before the modules import datashader.
+    #
+    warmup_config = config.get('warmup', {})
+    if 'numba_cache_dir' in warmup_config:
+        os.environ.setdefault('NUMBA_CACHE_DIR', str(Path(warmup_config['numba_cache_dir']).resolve()))
+
+    cache_config = config.get('cache', {})
+    util.tile_cache.max_bytes = int(cache_config.get('max_mb', 256) * 1024 * 1024)
+    util.shared_cache.configure(cache_config.get('shared'), max_mb=cache_config.get('shared_max_mb'), wait=cache_config.get('shared_wait', 5.0))
+    util.memory.configure(config.get('memory', {}).get('max_mb'))
+
+    render_config = config.get('render', {})
+    util.scheduler.configure(
+        max_concurrent=render_config.get('max_concurrent'),
+        max_queue=render_config.get('max_queue', 64),
+        deadline=render_config.get('deadline', 30.0),
+        retry_after=render_config.get('retry_after', 1)
+    )
+
+    global MAX_WIDTH, MAX_HEIGHT, STREAM_PIXELS, STRIP_PIXELS, REFINE_DRAFTS, BATCH_MAX_TILES
+    MAX_WIDTH = render_config.get('max_width', MAX_WIDTH)
+    MAX_HEIGHT = render_config.get('max_height', MAX_HEIGHT)
+    STREAM_PIXELS = render_config.get('stream_pixels', STREAM_PIXELS)
+    STRIP_PIXELS = render_config.get('strip_pixels', STRIP_PIXELS)
+    REFINE_DRAFTS = render_config.get('refine_drafts', REFINE_DRAFTS)
+    BATCH_MAX_TILES = render_config.get('batch_max_tiles', BATCH_MAX_TILES)
+
+    # The modules are imported in parallel in the background, so the server can answer
+    # (for example, GetCapabilities with the layers registered so far) while they load.
+    # The point layers defined in config.toml rather than in a module are initialised
+    # in the same way. Modules (and config.toml layers) that load their data with a
+    # util.DatasetHandle(..., background=True) register their layers before their data is loaded.
+    #
+    loop = asyncio.get_running_loop()
+    jobs = {name:functools.partial(_import_module, app, loop, fnam) for name,fnam in config['modules'].items()}
+    if config.get('layers'):
+        jobs['layers'] = functools.partial(_point_layers, config)
+    for name in jobs:
+        _modules[name] = {'state': 'loading', 'seconds': None, 'error': None}
+
+    pool = ThreadPoolExecutor(max_workers=max(1, len(jobs)), thread_name_prefix='init')
+    futures = [pool.submit(_initialise, name, job) for name,job in jobs.items()]
+
+    def finish():
+        for future in futures:
+            future.result()
+        pool.shutdown()
+
+        if warmup_config.get('enabled', True):
+            util.warmup.start(warmup_config.get('size', 64))
+
+        # Reload datasets when their files change.
+        #
+        dataset_config = config.get('datasets', {})
+        if dataset_config.get('watch', False):
+            for handle in util.dataset_handles.values():
+                handle.watch(dataset_config.get('watch_interval', 5.0))
+
+        _initialised.set()
+
+    threading.Thread(target=finish, name='init', daemon=True).start()
+
+# The modules (and config.toml layers) initialised at startup: their state
+# ("loading", "ready", or "failed"), how long they took, and why they failed.
+#
+_modules = {}
 
-    for fnam in config['modules'].values():
-        print(f'import {fnam}')
-        stem = Path(fnam).stem
-        spec = importlib.util.spec_from_file_location(stem, fnam)
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[stem] = module
-        spec.loader.exec_module(module)
+# Set when all of the modules have been initialised.
+#
+_initialised = threading.Event()
+
+def _initialise(name, job):
+    """Run a module's initialisation in a background thread, and time it."""
+
+    t0 = time.perf_counter()
+    try:
+        job()
+    except Exception as e:
+        seconds = time.perf_counter() - t0
+        _modules[name].update(state='failed', seconds=seconds, error=f'{type(e).__name__}: {e}')
+        print(f'Initialising {name} failed after {seconds:.1f}s: {e!r}')
+
+        return
+
+    seconds = time.perf_counter() - t0
+    _modules[name].update(state='ready', seconds=seconds)
+    print(f'Initialised {name} in {seconds:.1f}s')
+
+def _import_module(app, loop, fnam):
+    print(f'import {fnam}')
+    stem = Path(fnam).stem
+    spec = importlib.util.spec_from_file_location(stem, fnam)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[stem] = module
+    spec.loader.exec_module(module)
+
+    # Handlers are registered with Litestar on the event loop rather than in this thread.
+    #
+    if 'register' in dir(module):
+        loop.call_soon_threadsafe(module.register, app)
 
-        if 'register' in dir(module):
-            module.register(app)
+def _point_layers(config):
+    import dsutil
+    dsutil.point_layers(config)
 
 def _get_mandatory(args, arg):
     """Get the argument of a mandatory parameter.
@@ -52,6 +172,211 @@ def _get_mandatory(args, arg):
 
     return value
 
+def _get_int(args, arg, default=None, minimum=None):
+    """Get the integer argument of a parameter.
+
+    Raises WmsError if the parameter is missing (and there is no default),
+    isn't an integer, or is less than minimum.
+    """
+
+    value = args.get(arg) if default is None else args.get(arg, str(default))
+    if value is None:
+        raise util.WmsError(None, f'Missing mandatory parameter "{arg}"')
+    try:
+        value = int(value)
+    except ValueError:
+        raise util.WmsError(None, f'Parameter "{arg}" must be an integer') from None
+    if minimum is not None and value<minimum:
+        raise util.WmsError(None, f'Parameter "{arg}" must be at least {minimum}')
+
+    return value
+
+def _get_bbox(args):
+    """Get the bounding box as (west, south, east, north).
+
+    Raises WmsError if the CRS is not supported.
+    """
+
+    crs = _get_mandatory(args, 'CRS')
+    bbox = [float(f) for f in _get_mandatory(args, 'BBOX').split(',')]
+
+    if crs=='EPSG:4326':
+        # EPSG:4326 refers to WGS 84 geographic latitude, then longitude.
+        # That is, in this CRS the x axis corresponds to latitude, and the y axis to longitude.
+        # Therefore, reverse x and y.
+        # See 6.7.3.3 in the WMS v1.3.0 Specification.
+        #
+        w, s, e, n = bbox
+        bbox = s, w, n, e
+    else:
+        raise util.WmsError('InvalidCRS', 'Only CRS=EPSG:4326 is valid')
+
+    return bbox
+
+def _render_image(request, width, height, bbox, path, layer_names, style_names):
+    """Call the layer function(s) to render an image, or None if there is nothing to draw."""
+
+    if ',' in layer_names:
+        # The client has asked for multiple layers combined.
+        #
+        return wms.multi_layer(request, width, height, bbox, path, layer_names.split(','), style_names.split(','))
+    else:
+        return wms.get_layer(layer_names).img_func(request, width, height, bbox, path, layer_names, style_names)
+
+# Full renders of the tiles that were served as drafts, by cache key.
+#
+_refining = {}
+
+def _refine(key, layer_names, bbox, render):
+    """Render a tile at full quality in the background, and cache it."""
+
+    if key in _refining:
+        return
+
+    job = functools.partial(render, 'full')
+    if util.shared_cache.enabled:
+        job = functools.partial(util.shared_cache.render, key, layer_names, job)
+
+    async def refine():
+        version = util.tile_cache.version(layer_names)
+        try:
+            data, _, seconds = await util.scheduler.run(job)
+        except (util.Overloaded, util.RenderCancelled):
+            return
+        except Exception as e:
+            print(f'Refining {key} failed: {e!r}')
+            return
+        finally:
+            del _refining[key]
+
+        if data is not None:
+            util.metrics.inc('getmap_refined')
+            util.tile_cache.put(key, layer_names, bbox, data, cost=seconds, version=version)
+
+    _refining[key] = asyncio.create_task(refine())
+
+def _aggregate_formats():
+    """The GetMap formats that return an aggregate (see dsutil.AGGREGATE_FORMATS),
+    if any layer provides aggregates.
+    """
+
+    if not wms.aggregate_names():
+        return []
+
+    import dsutil
+
+    return list(dsutil.AGGREGATE_FORMATS)
+
+def _encode_aggregate(agg, format, width, height, bbox, layer_name, draft=False):
+    """Encode an aggregate for an aggregate GetMap format."""
+
+    import dsutil
+
+    return dsutil.encode_aggregate(agg, format, bbox, layer=layer_name, draft=draft)
+
+async def _empty_aggregate(request, format, width, height, bbox, path, layer_name, headers=None):
+    """Respond with the aggregate of a tile with nothing in it.
+
+    It has the layer's dtype and categories, which may need the layer's data (loading
+    a partition, for example), so it is made in a worker thread.
+    """
+
+    import dsutil
+
+    def encode():
+        empty = wms.get_empty_aggregate(layer_name)
+        agg = dsutil.empty_aggregate(width, height) if empty is None else empty(request, width, height, path, layer_name)
+
+        return dsutil.encode_aggregate(agg, format, bbox, layer=layer_name, empty=True)
+
+    try:
+        data = await util.scheduler.run(encode)
+    except util.Overloaded as e:
+        return _overloaded(e)
+
+    return Response(content=data, media_type=format, headers=headers)
+
+def _overloaded(e):
+    return Response(
+        content=e.message,
+        status_code=503,
+        media_type='text/plain',
+        headers={'Retry-After': str(e.retry_after)}
+    )
+
+def _stream_blank(width, height):
+    """Stream a transparent image that is too large to hold in memory.
+
+    (A generator that isn't async is iterated in a worker thread, so the event loop isn't blocked.)
+    """
+
+    png = util.PngStream(width, height)
+    rows = max(1, STRIP_PIXELS // width)
+
+    def stream():
+        yield png.header()
+        for r0 in range(0, height, rows):
+            yield png.blank(min(rows, height-r0))
+        yield png.finish()
+        util.metrics.inc('getmap_streamed')
+
+    return Stream(stream(), media_type=WMS_FORMAT)
+
+async def _stream_map(request, width, height, bbox, path, layer_names, style_names):
+    """Render a large image in horizontal strips, and stream it as it is encoded.
+
+    Memory use is bounded by the size of a strip rather than the size of the image.
+    A worker is reserved for the whole image, so once it has started, the strips
+    don't queue behind other requests (and can't be refused part way through).
+    The layers must shade each strip in the same way (see util.rendering_strip()).
+    """
+
+    png = util.PngStream(width, height)
+    strips = util.strips(width, height, bbox, max(1, STRIP_PIXELS // width))
+
+    def render(r0, r1, top, bottom, strip_bbox):
+        with util.render_quality('full', strip=True):
+            img = _render_image(request, width, bottom-top, strip_bbox, path, layer_names, style_names)
+        if img is None:
+            return png.blank(r1-r0)
+
+        return png.rows(img.convert('RGBA').crop((0, r0-top, width, r1-top)).tobytes())
+
+    # Render the first strip before responding, so an overloaded server can still say so.
+    #
+    try:
+        reservation = await util.scheduler.reserve(disconnected=util.wait_for_disconnect(request))
+    except util.Overloaded as e:
+        return _overloaded(e)
+    except util.Disconnected:
+        return Response(content=b'', status_code=499)
+    try:
+        first = png.header() + await reservation.run(render, *strips[0], disconnected=util.wait_for_disconnect(request))
+    except util.Overloaded as e:
+        reservation.release()
+        return _overloaded(e)
+    except util.Disconnected:
+        reservation.release()
+        return Response(content=b'', status_code=499)
+    except BaseException:
+        reservation.release()
+        raise
+
+    # Once the response has started, Stream watches for the client disconnecting
+    # (the generator is cancelled, which flags the current strip as cancelled).
+    #
+    async def stream():
+        try:
+            yield first
+            for strip in strips[1:]:
+                yield await reservation.run(render, *strip)
+            yield png.finish()
+            util.metrics.inc('getmap_streamed')
+        finally:
+            reservation.release()
+
+    return Stream(stream(), media_type=WMS_FORMAT)
+
 @get('/')
 async def get_root(request: Request) -> Response:
     """An easy place for a human to browse to.
@@ -67,7 +392,7 @@ async def get_root(request: Request) -> Response:
 
     # If there are parameters, pass the request to the WMS endpoint.
     #
-    return _get_wms(request, '')
+    return await _get_wms(request, '')
 
 @get('/favicon.ico')
 async def favicon() -> bytes:
@@ -77,9 +402,9 @@ async def favicon() -> bytes:
 async def get_wms(request: Request, path: str='') -> Response:
     """The endpoint for WMS requests."""
 
-    return _get_wms(request, path)
+    return await _get_wms(request, path)
 
-def _get_wms(request, path):
+async def _get_wms(request, path):
     args = request.query_params
 
     try:
@@ -89,43 +414,169 @@ def _get_wms(request, path):
             if version!=WMS_VERSION:
                 raise util.WmsError(None, f'Only version "{WMS_VERSION}" is supported')
             format = _get_mandatory(args, 'FORMAT')
-            if format!=WMS_FORMAT:
-                raise util.WmsError('InvalidFormat', f'Only format "{WMS_FORMAT}" is supported')
+            aggregate = format!=WMS_FORMAT
+            if aggregate and format not in _aggregate_formats():
+                raise util.WmsError('InvalidFormat', f'Only formats {[WMS_FORMAT]+_aggregate_formats()} are supported')
 
             width = int(_get_mandatory(args, 'WIDTH'))
             height = int(_get_mandatory(args, 'HEIGHT'))
             layer_names = _get_mandatory(args, 'LAYERS')
             style_names = _get_mandatory(args, 'STYLES')
-            crs = _get_mandatory(args, 'CRS')
-            bbox = [float(f) for f in _get_mandatory(args, 'BBOX').split(',')]
-
-            if crs=='EPSG:4326':
-                # EPSG:4326 refers to WGS 84 geographic latitude, then longitude.
-                # That is, in this CRS the x axis corresponds to latitude, and the y axis to longitude.
-                # Therefore, reverse x and y.
-                # See 6.7.3.3 in the WMS v1.3.0 Specification.
-                #
-                w, s, e, n = bbox
-                bbox = s, w, n, e
-            else:
-                raise util.WmsError('InvalidCRS', 'Only CRS=EPSG:4326 is valid')
+            bbox = _get_bbox(args)
+            if not (0<width<=MAX_WIDTH and 0<height<=MAX_HEIGHT):
+                raise util.WmsError(None, f'WIDTH and HEIGHT must be at most {MAX_WIDTH} and {MAX_HEIGHT}')
+
+            # An aggregate format returns the layer's aggregate, for the client to shade,
+            # so it needs a single layer that has registered an aggregate function.
+            # The style doesn't change the aggregate.
+            #
+            if aggregate:
+                if ',' in layer_names or wms.get_aggregate(layer_names) is None:
+                    raise util.WmsError('InvalidFormat', f'Format "{format}" needs a single layer that provides aggregates')
+                if width*height>STREAM_PIXELS:
+                    raise util.WmsError(None, f'Format "{format}" is limited to {STREAM_PIXELS} pixels')
+                style_names = ''
+
+            # Tiles outside all of the layers don't need to be rendered (or cached).
+            #
+            lns = layer_names.split(',')
+            layer_defs = [wms.get_layer(name) for name in lns]
+            if not any(util.intersects(bbox, layer_def) for layer_def in layer_defs):
+                util.metrics.inc('getmap_outside')
+                if aggregate:
+                    return await _empty_aggregate(request, format, width, height, bbox, path, layer_names)
+
+                if width*height>STREAM_PIXELS:
+                    return _stream_blank(width, height)
+
+                return Response(content=util.blank_png(width, height), media_type=WMS_FORMAT)
+
+            if width*height>STREAM_PIXELS:
+                unstreamable = [layer_def.name for layer_def in layer_defs if not layer_def.stream]
+                if unstreamable:
+                    raise util.WmsError(None, f'Layers {unstreamable} are shaded per image, so are limited to {STREAM_PIXELS} pixels')
+
+                return await _stream_map(request, width, height, bbox, path, layer_names, style_names)
+
+            # The PROFILE=1 vendor parameter profiles the render, if enabled in config.toml.
+            #
+            profile_config = util.config.get('profile', {})
+            profiling = args.get('PROFILE')=='1' and profile_config.get('enabled', False)
 
-            if ',' in layer_names:
-                # The client has asked for multiple layers combined.
+            # Only layers that have opted in are cached.
+            #
+            cacheable = all(layer_def.cache for layer_def in layer_defs)
+            key = (path, layer_names, style_names, width, height, tuple(bbox))
+            if aggregate:
+                key += (format,)
+            categories = util.request_categories(request)
+            if categories:
+                key += (tuple(categories),)
+            if cacheable and not profiling:
+                data = util.tile_cache.get(key)
+                if data is not None:
+                    util.metrics.inc('getmap_cached')
+
+                    return Response(content=data, media_type=format)
+
+            def render(mode='auto'):
+                """Return the encoded image (or None), whether it's a draft, and how long it took."""
+
+                t0 = time.perf_counter()
+                with util.render_quality(mode) as quality:
+                    if aggregate:
+                        agg = wms.get_aggregate(layer_names)[0](request, width, height, bbox, path, layer_names)
+                        data = None if agg is None else _encode_aggregate(agg, format, width, height, bbox, layer_names, quality.draft)
+                    else:
+                        img = _render_image(request, width, height, bbox, path, layer_names, style_names)
+                        data = None if img is None else util.byte_buffer(img).read()
+
+                return data, quality.draft, time.perf_counter()-t0
+
+            # The shared cache is checked in the worker thread, since it may have to wait
+            # for another process to render the tile.
+            #
+            job = render
+            headers = {}
+            if cacheable and not profiling and util.shared_cache.enabled:
+                job = functools.partial(util.shared_cache.render, key, lns, render)
+            if profiling:
+                profile_id = util.new_profile_id()
+                info = {'path': path, 'layers': layer_names, 'styles': style_names, 'width': width, 'height': height, 'bbox': bbox}
+                job = functools.partial(util.profile, render, profile_config.get('dir', 'profiles'), profile_id, info)
+                headers['X-Profile-Id'] = profile_id
+
+            # Rendering and encoding run in the scheduler's worker threads.
+            #
+            version = util.tile_cache.version(lns)
+            try:
+                data, draft, render_time = await util.scheduler.run(job, disconnected=util.wait_for_disconnect(request))
+            except util.Overloaded as e:
+                return _overloaded(e)
+            except util.Disconnected:
+                # Nobody is listening. (499 is nginx's "client closed request".)
                 #
-                lns = layer_names.split(',')
-                sns = style_names.split(',')
-                img = wms.multi_layer(request, width, height, bbox, path, lns, sns)
+                return Response(content=b'', status_code=499)
 
-                return Response(util.byte_buffer(img), media_type=WMS_FORMAT)
-            else:
-                layer_def = wms.get_layer(layer_names)
-                if util.intersects(bbox, layer_def):
-                    img = layer_def.img_func(request, width, height, bbox, path, layer_names, style_names)
-                else:
-                    img = util.blank_image(request, width, height)
+            # A layer function returns None if there is nothing to draw.
+            # Empty tiles are cheap to detect, so they aren't cached.
+            #
+            if data is None:
+                util.metrics.inc('getmap_empty')
+                if aggregate:
+                    return await _empty_aggregate(request, format, width, height, bbox, path, layer_names, headers)
+
+                return Response(content=util.blank_png(width, height), media_type=WMS_FORMAT, headers=headers)
+
+            # Drafts aren't cached; instead, a full render replaces them in the cache.
+            #
+            if draft:
+                util.metrics.inc('getmap_draft')
+                headers['X-Render-Quality'] = 'draft'
+                if cacheable and REFINE_DRAFTS:
+                    _refine(key, lns, bbox, render)
+
+                return Response(content=data, media_type=format, headers=headers)
 
-                return Response(content=util.byte_buffer(img).read(), media_type=WMS_FORMAT)
+            util.metrics.inc('getmap_aggregates' if aggregate else 'getmap_rendered')
+            if cacheable:
+                util.tile_cache.put(key, lns, bbox, data, cost=render_time, version=version)
+
+            return Response(content=data, media_type=format, headers=headers)
+        elif req=='GetFeatureInfo':
+            version = _get_mandatory(args, 'VERSION')
+            if version!=WMS_VERSION:
+                raise util.WmsError(None, f'Only version "{WMS_VERSION}" is supported')
+            info_format = _get_mandatory(args, 'INFO_FORMAT')
+            if info_format not in WMS_INFO_FORMATS:
+                raise util.WmsError('InvalidFormat', f'Only formats {WMS_INFO_FORMATS} are supported')
+
+            width = _get_int(args, 'WIDTH', minimum=1)
+            height = _get_int(args, 'HEIGHT', minimum=1)
+            bbox = _get_bbox(args)
+            query_layers = _get_mandatory(args, 'QUERY_LAYERS').split(',')
+            feature_count = _get_int(args, 'FEATURE_COUNT', 1, minimum=1)
+            i = _get_int(args, 'I')
+            j = _get_int(args, 'J')
+            if not (0<=i<width and 0<=j<height):
+                raise util.WmsError('InvalidPoint', f'Point I={i}, J={j} is outside the map')
+
+            # Searching the layers may load a partition of their data, so it runs in a worker thread.
+            #
+            try:
+                features = await util.scheduler.run(
+                    wms.get_feature_info, request, width, height, bbox, i, j, path, query_layers, feature_count,
+                    disconnected=util.wait_for_disconnect(request)
+                )
+            except util.Overloaded as e:
+                return _overloaded(e)
+            except util.Disconnected:
+                return Response(content=b'', status_code=499)
+
+            if info_format=='application/json':
+                return Response(util.features_json(features), media_type=info_format)
+            else:
+                return Response(util.features_xml(features), media_type=info_format)
         elif req=='GetCapabilities':
             service = _get_mandatory(args, 'SERVICE')
             if service!='WMS':
@@ -150,14 +601,24 @@ def _get_wms(request, path):
             # (because we don't want to build the entire XML document manually),
             # then generate the <Layer> tree from the imported layers.
             #
-            cap_xml = util.render('capabilities.xml', url=url, path=path)
-            cap_xml = wms.build_capabilities(request, cap_xml, path)
+            cap_xml = util.render('capabilities.xml', url=url, path=path, max_width=MAX_WIDTH, max_height=MAX_HEIGHT, map_formats=[WMS_FORMAT]+_aggregate_formats())
+            # Sizing the legends may load a partition of a layer's data, so it runs in a worker thread.
+            #
+            try:
+                cap_xml = await util.scheduler.run(wms.build_capabilities, request, cap_xml, path)
+            except util.Overloaded as e:
+                return _overloaded(e)
 
             return Response(cap_xml, media_type='application/xml', headers={'Content-Disposition': 'inline'})
         else:
             raise util.WmsError('OperationNotSupported', f'Unrecognised REQUEST: "{req}"')
 
     except util.WmsError as e:
+        # The layers of modules that haven't been imported yet aren't defined yet.
+        #
+        if e.code=='LayerNotDefined' and not _initialised.is_set():
+            e = util.WmsError('LayerNotReady', f'{e.message} yet: the server is still loading its modules')
+
         print('EXCEPTION', e)
         xml = util.build_exception(e)
 
@@ -168,15 +629,260 @@ def _get_wms(request, path):
     '/legend/{path:path}/{legend:str}']
     #, sync_to_thread=True
 )
-async def get_legend(path: str='', legend: str|None=None) -> Response:
-    """The legend endpoint."""
+async def get_legend(request: Request, path: str='', legend: str|None=None) -> Response:
+    """The legend endpoint.
+
+    A style that supports subsets of categories draws the legend of the categories
+    in the CATEGORIES parameter, as a GetMap request with the same parameter does.
+    """
 
     # app.logger.info(f'Legend: {legend}')
     print(f'GET LEGEND {path=} {legend=}')
     legend = legend.lstrip('/')
 
-    legend_func = wms.get_style(legend)
-    return Response(util.byte_buffer(legend_func(path, legend)).read(), media_type=WMS_FORMAT)
+    # Litestar matches "/legend/path/to/style" to the first route,
+    # so the path arrives as part of the legend.
+    #
+    if '/' in legend:
+        path, _, legend = legend.rpartition('/')
+
+    # Drawing a legend may load a partition of the layer's data, so it runs in a worker thread.
+    #
+    def draw(legend_func, categories):
+        if categories and wms.style_categories(legend):
+            img = legend_func(path, legend, categories=categories)
+        else:
+            img = legend_func(path, legend)
+
+        return util.byte_buffer(img).read()
+
+    try:
+        legend_func = wms.get_style(legend)
+        data = await util.scheduler.run(draw, legend_func, util.request_categories(request))
+    except util.WmsError as e:
+        return Response(util.build_exception(e), media_type='application/xml', headers={'Content-Disposition': 'inline'})
+    except util.Overloaded as e:
+        return _overloaded(e)
+
+    return Response(data, media_type=WMS_FORMAT)
+
+def _batch_part(boundary, tile, content, media_type, quality=None):
+    """One part of a multipart batch response."""
+
+    if isinstance(content, str):
+        content = content.encode()
+    headers = [f'--{boundary}', f'Content-Type: {media_type}', f'X-Tile-Index: {tile.index}', f'Content-Length: {len(content)}']
+    if quality:
+        headers.append(f'X-Render-Quality: {quality}')
+
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode() + content + b'\r\n'
+
+@post('/batch', status_code=200)
+async def post_batch(request: Request, data: dict) -> Response:
+    """Render many GetMap tiles in one request.
+
+    The body is a JSON object::
+
+        {
+            "path": "",
+            "crs": "EPSG:4326",
+            "tiles": [
+                {"layers": "total_ais", "styles": "", "bbox": "-50,145,-40,155", "width": 256, "height": 256},
+                ...
+            ]
+        }
+
+    where path is the path of /WMS/{path}/, and each tile has the LAYERS, STYLES, BBOX,
+    WIDTH and HEIGHT parameters of a GetMap request. Tiles of a layer that can share
+    an aggregation (see util.tile_groups()) are rendered together.
+
+    The response is multipart/mixed, with a part for each tile in the order the tiles
+    are finished. Each part has an X-Tile-Index header giving the index of the tile
+    in the request. A tile that couldn't be rendered has an XML exception
+    (as GetMap would return) instead of an image.
+    """
+
+    try:
+        path = data.get('path', '').strip('/')
+        crs = data.get('crs', 'EPSG:4326')
+        specs = data['tiles']
+        if len(specs)>BATCH_MAX_TILES:
+            raise ValueError(f'At most {BATCH_MAX_TILES} tiles can be requested at once')
+
+        tiles = []
+        for i,spec in enumerate(specs):
+            width, height = int(spec['width']), int(spec['height'])
+            if not (0<width<=MAX_WIDTH and 0<height<=MAX_HEIGHT) or width*height>STREAM_PIXELS:
+                raise ValueError(f'Tile {i}: the size must be at most {MAX_WIDTH}x{MAX_HEIGHT} and {STREAM_PIXELS} pixels')
+            bbox = _get_bbox({'CRS': crs, 'BBOX': spec['bbox']})
+            tiles.append(util.Tile(i, spec['layers'], spec.get('styles', ''), tuple(bbox), width, height))
+    except KeyError as e:
+        return Response({'error': f'Missing "{e.args[0]}"'}, status_code=400)
+    except (TypeError, ValueError, util.WmsError) as e:
+        return Response({'error': getattr(e, 'message', None) or str(e)}, status_code=400)
+
+    boundary = f'batch-{os.urandom(8).hex()}'
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def send(tile, content, media_type=WMS_FORMAT):
+        queue.put_nowait((tile.index, _batch_part(boundary, tile, content, media_type)))
+
+    def emit(tile, content):
+        """send() from a worker thread."""
+
+        loop.call_soon_threadsafe(send, tile, content)
+
+    # As in GetMap, a CATEGORIES parameter (in the query string) draws a subset of the categories.
+    #
+    categories = util.request_categories(request)
+
+    def key(tile):
+        k = path, tile.layer_names, tile.style_names, tile.width, tile.height, tile.bbox
+
+        return k + (tuple(categories),) if categories else k
+
+    # Answer what we can without rendering.
+    #
+    todo = []
+    versions = {}
+    for tile in tiles:
+        try:
+            layer_defs = [wms.get_layer(name) for name in tile.layer_names.split(',')]
+            if not any(util.intersects(tile.bbox, layer_def) for layer_def in layer_defs):
+                send(tile, util.blank_png(tile.width, tile.height))
+                continue
+
+            cached = util.tile_cache.get(key(tile)) if all(layer_def.cache for layer_def in layer_defs) else None
+            if cached is not None:
+                util.metrics.inc('getmap_cached')
+                send(tile, cached)
+                continue
+        except util.WmsError as e:
+            send(tile, util.build_exception(e), 'application/xml')
+            continue
+
+        todo.append(tile)
+        versions[tile.index] = util.tile_cache.version(tile.layer_names.split(','))
+
+    def finish(tile, img, seconds):
+        data = None if img is None else util.byte_buffer(img).read()
+        if data is None:
+            data = util.blank_png(tile.width, tile.height)
+        elif all(wms.get_layer(name).cache for name in tile.layer_names.split(',')):
+            util.tile_cache.put(key(tile), tile.layer_names.split(','), tile.bbox, data, cost=seconds, version=versions[tile.index])
+        util.metrics.inc('batch_tiles')
+        emit(tile, data)
+
+    def render_group(group):
+        t0 = time.perf_counter()
+        with util.render_quality('full'):
+            for tile,img in wms.render_tiles(request, group, path):
+                t1 = time.perf_counter()
+                finish(tile, img, t1-t0)
+                t0 = t1
+
+    def render_tile(tile):
+        t0 = time.perf_counter()
+        with util.render_quality('full'):
+            img = _render_image(request, tile.width, tile.height, tile.bbox, path, tile.layer_names, tile.style_names)
+        finish(tile, img, time.perf_counter()-t0)
+
+    async def run(func, arg, group):
+        try:
+            await util.scheduler.run(func, arg)
+        except Exception as e:
+            if not isinstance(e, util.WmsError):
+                e = util.WmsError(None, 'The server is too busy' if isinstance(e, util.Overloaded) else repr(e))
+            for tile in group:
+                send(tile, util.build_exception(e), 'application/xml')
+
+    groups, others = util.tile_groups(todo, STREAM_PIXELS)
+    util.metrics.inc('batch_groups', len(groups))
+    tasks = [asyncio.create_task(run(render_group, group, group)) for group in groups]
+    tasks += [asyncio.create_task(run(render_tile, tile, [tile])) for tile in others]
+
+    async def stream():
+        sent = set()
+        try:
+            while len(sent)<len(tiles):
+                index, part = await queue.get()
+
+                # If a group fails part way through, the tiles that were already sent aren't sent again.
+                #
+                if index not in sent:
+                    sent.add(index)
+                    yield part
+            yield f'--{boundary}--\r\n'.encode()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return Stream(stream(), media_type=f'multipart/mixed; boundary={boundary}')
+
+@post('/admin/reload/{name:str}')
+async def reload_dataset(name: str) -> Response:
+    """Load a new version of a dataset in the background and swap it in."""
+
+    handle = util.dataset_handles.get(name)
+    if handle is None:
+        return Response({'error': f'Dataset "{name}" is not defined'}, status_code=404)
+
+    started = handle.reload()
+
+    return Response(handle.status(), status_code=202 if started else 409)
+
+@get('/admin/datasets')
+async def get_datasets() -> list[dict]:
+    """The status of the reloadable and partitioned datasets."""
+
+    return [handle.status() for handle in util.dataset_handles.values()] + [
+        dataset.status() for dataset in util.partitioned_datasets.values()
+    ]
+
+@get('/admin/registry')
+async def get_registry() -> dict:
+    """The memory held by the registered datasets and views."""
+
+    return util.registry.report()
+
+@get('/admin/memory')
+async def get_memory() -> dict:
+    """The memory budget, and the memory held by each cache and dataset."""
+
+    return util.memory.status()
+
+@get('/ready')
+async def get_ready() -> Response:
+    """Readiness: 200 when the modules have been initialised, their datasets loaded,
+    and the layers warmed up; 503 until then.
+    """
+
+    # The warmup waits for the datasets, but if it is disabled, they are checked here.
+    #
+    status = util.warmup.status()
+    status['modules'] = _modules
+    status['datasets'] = {name:handle.ready for name,handle in util.dataset_handles.items()}
+    status['ready'] = status['ready'] and _initialised.is_set() and all(status['datasets'].values())
+
+    return Response(status, status_code=200 if status['ready'] else 503)
+
+@get('/metrics')
+async def get_metrics() -> dict:
+    """Request counters and cache statistics."""
+
+    cache = util.tile_cache
+    scheduler = util.scheduler
+
+    return {
+        **util.metrics.snapshot(),
+        'rss_bytes': util.rss_bytes(),
+        'render_running': scheduler.running,
+        'render_queue_depth': scheduler.queued,
+        'tile_cache_hits': cache.hits,
+        'tile_cache_misses': cache.misses,
+        'tile_cache_bytes': cache.nbytes
+    }
 
 def shutdown():
     print('Shutting down ...')
@@ -184,5 +890,5 @@ def shutdown():
 app = Litestar(
     on_startup=[startup],
     on_shutdown=[shutdown],
-    route_handlers=[get_root, get_wms, get_legend, favicon]
+    route_handlers=[get_root, get_wms, get_legend, post_batch, favicon, reload_dataset, get_datasets, get_registry, get_memory, get_metrics, get_ready]
 )
@@ -0,0 +1,1929 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import reduce
+from io import BytesIO
+import json
+import math
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import datashader as ds
+import xarray as xr
+from datashader import transfer_functions as tf
+from datashader.colors import rgb
+
+import util
+from util import bbox_intersects, check_cancelled, wms
+
+# Datashader helpers shared by the layer modules.
+#
+# These live apart from util so that the server and the sample layers
+# do not need numpy or datashader to be installed.
+#
+
+def palette_rgba(cmap):
+    """Convert a colormap (a list of '#rrggbb' strings, names, or RGB tuples)
+    into an array of packed RGBA uint32 values, as used by datashader images.
+    """
+
+    cols = np.array([rgb(c) for c in cmap], dtype=np.uint32)
+
+    return cols[:, 0] | (cols[:, 1] << 8) | (cols[:, 2] << 16) | np.uint32(255 << 24)
+
+def _add(a, b):
+    """Add two partial aggregates, treating empty (NaN) pixels as 0
+    unless they are empty in both.
+    """
+
+    if isinstance(a, xr.Dataset):
+        return xr.Dataset({name:_add(a[name], b[name]) for name in a.data_vars})
+    if a.dtype.kind!='f':
+        return a + b
+    if isinstance(a, xr.DataArray):
+        return (a.fillna(0) + b.fillna(0)).where(a.notnull() | b.notnull())
+
+    return np.where(np.isnan(a) & np.isnan(b), np.nan, np.nan_to_num(a) + np.nan_to_num(b))
+
+def combine(agg, a, b):
+    """Combine two partial aggregates (xarray or numpy) of the same canvas.
+
+    Partial maxima and minima are combined with np.fmax() and np.fmin(),
+    and everything else is added; either way, a pixel that is empty (NaN)
+    in one of the aggregates has the value of the other.
+    """
+
+    if isinstance(agg, ds.max):
+        return np.fmax(a, b)
+    if isinstance(agg, ds.min):
+        return np.fmin(a, b)
+
+    return _add(a, b)
+
+# Aggregating one large tile is a single pass over the rows, which leaves the other
+# cores idle when there aren't many concurrent requests. Frames with at least
+# 2 x aggregate_min_rows rows (in the [render] section of config.toml) are split into
+# up to aggregate_threads row partitions, which are aggregated onto their own grids
+# in parallel and then combined. Datashader's numba kernels release the GIL,
+# so threads can use all the cores without copying the data.
+# A profiled render (see util.profiling()) aggregates in its own thread.
+#
+_aggregate_pool = None
+
+def _aggregate_threads():
+    """Return the number of aggregation threads (creating the pool on first use) and the minimum partition size."""
+
+    global _aggregate_pool
+
+    render_config = util.config.get('render', {})
+    threads = render_config.get('aggregate_threads') or os.cpu_count() or 1
+    if util.profiling():
+        threads = 1
+    if threads>1 and _aggregate_pool is None:
+        _aggregate_pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='aggregate')
+
+    return threads, render_config.get('aggregate_min_rows', 1_000_000)
+
+def _row_partitions(frames, threads, min_rows):
+    """Split the frames into row slices (views, not copies) of at least min_rows rows."""
+
+    parts = []
+    for df in frames:
+        n = max(1, min(threads, len(df)//min_rows))
+        edges = np.linspace(0, len(df), n+1).astype(int)
+        parts.extend(df.iloc[start:stop] for start,stop in zip(edges[:-1], edges[1:]))
+
+    return parts
+
+def aggregate(cvs, frames, x, y, agg):
+    """Aggregate the points in a list of DataFrames onto a canvas.
+
+    The aggregates of the frames are combined using combine(), so agg must be
+    count, count_cat, sum, max, min, or a summary of additive reductions.
+    This allows a dataset to be held in pieces, such as the chunks of a PointSet
+    or the parts of a util.DatasetRegistry view, without concatenating them.
+    Large frames are aggregated in parallel row partitions.
+    """
+
+    threads, min_rows = _aggregate_threads()
+    parts = _row_partitions(frames, threads, min_rows) if threads>1 else frames
+    if len(parts)>1 and threads>1:
+        results = list(_aggregate_pool.map(lambda df: cvs.points(df, x, y, agg), parts))
+        check_cancelled()
+
+        return reduce(lambda a, b: combine(agg, a, b), results)
+
+    result = cvs.points(parts[0], x, y, agg)
+    for df in parts[1:]:
+        check_cancelled()
+        result = combine(agg, result, cvs.points(df, x, y, agg))
+
+    return result
+
+def is_empty(agg):
+    """Does an aggregate have no data?
+
+    Layer functions can return None for an empty aggregate rather than shading,
+    spreading, and encoding a transparent image.
+    """
+
+    data = agg.data
+
+    return not np.any(data[~np.isnan(data)] if data.dtype.kind=='f' else data)
+
+# tf.dynspread() chooses how far to spread from the density of the image, so the strips
+# of a streamed image would each be spread differently (and the seams would show).
+# Strips are spread by this many pixels instead.
+#
+STRIP_SPREAD_PX = 1
+
+def dynspread(img, *, threshold=0.5, max_px=4, shape='circle'):
+    """Spread an image with tf.dynspread(), or by STRIP_SPREAD_PX pixels
+    if it is a strip of a larger image (see util.rendering_strip()).
+    """
+
+    if util.rendering_strip():
+        return tf.spread(img, px=min(STRIP_SPREAD_PX, max_px), shape=shape)
+
+    return tf.dynspread(img, threshold=threshold, max_px=max_px, shape=shape)
+
+def aggregate_metadata(agg, bbox, **extra):
+    """Describe an aggregate for a client that shades it: its dtype, shape,
+    and bbox (west, south, east, north), and the categories of a categorical aggregate.
+
+    The grid is north up (row 0 is the north edge), as in an image.
+    """
+
+    meta = {
+        'dtype': str(agg.dtype),
+        'shape': list(agg.shape),
+        'dims': ['y', 'x'] + list(agg.dims[2:]),
+        'bbox': list(bbox),
+        'categories': [str(c) for c in agg.coords[agg.dims[2]].values] if agg.ndim>2 else None
+    }
+    meta.update(extra)
+
+    return meta
+
+def _north_up(agg):
+    return np.ascontiguousarray(agg.data[::-1])
+
+def _encode_npz(agg, meta):
+    buf = BytesIO()
+    np.savez_compressed(buf, data=_north_up(agg), metadata=np.array(json.dumps(meta)))
+
+    return buf.getvalue()
+
+def _encode_arrow(agg, meta):
+    import pyarrow as pa
+
+    # One column per category (or one column), each a row-major flattening of the grid.
+    #
+    data = _north_up(agg)
+    if agg.ndim>2:
+        columns = {str(c):data[..., i].ravel() for i,c in enumerate(agg.coords[agg.dims[2]].values)}
+    else:
+        columns = {'value': data.ravel()}
+    table = pa.table(columns).replace_schema_metadata({'aggregate': json.dumps(meta)})
+
+    buf = pa.BufferOutputStream()
+    with pa.ipc.new_stream(buf, table.schema) as writer:
+        writer.write_table(table)
+
+    return buf.getvalue().to_pybytes()
+
+def _encode_png16(agg, meta):
+    from PIL import Image, PngImagePlugin
+
+    if agg.ndim>2:
+        raise util.WmsError('InvalidFormat', 'A categorical layer can\'t be encoded as a 16-bit PNG')
+
+    # Counts are rounded (drafts have fractional weights) and clipped to 16 bits.
+    #
+    data = np.nan_to_num(_north_up(agg).astype('float64'))
+    meta['max'] = float(data.max())
+    img = Image.fromarray(np.clip(np.rint(data), 0, 65535).astype('uint16'))
+    info = PngImagePlugin.PngInfo()
+    info.add_text('aggregate', json.dumps(meta))
+    buf = BytesIO()
+    img.save(buf, format='png', pnginfo=info)
+
+    return buf.getvalue()
+
+# GetMap formats that return the aggregate of a layer rather than an image,
+# so a client can shade it. The metadata is stored in the "metadata" array of
+# an .npz, in the "aggregate" schema metadata of an Arrow stream,
+# and in the "aggregate" text chunk of a PNG.
+#
+AGGREGATE_FORMATS = {
+    'application/x-npz': _encode_npz,
+    'application/vnd.apache.arrow.stream': _encode_arrow,
+    'image/png; mode=16bit': _encode_png16
+}
+
+def empty_aggregate(width, height, dtype='uint32', categories=None, dim=None):
+    """The aggregate of a tile with nothing in it: zeros, or NaN if the dtype is floating point.
+
+    :param categories: The categories of a categorical aggregate, with dimensions (y, x, dim).
+    :param dim: The name of the category dimension (default CATEGORY).
+    """
+
+    shape = (height, width) if categories is None else (height, width, len(categories))
+    data = np.full(shape, np.nan, dtype=dtype) if np.dtype(dtype).kind=='f' else np.zeros(shape, dtype=dtype)
+    if categories is None:
+        return xr.DataArray(data, dims=['y', 'x'])
+
+    dim = dim or CATEGORY
+
+    return xr.DataArray(data, dims=['y', 'x', dim], coords={dim: list(categories)})
+
+def encode_aggregate(agg, format, bbox, **extra):
+    """Encode an aggregate (as returned by a wms.aggregate() function) in one of AGGREGATE_FORMATS.
+
+    :param extra: More metadata, such as the layer name.
+    """
+
+    return AGGREGATE_FORMATS[format](agg, aggregate_metadata(agg, bbox, **extra))
+
+# The side, in degrees, of the bounds EqHistLut gives a single point.
+#
+MIN_EXTENT = 1e-3
+
+class EqHistLut:
+    """Histogram equalisation precomputed over a complete dataset.
+
+    tf.shade(how='eq_hist') equalises the histogram of each tile separately,
+    which costs CPU per request, and gives the same density a different
+    color in neighbouring tiles. Instead, aggregate the full dataset once
+    at load time and keep the cumulative distribution of the per-pixel counts.
+    Shading is then a vectorised lookup of each aggregate value in the CDF.
+
+    Counts depend on the pixel size, so the CDF is built at one or more
+    resolutions ("levels", the width in pixels of a canvas covering the
+    dataset bounds). A tile uses the level with the closest pixel area,
+    and its counts are scaled to that pixel area before the lookup.
+    A single level gives one global normalisation; several levels give
+    a per-zoom normalisation.
+
+    :param df: The DataFrame (or list of DataFrames) containing the points.
+    :param x: The name of the x (longitude) column.
+    :param y: The name of the y (latitude) column.
+    :param bounds: The (minx, miny, maxx, maxy) bounds of the data.
+    :param agg: The datashader reduction; defaults to ds.count().
+    :param categories: If agg is categorical, the categories to count.
+    :param levels: Canvas widths at which to build the CDF.
+    :param nbins: The maximum number of points kept in each CDF.
+    """
+
+    def __init__(self, df, x, y, bounds, *, agg=None, categories=None, levels=(256, 1024, 2048), nbins=4096):
+        self.x = x
+        self.y = y
+        self.agg = ds.count() if agg is None else agg
+        self.categories = categories
+        self.nbins = nbins
+
+        # Points with a single longitude or latitude have bounds of zero width, which
+        # don't make a canvas. Such a side is padded to the other side (or, for a single
+        # point, both sides to MIN_EXTENT), centred on the points.
+        #
+        minx, miny, maxx, maxy = bounds
+        side = max(maxx-minx, maxy-miny) or MIN_EXTENT
+        if maxx==minx:
+            minx, maxx = minx-side/2, maxx+side/2
+        if maxy==miny:
+            miny, maxy = miny-side/2, maxy+side/2
+        self.bounds = minx, miny, maxx, maxy
+        self.canvases = []
+        self.aggs = []
+        for width in levels:
+            height = max(1, round(width * (maxy-miny) / (maxx-minx)))
+            cvs = ds.Canvas(plot_width=width, plot_height=height, x_range=(minx, maxx), y_range=(miny, maxy))
+            self.canvases.append(cvs)
+            self.aggs.append(self._aggregate(cvs, df))
+
+        self._build()
+
+    def _aggregate(self, cvs, df):
+        frames = df if isinstance(df, list) else [df]
+        agg = aggregate(cvs, frames, self.x, self.y, self.agg)
+        if self.categories is not None:
+            dim = agg.dims[2]
+            agg = agg.sel({dim:self.categories}).sum(dim=dim)
+
+        return agg.data
+
+    def _build(self):
+        minx, miny, maxx, maxy = self.bounds
+        levels = []
+        for data in self.aggs:
+            height, width = data.shape
+            pixel_area = (maxx-minx) / width * (maxy-miny) / height
+            levels.append(self._cdf(data, pixel_area))
+
+        # Replace the levels in one go, so concurrent shading sees either the old or new levels.
+        #
+        self.levels = levels
+
+    @property
+    def nbytes(self):
+        """The memory used by the precomputed aggregates and CDFs."""
+
+        return sum(agg.nbytes for agg in self.aggs) + sum(vals.nbytes+cdf.nbytes for _,vals,cdf in self.levels)
+
+    def update(self, df):
+        """Add new points to the precomputed aggregates and rebuild the CDFs.
+
+        The aggregates keep the bounds they were created with,
+        so points outside the original bounds are not counted.
+        """
+
+        self.aggs = [combine(self.agg, agg, self._aggregate(cvs, df)) for cvs,agg in zip(self.canvases, self.aggs)]
+        self._build()
+
+    def _cdf(self, data, pixel_area):
+        """Build the CDF of the non-empty pixel values of an aggregate."""
+
+        data = data[data>0]
+        if len(data)==0:
+            return pixel_area, np.array([0.0, 1.0]), np.array([0.0, 1.0])
+
+        vals, counts = np.unique(data, return_counts=True)
+        cdf = np.cumsum(counts).astype('f8')
+        cdf = (cdf-cdf[0]) / max(cdf[-1]-cdf[0], 1)
+        if len(vals)>self.nbins:
+            keep = np.linspace(0, len(vals)-1, self.nbins).astype(int)
+            vals = vals[keep]
+            cdf = cdf[keep]
+
+        return pixel_area, vals.astype('f8'), cdf
+
+    def normalise(self, data, bbox):
+        """Map raw aggregate values to [0, 1] using the precomputed CDF.
+
+        Pixels with no data are NaN.
+
+        :param data: A 2D array of aggregate values for the tile.
+        :param bbox: The (west, south, east, north) bounding box of the tile.
+        """
+
+        west, south, east, north = bbox
+        h, w = data.shape
+        pixel_area = (east-west) / w * (north-south) / h
+        level_area, vals, cdf = min(self.levels, key=lambda level:abs(math.log(level[0]/pixel_area)))
+
+        out = np.full(data.shape, np.nan)
+        mask = data>0
+        out[mask] = np.interp(data[mask] * (level_area/pixel_area), vals, cdf)
+
+        return out
+
+    def shade(self, agg, cmap, bbox):
+        """Shade a 2D aggregate with a colormap.
+
+        Equivalent to tf.shade(agg, cmap=cmap, how='eq_hist'),
+        except that the histogram is the dataset's rather than the tile's.
+        """
+
+        pal = palette_rgba(cmap)
+        q = self.normalise(agg.data, bbox)
+        mask = ~np.isnan(q)
+        rgba = np.zeros(q.shape, dtype=np.uint32)
+        rgba[mask] = pal[(q[mask]*(len(pal)-1)+0.5).astype(int)]
+
+        return tf.Image(rgba, coords=agg.coords, dims=agg.dims)
+
+    def shade_cat(self, agg, color_key, bbox, min_alpha=40):
+        """Shade a 3D categorical aggregate (as produced by ds.count_cat).
+
+        Each pixel is the count-weighted mix of the category colors.
+        The alpha is derived from the total count using the precomputed CDF,
+        as tf.shade(agg, color_key=color_key, how='eq_hist') does per tile.
+        """
+
+        cats = agg.coords[agg.dims[2]].values
+        cols = np.array([rgb(color_key[c]) for c in cats], dtype='f8')
+        data = agg.data.astype('f8')
+        totals = data.sum(axis=2)
+
+        q = self.normalise(totals, bbox)
+        mask = ~np.isnan(q)
+        mix = (data[mask] @ cols) / totals[mask, None]
+        r, g, b = (mix.T+0.5).astype(np.uint32)
+        a = (min_alpha + q[mask]*(255-min_alpha) + 0.5).astype(np.uint32)
+
+        rgba = np.zeros(totals.shape, dtype=np.uint32)
+        rgba[mask] = r | (g << 8) | (b << 16) | (a << 24)
+
+        dims = agg.dims[:2]
+
+        return tf.Image(rgba, coords={d:agg.coords[d] for d in dims}, dims=dims)
+
+class GridIndex:
+    """A uniform grid index over point coordinates.
+
+    The points are bucketed into the cells of a grid covering the bounds.
+    order holds the row numbers of the points sorted by cell, and
+    order[offsets[c]:offsets[c+1]] are the rows of the points in cell c.
+    Points outside the bounds are clamped into the edge cells.
+
+    :param x: The x (longitude) coordinates.
+    :param y: The y (latitude) coordinates.
+    :param bounds: The (minx, miny, maxx, maxy) bounds of the grid.
+    :param shape: The number of (x, y) cells in the grid.
+    :param quantizer: If x and y are quantised, the Quantizer that encoded them.
+    """
+
+    def __init__(self, x, y, bounds, shape=(256, 256), quantizer=None):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.bounds = bounds
+        self.quantizer = quantizer
+        self.nx, self.ny = shape
+
+        minx, miny, maxx, maxy = bounds
+        self.sx = self.nx / ((maxx-minx) or 1)
+        self.sy = self.ny / ((maxy-miny) or 1)
+
+        x, y = self._coords(slice(None))
+        cell = self._cx(x) + self._cy(y)*self.nx
+        itype = np.int32 if len(cell)<2**31 else np.int64
+        self.order = np.argsort(cell, kind='stable').astype(itype)
+        self.offsets = np.zeros(self.nx*self.ny+1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=self.nx*self.ny), out=self.offsets[1:])
+
+    def _coords(self, rows):
+        """Return the x and y coordinates of some rows."""
+
+        x, y = self.x[rows], self.y[rows]
+        if self.quantizer is not None:
+            x, y = self.quantizer.decode(x, y)
+
+        return x, y
+
+    def _cx(self, x):
+        with np.errstate(invalid='ignore'):
+            return np.clip(np.nan_to_num((np.asarray(x)-self.bounds[0])*self.sx), 0, self.nx-1).astype(np.int64)
+
+    def _cy(self, y):
+        with np.errstate(invalid='ignore'):
+            return np.clip(np.nan_to_num((np.asarray(y)-self.bounds[1])*self.sy), 0, self.ny-1).astype(np.int64)
+
+    def _ranges(self, bbox):
+        """Return the (start, stop) ranges of order covering the bbox, one per grid row."""
+
+        west, south, east, north = bbox
+        minx, miny, maxx, maxy = self.bounds
+        if west>maxx or east<minx or south>maxy or north<miny:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        cx0, cx1 = self._cx(west), self._cx(east)
+        rows = np.arange(self._cy(south), self._cy(north)+1) * self.nx
+
+        return self.offsets[rows+cx0], self.offsets[rows+cx1+1]
+
+    def count(self, bbox):
+        """Return the number of points in the cells that intersect the bbox.
+
+        This is an upper bound of the number of points in the bbox.
+        """
+
+        starts, stops = self._ranges(bbox)
+
+        return int((stops-starts).sum())
+
+    def rows(self, bbox):
+        """Return the row numbers of the points in the cells that intersect the bbox."""
+
+        starts, stops = self._ranges(bbox)
+        if len(starts)==0:
+            return self.order[:0]
+
+        return np.concatenate([self.order[a:b] for a,b in zip(starts, stops)])
+
+    def nearest(self, x, y, rx, ry, k=None, return_dist=False):
+        """Return the row numbers of the points within the ellipse with centre (x, y)
+        and radii (rx, ry), nearest first.
+
+        :param k: If specified, the maximum number of rows to return.
+        :param return_dist: If True, also return the (squared, normalised) distances.
+        """
+
+        rows = self.rows((x-rx, y-ry, x+rx, y+ry))
+        px, py = self._coords(rows)
+        dist = ((px-x)/rx)**2 + ((py-y)/ry)**2
+        inside = dist<=1
+        rows = rows[inside]
+        dist = dist[inside]
+        order = np.argsort(dist, kind='stable')[:k]
+
+        return (rows[order], dist[order]) if return_dist else rows[order]
+
+class Quantizer:
+    """Coordinates stored as unsigned integer steps from the corner of their bounds.
+
+    A coordinate x is stored as floor((x-minx) / scale), in 16 bits if the bounds
+    are at most 65535 steps across, and otherwise in 32 bits, rather than as a
+    64 bit float, so a point uses a quarter (or half) of the memory, and
+    aggregation reads a quarter (or half) of the bytes. Points are moved by less than
+    a step, which is invisible at any zoom level where a pixel is larger than a step.
+    (Rounding down rather than to the nearest step keeps the points on the maxx and maxy
+    edges inside the bounds.)
+
+    The integer coordinates are aggregated without decoding them, by drawing them
+    on a canvas whose ranges are converted to steps (see aggregate()).
+
+    Use for_bounds() rather than the constructor, which raises ValueError
+    if the bounds are too many steps across for 32 bits.
+
+    :param bounds: The (minx, miny, maxx, maxy) bounds of the coordinates.
+    :param scale: The size of a step, in the units of the coordinates.
+    """
+
+    def __init__(self, bounds, scale):
+        minx, miny, maxx, maxy = bounds
+        steps = max(maxx-minx, maxy-miny) / scale
+        if not steps<2**32:
+            raise ValueError(f'The bounds {bounds} are too many steps of {scale} across')
+
+        self.origin = minx, miny
+        self.scale = scale
+        self.dtype = np.dtype(np.uint16 if steps<2**16 else np.uint32)
+
+    def __repr__(self):
+        return f'Quantizer(origin={self.origin}, scale={self.scale}, dtype={self.dtype})'
+
+    @classmethod
+    def for_bounds(cls, bounds, scale):
+        """Return a Quantizer for the bounds, or None if they can't be quantised."""
+
+        try:
+            return cls(bounds, scale)
+        except ValueError:
+            return None
+
+    def encode(self, x, y):
+        """Return the integer steps of arrays of coordinates."""
+
+        ox, oy = self.origin
+
+        return (
+            np.floor((np.asarray(x)-ox) / self.scale).astype(self.dtype),
+            np.floor((np.asarray(y)-oy) / self.scale).astype(self.dtype)
+        )
+
+    def decode(self, qx, qy):
+        """Return the coordinates of arrays of integer steps."""
+
+        ox, oy = self.origin
+
+        return qx*self.scale + ox, qy*self.scale + oy
+
+    def decode_frame(self, df, x, y):
+        """Return a DataFrame with the x and y columns decoded.
+
+        The other columns are shared with df, not copied.
+        """
+
+        qx, qy = self.decode(df[x].values, df[y].values)
+        df = df.copy(deep=False)
+        df[x] = qx
+        df[y] = qy
+
+        return df
+
+    def canvas(self, cvs):
+        """Return a canvas like cvs, with its ranges in steps."""
+
+        ox, oy = self.origin
+        x0, x1 = cvs.x_range
+        y0, y1 = cvs.y_range
+
+        return ds.Canvas(
+            plot_width=cvs.plot_width,
+            plot_height=cvs.plot_height,
+            x_range=((x0-ox)/self.scale, (x1-ox)/self.scale),
+            y_range=((y0-oy)/self.scale, (y1-oy)/self.scale)
+        )
+
+    def aggregate(self, cvs, frames, x, y, agg):
+        """Aggregate quantised points onto a canvas, as aggregate() does with the decoded points.
+
+        The result has the coordinates of cvs (rather than steps),
+        so it can be combined with other aggregates of cvs.
+        """
+
+        result = aggregate(self.canvas(cvs), frames, x, y, agg)
+        xs = cvs.x_axis.compute_index(cvs.x_axis.compute_scale_and_translate(cvs.x_range, cvs.plot_width), cvs.plot_width)
+        ys = cvs.y_axis.compute_index(cvs.y_axis.compute_scale_and_translate(cvs.y_range, cvs.plot_height), cvs.plot_height)
+
+        return result.assign_coords({x: xs, y: ys})
+
+def data_bounds(df, x, y):
+    """Return the (minx, miny, maxx, maxy) bounds of the points in a DataFrame."""
+
+    return df[x].min(), df[y].min(), df[x].max(), df[y].max()
+
+def union_bounds(a, b):
+    """Return the bounds containing bounds a and b."""
+
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def partition_rows(df, column):
+    """Sort the rows of a DataFrame by the values of a column, so the rows with each value
+    are a contiguous slice.
+
+    Returns the sorted DataFrame, and a dictionary of {value: (start, stop)},
+    so that df.iloc[start:stop] (a view, not a copy) holds the rows with that value.
+    Rows where the column is missing are at the start, and aren't in any partition.
+    """
+
+    codes, values = pd.factorize(df[column], sort=True)
+    order = np.argsort(codes, kind='stable')
+    df = df.take(order).reset_index(drop=True)
+
+    edges = np.searchsorted(codes[order], np.arange(len(values)+1))
+    parts = {value:(int(edges[i]), int(edges[i+1])) for i,value in enumerate(values)}
+
+    return df, parts
+
+class PointSet:
+    """A point dataset that can grow without being reloaded.
+
+    The points are held as a list of DataFrame chunks, each with its own GridIndex.
+    Appending a batch adds a chunk, and aggregation sums the aggregates of the chunks
+    that intersect the canvas. When there are more than max_chunks appended chunks,
+    they are merged into one.
+
+    If partition is a column name, the rows of each chunk are sorted by that column
+    (see partition_rows()), so the points with some values of the column (such as
+    some categories) can be aggregated without scanning, or copying, the rest.
+    The sorted chunks replace the DataFrames they were made from: use frames()
+    rather than the original DataFrame.
+
+    If precision is given, the coordinates of each chunk are quantised to steps of
+    that size from the corner of the chunk's bounds (see Quantizer), and points
+    without coordinates are dropped. The x and y columns of frames() then hold
+    the integer steps; frames(decode=True) and nearest() return the coordinates.
+
+    :param df: The initial points.
+    :param x: The name of the x (longitude) column.
+    :param y: The name of the y (latitude) column.
+    :param max_chunks: The number of appended chunks that triggers a merge.
+    :param partition: The name of a column to partition the points by.
+    :param precision: The step of quantised coordinates, in the units of the coordinates.
+    """
+
+    def __init__(self, df, x, y, *, max_chunks=8, partition=None, precision=None):
+        self.x = x
+        self.y = y
+        self.max_chunks = max_chunks
+        self.partition = partition
+        self.precision = precision
+        self.chunks = [self._chunk(df)]
+        self.bounds = self.chunks[0][1]
+
+    def _chunk(self, df):
+        """Return a (df, bounds, index, parts) chunk."""
+
+        x, y = self.x, self.y
+        if self.precision is not None:
+            missing = df[x].isna() | df[y].isna()
+            if missing.any():
+                df = df[~missing].reset_index(drop=True)
+
+        parts = None
+        if self.partition is not None:
+            df, parts = partition_rows(df, self.partition)
+
+        bounds = data_bounds(df, x, y)
+
+        # The quantised columns are made into one block, as the float columns were:
+        # datashader copies the columns it uses out of the DataFrame, which is slower
+        # from separate blocks than from one.
+        #
+        quantizer = None
+        if self.precision is not None and len(df):
+            quantizer = Quantizer.for_bounds(bounds, self.precision)
+        if quantizer is not None:
+            qx, qy = quantizer.encode(df[x].values, df[y].values)
+            df = pd.concat([pd.DataFrame({x: qx, y: qy}, index=df.index), df.drop(columns=[x, y])], axis=1)
+
+        # Aim for a few dozen points per cell.
+        #
+        side = int(np.clip(math.sqrt(len(df)/32), 1, 256))
+        index = GridIndex(df[x].values, df[y].values, bounds, (side, side), quantizer)
+
+        return df, bounds, index, parts
+
+    def __len__(self):
+        return sum(len(df) for df,*_ in self.chunks)
+
+    def _decoded(self, chunk):
+        df, _, index, _ = chunk
+
+        return df if index.quantizer is None else index.quantizer.decode_frame(df, self.x, self.y)
+
+    def frames(self, decode=False):
+        """Return the DataFrames of the chunks.
+
+        :param decode: If True, decode quantised coordinates. This copies the coordinate columns.
+        """
+
+        if decode:
+            return [self._decoded(chunk) for chunk in self.chunks]
+
+        return [df for df,*_ in self.chunks]
+
+    def values(self):
+        """Return the values of the partition column, sorted."""
+
+        if self.partition is None:
+            return []
+
+        return sorted(set().union(*(parts for *_,parts in self.chunks)))
+
+    def append(self, df):
+        """Add new points. Returns the bounds of the new points."""
+
+        chunk = self._chunk(df)
+        chunks = self.chunks + [chunk]
+        if len(chunks)>self.max_chunks+1:
+            merged = pd.concat([self._decoded(c) for c in chunks[1:]], ignore_index=True)
+            chunks = [chunks[0], self._chunk(merged)]
+
+        # Replace the list in one go, so concurrent renders see either the old or new chunks.
+        #
+        self.chunks = chunks
+        self.bounds = union_bounds(self.bounds, chunk[1])
+
+        return chunk[1]
+
+    def assign(self, **columns):
+        """Add or replace columns of every chunk.
+
+        Each keyword is a column name, and its value is a function of a chunk's DataFrame
+        that returns the column. The DataFrames are replaced by shallow copies (sharing
+        the other columns), and the list of chunks in one go, so concurrent renders
+        see either the old or the new columns.
+        """
+
+        chunks = []
+        for df,bounds,index,parts in self.chunks:
+            new = df.copy(deep=False)
+            for name, func in columns.items():
+                new[name] = func(df)
+            chunks.append((new, bounds, index, parts))
+
+        self.chunks = chunks
+
+    def count(self, bbox):
+        """Return an upper bound of the number of points in the bbox."""
+
+        return sum(index.count(bbox) for _,_,index,_ in self.chunks)
+
+    def aggregate(self, cvs, agg, values=None):
+        """Aggregate the points onto a canvas.
+
+        :param values: If the points are partitioned, aggregate only the points
+            with these values of the partition column.
+        """
+
+        x_range, y_range = cvs.x_range, cvs.y_range
+        bbox = x_range[0], y_range[0], x_range[1], y_range[1]
+        if values is not None and self.partition is None:
+            raise ValueError('The points are not partitioned')
+
+        chunks = self.chunks
+        groups = []
+        for df,bounds,index,parts in chunks:
+            if bbox_intersects(bounds, bbox):
+                dfs = [df] if values is None else [df.iloc[slice(*parts[value])] for value in values if value in parts]
+                if dfs:
+                    groups.append((index.quantizer, dfs))
+        if not groups:
+            groups = [(chunks[0][2].quantizer, [chunks[0][0].iloc[:0]])]
+
+        if all(quantizer is None for quantizer,_ in groups):
+            return aggregate(cvs, [df for _,dfs in groups for df in dfs], self.x, self.y, agg)
+
+        # Each chunk's coordinates are in its own steps, so the chunks are aggregated separately.
+        #
+        results = []
+        for quantizer, dfs in groups:
+            check_cancelled()
+            if quantizer is None:
+                results.append(aggregate(cvs, dfs, self.x, self.y, agg))
+            else:
+                results.append(quantizer.aggregate(cvs, dfs, self.x, self.y, agg))
+
+        return reduce(lambda a, b: combine(agg, a, b), results)
+
+    def aggregate_values(self, cvs, values, dim):
+        """Count the points with each of the values of the partition column.
+
+        Returns a categorical aggregate with dimensions (y, x, dim), as ds.count_cat()
+        would, but reading only the partitions of the values, so the values can be any
+        subset (of any size) of the column, which doesn't need to be categorical.
+        """
+
+        aggs = []
+        for value in values:
+            check_cancelled()
+            aggs.append(self.aggregate(cvs, ds.count(), [value]))
+        agg = xr.concat(aggs, dim=pd.Index(values, name=dim))
+
+        return agg.transpose(*aggs[0].dims, dim)
+
+    def nearest(self, x, y, rx, ry, k=None):
+        """Return a DataFrame of the points within the ellipse with centre (x, y)
+        and radii (rx, ry), nearest first.
+        """
+
+        dfs = []
+        dists = []
+        for df,_,index,_ in self.chunks:
+            rows, dist = index.nearest(x, y, rx, ry, k, return_dist=True)
+            df = df.iloc[rows]
+            dfs.append(df if index.quantizer is None else index.quantizer.decode_frame(df, self.x, self.y))
+            dists.append(dist)
+
+        order = np.argsort(np.concatenate(dists), kind='stable')[:k]
+
+        return pd.concat(dfs, ignore_index=True).iloc[order]
+
+class TrackSet:
+    """The tracks of moving objects (such as vessels), arranged for drawing with cvs.line().
+
+    Drawing tracks per request would mean grouping the points by object and
+    sorting them by time for every tile. Instead, the points are sorted by
+    (track, time) once, a track is split wherever consecutive points are more
+    than max_gap apart in time, and the coordinates are stored as two contiguous
+    arrays with a NaN after each track, which cvs.line() treats as a break.
+    Each track has a bounding box, so a tile only draws the tracks that intersect it.
+    Points without coordinates are dropped, and tracks with a single point can't be
+    drawn as lines, so they are dropped too.
+
+    :param df: The points.
+    :param x: The name of the x (longitude) column.
+    :param y: The name of the y (latitude) column.
+    :param track: The name of the column identifying the track (such as a vessel id).
+    :param time: The name of the time column (datetimes, or numbers in seconds).
+    :param max_gap: Split tracks at time gaps longer than this many seconds.
+    """
+
+    def __init__(self, df, x, y, track, time, *, max_gap=None):
+        self.x = x
+        self.y = y
+
+        # A point without coordinates would give its track a NaN bounding box (and the set NaN bounds).
+        #
+        missing = df[x].isna() | df[y].isna()
+        if missing.any():
+            df = df[~missing]
+
+        ids = df[track].values
+        ts = df[time].values
+        order = np.lexsort((ts, ids))
+        xs = df[x].values[order].astype('f8')
+        ys = df[y].values[order].astype('f8')
+        ids = ids[order]
+        ts = ts[order]
+
+        breaks = ids[1:]!=ids[:-1]
+        if max_gap is not None:
+            gaps = np.diff(ts)
+            if gaps.dtype.kind=='m':
+                gaps = gaps / np.timedelta64(1, 's')
+            breaks |= gaps>max_gap
+
+        starts = np.concatenate([[0], np.flatnonzero(breaks)+1]) if len(xs) else np.zeros(0, dtype=int)
+        lengths = np.diff(np.append(starts, len(xs)))
+        keep = lengths>1
+        if not keep.all():
+            points = np.repeat(keep, lengths)
+            xs, ys = xs[points], ys[points]
+            lengths = lengths[keep]
+            starts = np.cumsum(lengths) - lengths
+
+        # Point i of track k is at i+k in the arrays, followed by a NaN at the end of each track.
+        #
+        n = len(lengths)
+        self.starts = starts + np.arange(n)
+        self.lengths = lengths
+        positions = np.arange(len(xs)) + np.repeat(np.arange(n), lengths)
+        line_x = np.full(len(xs)+n, np.nan)
+        line_y = np.full(len(xs)+n, np.nan)
+        line_x[positions] = xs
+        line_y[positions] = ys
+        self.lines = pd.DataFrame({x: line_x, y: line_y})
+
+        if n:
+            self.minx, self.maxx = np.minimum.reduceat(xs, starts), np.maximum.reduceat(xs, starts)
+            self.miny, self.maxy = np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts)
+            self.bounds = self.minx.min(), self.miny.min(), self.maxx.max(), self.maxy.max()
+        else:
+            self.minx = self.maxx = self.miny = self.maxy = np.zeros(0)
+            self.bounds = 0.0, 0.0, 0.0, 0.0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def nbytes(self):
+        return int(self.lines.memory_usage(index=False).sum()) + sum(a.nbytes for a in (self.starts, self.lengths, self.minx, self.maxx, self.miny, self.maxy))
+
+    def _intersecting(self, bbox):
+        west, south, east, north = bbox
+
+        return (self.minx<=east) & (self.maxx>=west) & (self.miny<=north) & (self.maxy>=south)
+
+    def count(self, bbox):
+        """Return the number of tracks whose bounding boxes intersect the bbox."""
+
+        return int(np.count_nonzero(self._intersecting(bbox)))
+
+    def select(self, bbox):
+        """Return a DataFrame of the tracks that intersect the bbox, separated by NaNs, or None."""
+
+        mask = self._intersecting(bbox)
+        starts = self.starts[mask]
+        if len(starts)==0:
+            return None
+
+        # Each track is followed by its NaN separator.
+        #
+        lengths = self.lengths[mask] + 1
+        total = int(lengths.sum())
+        if total>len(self.lines)//2:
+            return self.lines
+
+        rows = np.repeat(starts - (np.cumsum(lengths)-lengths), lengths) + np.arange(total)
+
+        return pd.DataFrame({self.x: self.lines[self.x].values[rows], self.y: self.lines[self.y].values[rows]})
+
+class VectorSet:
+    """Polygons or lines arranged for drawing with cvs.polygons() or cvs.line().
+
+    Rasterising every feature at full resolution for every tile would spend most
+    of the time on features outside the tile, and on vertices closer together than
+    a pixel. Instead, the geometries are simplified once for each of a series of
+    zoom bands: the coarsest has a tolerance of one pixel of a tile covering all of
+    the data, and each band's tolerance is 1/band of the previous one's. Each band
+    has an STRtree (a packed R-tree) of its geometries. A tile uses the coarsest band
+    whose tolerance is at most half a pixel, and only draws the features whose
+    bounding boxes intersect it. Bands stop when the tolerance is below min_tolerance,
+    or when simplifying no longer removes a quarter of the vertices; finer tiles use
+    the geometries as they were loaded.
+
+    A VectorSet holds either polygons (and multipolygons) or lines (and multilines);
+    features without a geometry are dropped.
+
+    This needs geopandas (and shapely), which are imported when a VectorSet is created,
+    so that servers without vector layers don't need them.
+
+    :param gdf: A GeoDataFrame in longitude and latitude.
+    :param band: The ratio of the tolerances of consecutive zoom bands.
+    :param min_tolerance: The finest tolerance, in degrees.
+    :param tile_size: The width of a tile in pixels.
+    """
+
+    def __init__(self, gdf, *, band=4, min_tolerance=1e-5, tile_size=256):
+        import shapely
+
+        gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)].reset_index(drop=True)
+        kinds = set(gdf.geom_type)
+        if kinds<={'Polygon', 'MultiPolygon'}:
+            self.kind = 'polygons'
+        elif kinds<={'LineString', 'MultiLineString', 'LinearRing'}:
+            self.kind = 'lines'
+        else:
+            raise ValueError(f'A vector layer needs polygons or lines, not {sorted(kinds)}')
+
+        self.gdf = gdf
+        self.bounds = tuple(float(v) for v in gdf.total_bounds) if len(gdf) else (0.0, 0.0, 0.0, 0.0)
+
+        # The bands, coarsest first, as (tolerance, rows, geometries, STRtree), where rows
+        # are the rows of gdf of the geometries (simplifying can make small features empty).
+        # The full resolution band has a tolerance of 0.
+        #
+        geoms = np.asarray(gdf.geometry.values)
+        full = int(shapely.get_num_coordinates(geoms).sum())
+        minx, miny, maxx, maxy = self.bounds
+        tolerance = max(maxx-minx, maxy-miny) / tile_size
+        self.bands = []
+        while tolerance>=min_tolerance:
+            simplified = shapely.simplify(geoms, tolerance, preserve_topology=True)
+            rows = np.flatnonzero(~shapely.is_empty(simplified))
+            simplified = simplified[rows]
+            if shapely.get_num_coordinates(simplified).sum()>full*3/4:
+                break
+            self.bands.append((tolerance, rows, simplified, shapely.STRtree(simplified)))
+            tolerance /= band
+
+        self.bands.append((0.0, np.arange(len(geoms)), geoms, shapely.STRtree(geoms)))
+
+    def __len__(self):
+        return len(self.gdf)
+
+    @property
+    def nbytes(self):
+        import shapely
+
+        # Each vertex is two doubles.
+        #
+        coords = sum(int(shapely.get_num_coordinates(geoms).sum()) for _,_,geoms,_ in self.bands)
+
+        return 16*coords + int(self.gdf.drop(columns=self.gdf.geometry.name).memory_usage(deep=True).sum())
+
+    def select(self, bbox, pixel=0.0):
+        """Return a GeoDataFrame of the features whose bounding boxes intersect the bbox,
+        simplified for the pixel size, or None.
+        """
+
+        import shapely
+
+        tolerance, rows, geoms, tree = next(b for b in self.bands if b[0]<=pixel/2)
+        found = np.sort(tree.query(shapely.box(*bbox)))
+        if len(found)==0:
+            return None
+
+        gdf = self.gdf.iloc[rows[found]]
+
+        return gdf if tolerance==0 else gdf.set_geometry(geoms[found])
+
+    def count(self, bbox):
+        """Return the number of features whose bounding boxes intersect the bbox."""
+
+        import shapely
+
+        return len(self.bands[-1][3].query(shapely.box(*bbox)))
+
+    def aggregate(self, cvs, agg, *, line_width=0):
+        """Aggregate the features that intersect a canvas, or return None if there aren't any.
+
+        :param line_width: For lines, the width in pixels; 0 draws one pixel lines without antialiasing.
+        """
+
+        west, east = cvs.x_range
+        south, north = cvs.y_range
+        pixel = min((east-west)/cvs.plot_width, (north-south)/cvs.plot_height)
+        gdf = self.select((west, south, east, north), pixel)
+        if gdf is None:
+            return None
+
+        # Datashader fills a polygon by testing its edges, so the polygons are clipped
+        # to the canvas (and a pixel around it, so the cut edges aren't drawn).
+        # When zoomed in on large polygons, this is most of their edges.
+        #
+        geometry = gdf.geometry.name
+        if self.kind=='polygons':
+            import shapely
+
+            clipped = shapely.clip_by_rect(gdf.geometry.values, west-pixel, south-pixel, east+pixel, north+pixel)
+            keep = ~shapely.is_empty(clipped)
+            if not keep.any():
+                return None
+            gdf = gdf[keep].set_geometry(clipped[keep])
+
+            return cvs.polygons(gdf, geometry=geometry, agg=agg)
+        elif line_width:
+            return cvs.line(gdf, geometry=geometry, agg=agg, line_width=line_width)
+        else:
+            return cvs.line(gdf, geometry=geometry, agg=agg)
+
+    def nearest(self, x, y, rx, ry, k=None):
+        """Return a GeoDataFrame of the (full resolution) features within the ellipse
+        with centre (x, y) and radii (rx, ry), nearest first, and the nearest point
+        of each feature as (x, y) arrays.
+
+        A point inside a polygon is at distance 0 from it.
+        """
+
+        import shapely
+
+        tree = self.bands[-1][3]
+        rows = tree.query(shapely.box(x-rx, y-ry, x+rx, y+ry), predicate='intersects')
+        gdf = self.gdf.iloc[np.sort(rows)]
+
+        # Measure in units of the radii, so the ellipse is a unit circle.
+        #
+        point = shapely.Point(x, y)
+        nearest = shapely.get_coordinates(shapely.shortest_line(gdf.geometry.values, point))[0::2]
+        dist = ((nearest[:, 0]-x)/rx)**2 + ((nearest[:, 1]-y)/ry)**2
+        inside = dist<=1
+        order = np.argsort(dist[inside], kind='stable')[:k]
+
+        return gdf[inside].iloc[order], nearest[inside][order, 0], nearest[inside][order, 1]
+
+# Point layers defined in the [layers] section of config.toml.
+#
+# Each [layers.NAME] table defines one layer, rendered by PointLayer:
+#
+#   file         The parquet file containing the points.
+#   x, y         The longitude and latitude columns (default "x" and "y").
+#   reduction    "count" (the default), "count_cat", "sum", "max", or "mean".
+#   column       The column to reduce (not needed for count).
+#   categories   For count_cat, the number of most common categories shown (default 10).
+#                A request can choose other categories with the CATEGORIES vendor parameter.
+#   colormap     A colorcet or datashader colormap name, or a list of colors.
+#                For count_cat, the colors of the categories (default "glasbey").
+#   styles       Further colormaps; each becomes a style that the client can choose.
+#   how          The tf.shade() normalisation when global shading isn't used (default "eq_hist").
+#   global_shading  Shade counts and sums with a histogram of the whole dataset (default true).
+#                Maxima and means are always shaded per tile. Layers shaded per tile are
+#                limited to the streaming threshold ([render] stream_pixels), since each strip
+#                of a larger image would be shaded separately.
+#   spread       The max_px of tf.dynspread(), or 0 to not spread (default 4).
+#   spread_threshold, spread_shape  Passed to tf.dynspread() (default 0.5 and "circle").
+#   info         Columns returned by GetFeatureInfo; if omitted, the layer isn't queryable.
+#   title, abstract, priority, cache  As for wms.layer() (cache defaults to true).
+#   type         "points" (the default), "tracks" to draw lines (see TrackLayer),
+#                or "vector" to draw shapes (see VectorLayer).
+#   time_budget_ms  If a tile would take longer than this to aggregate, draw a draft
+#                from a stratified sample of the points (see stratified_sample()).
+#   sample_size  The number of points in the sample (default 1000000).
+#   precision_m  Store the coordinates as 16 or 32 bit integers, in steps of this many metres
+#                (converted to degrees at the equator), rather than as 64 bit floats (see Quantizer).
+#                A step of 1 is smaller than a pixel down to web map zoom level 17.
+#
+# If file contains "{path}", the layer is partitioned by the WMS path: /WMS/2024-03-01/
+# reads file.format(path='2024-03-01') when it is first used (see util.PartitionedDataset).
+# Partitioned layers also have:
+#
+#   bounds       The [minx, miny, maxx, maxy] advertised in the capabilities (default: the world).
+#                (Layers that aren't partitioned advertise this until their data has loaded.)
+#   default_path The partition used when the path is empty; if omitted, an empty path is an error.
+#
+# Track layers (type = "tracks") join the points of each track with lines, and also have:
+#
+#   track        The column identifying the track, such as a vessel id (required).
+#   time         The time column used to order the points of a track (required).
+#   max_gap      Tracks are split where consecutive points are more than this many seconds apart.
+#   line_width   The width of the lines in pixels; 0 (the default) draws one pixel lines without antialiasing.
+#
+# A track layer's reduction is always "count" (the number of lines through each pixel),
+# it is shaded per tile (so it is limited to the streaming threshold), and spread defaults to 0.
+#
+# Vector layers (type = "vector") draw the polygons or lines in a shapefile (or any file
+# that geopandas can read, or a GeoParquet file), such as maritime zones or coastlines
+# (see VectorSet). They need geopandas. The reduction is "count" (the number of shapes
+# covering each pixel), "sum", "max", or "mean" of a column; x and y aren't used. They also have:
+#
+#   fill         If false, draw the outlines of polygons rather than filling them (default true).
+#   line_width   As for track layers.
+#   span         The [min, max] values of the colormap (default: from 0 to the tile's maximum
+#                for count, and the tile's minimum and maximum otherwise).
+#   band         The ratio of the simplification tolerances of consecutive zoom bands (default 4,
+#                so a band covers two zoom levels).
+#   min_tolerance  The finest simplification tolerance in degrees (default 0.00001, about a metre);
+#                tiles with smaller pixels draw the shapes as they were loaded.
+#
+# A vector layer is shaded per tile (with how = "linear" by default) unless span is given,
+# and spread defaults to 0.
+# GetFeatureInfo returns the shapes within the search radius, with the nearest point of each.
+#
+
+REDUCTIONS = ['count', 'count_cat', 'sum', 'max', 'mean']
+
+# Paths are used in file names, so they are restricted to safe characters.
+#
+PARTITION_PATH = re.compile(r'[A-Za-z0-9_.-]+')
+CATEGORY = '_category'
+OTHER = '(other)'
+WEIGHT = '_weight'
+WEIGHTED = '_weighted'
+
+# The length of a degree of latitude (and of longitude at the equator), used to convert precision_m.
+#
+METRES_PER_DEGREE = 111_320
+
+# The weight of the estimated aggregation rate of a layer (points per second) given
+# to each new measurement.
+#
+RATE_SMOOTHING = 0.2
+
+def stratified_sample(df, x, y, bounds, size, *, cells=256, seed=0):
+    """Return a random sample of about size rows of df, stratified by location,
+    with a WEIGHT column giving the number of points each sampled point stands for.
+
+    The bounds are divided into cells x cells strata, which are sampled at
+    the same rate, except that each stratum keeps at least one point, so that
+    sparse areas don't disappear from drafts. Aggregating the weights of the sample
+    (rather than counting the points) estimates the counts of the full dataset.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    n = len(df)
+    cx = np.nan_to_num((df[x].values-minx) / ((maxx-minx) or 1) * cells)
+    cy = np.nan_to_num((df[y].values-miny) / ((maxy-miny) or 1) * cells)
+    cell = np.clip(cy.astype(int), 0, cells-1)*cells + np.clip(cx.astype(int), 0, cells-1)
+
+    counts = np.bincount(cell, minlength=cells*cells)
+    keep = np.where(counts>0, np.maximum(1, np.round(counts*size/n)), 0).astype(int)
+
+    # Shuffle the points within each stratum, and keep the first keep[stratum].
+    #
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(n), cell))
+    rank = np.arange(n) - (np.cumsum(counts)-counts)[cell[order]]
+    rows = np.sort(order[rank<keep[cell[order]]])
+
+    sample = df.iloc[rows].reset_index(drop=True)
+    sample[WEIGHT] = (counts / np.maximum(keep, 1))[cell[rows]]
+
+    return sample
+
+def colormap(cmap):
+    """Return a list of '#rrggbb' colors given a colorcet or datashader colormap name, or a list of colors."""
+
+    import colorcet
+    import datashader.colors
+
+    if isinstance(cmap, list):
+        pal = cmap
+    elif cmap in colorcet.palette:
+        pal = list(colorcet.palette[cmap])
+    else:
+        pal = getattr(datashader.colors, cmap, None)
+        if not isinstance(pal, list):
+            raise ValueError(f'Unknown colormap "{cmap}"')
+
+    return [c if isinstance(c, str) else util.tuple_to_rgb([c])[0] for c in pal]
+
+def resample(pal, n):
+    """Return n colors evenly spaced along a colormap."""
+
+    return [pal[i] for i in np.linspace(0, len(pal)-1, n).round().astype(int)]
+
+def _read_parquet(fnam, columns):
+    return pd.read_parquet(fnam, columns=columns)
+
+# The columns read by read_columns(): {path: fingerprint of the file they were read from}.
+#
+_files = {}
+_files_lock = threading.Lock()
+_file_locks = {}
+
+def read_columns(fnam, columns, view):
+    """Read some of the columns of a parquet file, sharing them with the other layers that read it.
+
+    The columns read from each file are registered in util.registry as the dataset
+    "file:<path>", and each layer's columns are a view of it, so layers over the same
+    file hold one copy of the columns they have in common. Only the columns that haven't
+    been read yet are read. When the file changes (see util.file_fingerprint()),
+    the next call starts a new copy; the previous copy is released when the last
+    version of a layer that uses it is replaced.
+
+    :param fnam: The parquet file.
+    :param columns: The columns to read.
+    :param view: The name of the view of the columns in util.registry.
+    Returns a DataFrame.
+    """
+
+    path = os.path.abspath(fnam)
+    name = f'file:{path}'
+    with _files_lock:
+        lock = _file_locks.setdefault(path, threading.Lock())
+
+    with lock:
+        fingerprint = util.file_fingerprint(path)
+        df = util.registry.frames(name)[0] if path in _files and _files[path]==fingerprint else None
+        missing = [c for c in columns if df is None or c not in df.columns]
+        if missing:
+            new = pd.read_parquet(path, columns=missing)
+            if df is not None:
+                new = pd.DataFrame({**{c:df[c] for c in df.columns}, **{c:new[c] for c in new.columns}}, copy=False)
+            util.registry.register(name, new)
+            _files[path] = fingerprint
+
+        util.registry.view(view, name, columns=list(columns))
+
+        return util.registry.resolve(view)[0]
+
+class PointData:
+    """One loaded version of the points of a PointLayer.
+
+    :param fnam: The parquet file.
+    :param spec: The settings of the layer.
+    :param read: A function(fnam, columns) that reads the columns of the file;
+        by default, pd.read_parquet().
+    """
+
+    def __init__(self, fnam, spec, read=None):
+        x, y = spec['x'], spec['y']
+        column = spec.get('column')
+        info = spec.get('info', [])
+        columns = list(dict.fromkeys([x, y] + ([column] if column else []) + info))
+
+        self.df = (read or _read_parquet)(fnam, columns)
+
+        # As in image_ais.py, the categories beyond the most common are counted
+        # in a trailing OTHER category of a one-byte column, which is dropped from the aggregate.
+        # The points are partitioned by category, so a request for some of the categories
+        # (including those that aren't among the most common) only reads their points.
+        #
+        self.categories = None
+        self.values = None
+        if spec['reduction']=='count_cat':
+            counts = self.df[column].value_counts()
+            self.categories = sorted(counts.head(spec.get('categories', 10)).index)
+            values = self.df[column].where(self.df[column].isin(self.categories), OTHER)
+            self.df[CATEGORY] = pd.Categorical(values, categories=self.categories+[OTHER])
+
+        precision = spec.get('precision_m')
+        self.points = PointSet(self.df, x, y,
+            partition=column if self.categories is not None else None,
+            precision=precision/METRES_PER_DEGREE if precision else None
+        )
+        self.df = self.points.frames()[0]
+        self.bounds = self.points.bounds
+        if self.categories is not None:
+            self.values = self.points.values()
+
+        # The shading histogram and the sample are made from the coordinates,
+        # which are only decoded (if they are quantised) while they are made.
+        #
+        df = self.points.frames(decode=True)[0]
+
+        self.lut = None
+        if spec.get('global_shading', True) and spec['reduction'] not in ('max', 'mean'):
+            self.lut = EqHistLut(df, x, y, self.bounds, agg=self._lut_agg(spec), categories=self.categories)
+
+        # Layers with a time budget keep a sample of the points for drafts.
+        # Sums and means are estimated from the weighted values; points without
+        # a value have no weight.
+        #
+        self.sample = None
+        size = spec.get('sample_size', 1_000_000)
+        if spec.get('time_budget_ms') and len(df)>2*size:
+            if spec['reduction']=='count_cat':
+                columns = [x, y, CATEGORY]
+            else:
+                columns = [x, y] + ([column] if column else [])
+            self.sample = stratified_sample(df[columns], x, y, self.bounds, size)
+            if spec['reduction'] in ('sum', 'max', 'mean'):
+                self.sample[WEIGHT] *= self.sample[column].notna()
+                self.sample[WEIGHTED] = self.sample[column] * self.sample[WEIGHT]
+
+    def frames(self):
+        """The chunks as they are held, so registered datasets report (and share) the real columns.
+
+        Quantised coordinates are integer steps; a view that needs the coordinates
+        decodes them with self.points.frames(decode=True) when it's used.
+        """
+
+        return self.points.frames()
+
+    @staticmethod
+    def _lut_agg(spec):
+        reduction = spec['reduction']
+        if reduction=='count':
+            return ds.count()
+        elif reduction=='count_cat':
+            return ds.count_cat(CATEGORY)
+        else:
+            return ds.sum(spec['column'])
+
+class PointLayer:
+    """A point layer defined by a [layers.NAME] table in config.toml.
+
+    All such layers share this implementation: the points are held in a PointSet
+    (so empty tiles are detected from the index, and aggregation only reads the
+    chunks that intersect the tile), shaded with a precomputed EqHistLut where
+    possible, cached in util.tile_cache, and timed in util.metrics.
+    The data is a util.DatasetHandle, so it can be reloaded while the server is running,
+    or a util.PartitionedDataset if the file depends on the WMS path.
+
+    :param name: The layer name.
+    :param spec: The settings from config.toml.
+    """
+
+    def __init__(self, name, spec):
+        spec = {'x': 'x', 'y': 'y', 'reduction': 'count', **spec}
+        if 'file' not in spec:
+            raise ValueError(f'Layer "{name}": "file" is required')
+        if spec['reduction'] not in REDUCTIONS:
+            raise ValueError(f'Layer "{name}": reduction must be one of {REDUCTIONS}')
+        if spec['reduction']!='count' and 'column' not in spec:
+            raise ValueError(f'Layer "{name}": reduction "{spec["reduction"]}" needs a column')
+
+        self.name = name
+        self.spec = spec
+        self.reduction = spec['reduction']
+        self._rate = None
+
+        default = 'glasbey' if self.reduction=='count_cat' else 'fire'
+        cmaps = [spec.get('colormap', default)] + spec.get('styles', [])
+        self.styles = {}
+        for cmap in cmaps:
+            style_name = f'{name}_{cmap}' if isinstance(cmap, str) else f'{name}_{len(self.styles)}'
+            self.styles[style_name] = colormap(cmap)
+            wms.style(style_name, categories=self.reduction=='count_cat')(self.legend)
+
+        # Until the data has loaded in the background, the layer's bounds are the
+        # bounds setting (or the whole world); then they are the bounds of the data.
+        #
+        self.dataset = None
+        self.partitions = None
+        minx, miny, maxx, maxy = spec.get('bounds', (-180.0, -90.0, 180.0, 90.0))
+        if '{path}' in spec['file']:
+            self.partitions = util.PartitionedDataset(name, self._load_partition)
+
+        wms.layer(name,
+            title=spec.get('title', name),
+            abstract=spec.get('abstract', f'Points from {spec["file"]}'),
+            minx=minx,
+            miny=miny,
+            maxx=maxx,
+            maxy=maxy,
+            priority=spec.get('priority'),
+            style=list(self.styles),
+            cache=spec.get('cache', True),
+            stream=self._streams()
+        )(self.render)
+
+        wms.aggregate(name, shade=self.shade, empty=self.empty_aggregate)(self.aggregate)
+
+        if spec.get('info'):
+            wms.feature_info(name)(self.feature_info)
+
+        if self.partitions is None:
+            self.dataset = util.DatasetHandle(name, self._load, spec['file'], on_swap=self._swapped, background=True)
+
+    def _streams(self):
+        """Can large images be rendered in strips? Only if the shading doesn't depend on the image."""
+
+        return self.spec.get('global_shading', True) and self.reduction not in ('max', 'mean')
+
+    def _swapped(self, data):
+        minx, miny, maxx, maxy = data.bounds
+        wms.update_layer(self.name, minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+        util.tile_cache.invalidate([self.name], generation=util.dataset_handles[self.name].fingerprint)
+        util.registry.register(self.name, data.frames)
+
+    def _load(self, fnam):
+        return PointData(fnam, self.spec, self._read)
+
+    def _read(self, fnam, columns):
+        """Read the layer's columns of a file.
+
+        The columns of a single file are shared with the other layers over the file
+        (see read_columns()). The files of a partitioned layer are each read separately,
+        as a partition's memory is released when it is evicted.
+        """
+
+        if self.partitions is not None:
+            return _read_parquet(fnam, columns)
+
+        return read_columns(fnam, columns, f'{self.name}:columns')
+
+    def _load_partition(self, path):
+        fnam = self.spec['file'].format(path=path)
+        if not PARTITION_PATH.fullmatch(path) or not os.path.exists(fnam):
+            raise util.WmsError('LayerNotDefined', f'Layer "{self.name}" has no data for path "{path}"')
+
+        return self._load(fnam)
+
+    def _data(self, path):
+        """A context manager giving the data for the WMS path."""
+
+        if self.partitions is None:
+            return nullcontext(self.dataset.current)
+
+        path = path.strip('/') or self.spec.get('default_path')
+        if not path:
+            raise util.WmsError('LayerNotDefined', f'Layer "{self.name}" needs a path, such as /WMS/<path>/')
+
+        return self.partitions.use(path)
+
+    def _cmap(self, style_name):
+        return self.styles.get(style_name) or next(iter(self.styles.values()))
+
+    def legend(self, path, legend, categories=None):
+        pal = self._cmap(legend)
+        with self._data(path) as data:
+            if data.categories is not None:
+                ckey = self._color_key(data, pal, [c for c in categories if c in data.values] if categories else None)
+
+                return util.categorical_legend(list(ckey), list(ckey.values()))
+
+        return util.linear_legend(resample(pal, 128))
+
+    @staticmethod
+    def _color_key(data, pal, categories=None):
+        """The colors of the categories (by default, the most common categories).
+
+        The most common categories always have the same colors;
+        the others have the colors after them in the palette.
+        """
+
+        n = len(data.categories)
+        colors = resample(pal, n) if len(pal)<n else pal[:n]
+        ckey = dict(zip(data.categories, colors))
+        if categories is None:
+            return ckey
+
+        others = [v for v in data.values if v not in ckey]
+
+        return {c:ckey[c] if c in ckey else pal[(n+others.index(c)) % len(pal)] for c in categories}
+
+    def _request_categories(self, data, request):
+        """The categories chosen by the request's CATEGORIES parameter, or None."""
+
+        categories = util.request_categories(request)
+        if not categories or data.categories is None:
+            return None
+
+        unknown = [c for c in categories if c not in data.values]
+        if unknown:
+            raise util.WmsError(None, f'Layer "{self.name}" has no categories {unknown}')
+
+        return categories
+
+    def _aggregate_categories(self, data, w, h, bbox, categories):
+        """Return the aggregate of some of the categories in a tile, or None if it's empty.
+
+        Only the partitions of the categories are read, so subsets are rendered in full rather than as drafts.
+        """
+
+        if data.points.count(bbox)==0:
+            return None
+
+        west, south, east, north = bbox
+        cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=(west, east), y_range=(south, north))
+        with util.metrics.time(f'layer_{self.name}_aggregate'):
+            agg = data.points.aggregate_values(cvs, categories, CATEGORY)
+
+        return None if is_empty(agg) else agg
+
+    def _aggregate_draft(self, data, cvs):
+        """Estimate the aggregate from the weighted sample."""
+
+        x, y = self.spec['x'], self.spec['y']
+        column = self.spec.get('column')
+        frames = [data.sample]
+        if self.reduction=='count':
+            return aggregate(cvs, frames, x, y, ds.sum(WEIGHT))
+        elif self.reduction=='count_cat':
+            agg = aggregate(cvs, frames, x, y, ds.by(CATEGORY, ds.sum(WEIGHT)))
+
+            return agg.isel({CATEGORY: slice(0, -1)}).fillna(0)
+        elif self.reduction=='sum':
+            return aggregate(cvs, frames, x, y, ds.sum(WEIGHTED))
+        elif self.reduction=='max':
+            return aggregate(cvs, frames, x, y, ds.max(column))
+        else:
+            parts = aggregate(cvs, frames, x, y, ds.summary(total=ds.sum(WEIGHTED), n=ds.sum(WEIGHT)))
+
+            return parts['total'].where(parts['n']>0) / parts['n']
+
+    def _draft(self, data, n):
+        """Should a tile with (at most) n points be drawn from the sample?"""
+
+        if data.sample is None:
+            return False
+
+        mode = util.render_mode()
+        if mode=='draft':
+            return True
+        if mode=='full' or self._rate is None:
+            return False
+
+        return n/self._rate*1000>self.spec['time_budget_ms']
+
+    def _aggregate(self, data, cvs):
+        column = self.spec.get('column')
+        if self.reduction=='count':
+            return data.points.aggregate(cvs, ds.count())
+        elif self.reduction=='count_cat':
+            agg = data.points.aggregate(cvs, ds.count_cat(CATEGORY))
+
+            return agg.isel({CATEGORY: slice(0, -1)})
+        elif self.reduction=='sum':
+            return data.points.aggregate(cvs, ds.sum(column))
+        elif self.reduction=='max':
+            return data.points.aggregate(cvs, ds.max(column))
+        else:
+            # Sums and counts can be combined across chunks; means can't.
+            #
+            parts = data.points.aggregate(cvs, ds.summary(total=ds.sum(column), n=ds.count(column)))
+
+            return parts['total'].where(parts['n']>0) / parts['n']
+
+    def render(self, request, w, h, bbox, path, layer_name, style_name):
+        with self._data(path) as data:
+            agg = self._aggregate_request(request, data, w, h, bbox)
+
+            return None if agg is None else self._shade(data, agg, bbox, style_name)
+
+    def aggregate(self, request, w, h, bbox, path, layer_name):
+        with self._data(path) as data:
+            return self._aggregate_request(request, data, w, h, bbox)
+
+    def _aggregate_request(self, request, data, w, h, bbox):
+        categories = self._request_categories(data, request)
+        if categories:
+            return self._aggregate_categories(data, w, h, bbox, categories)
+
+        return self._aggregate_tile(data, w, h, bbox)
+
+    def empty_aggregate(self, request, w, h, path, layer_name):
+        """The aggregate of a tile with nothing in it, with the dtype and categories of the layer's aggregates."""
+
+        if self.reduction=='count_cat':
+            with self._data(path) as data:
+                categories = self._request_categories(data, request) or list(data.categories)
+
+            return empty_aggregate(w, h, categories=categories)
+
+        return empty_aggregate(w, h, self._dtype(path))
+
+    def _dtype(self, path):
+        """The dtype of the layer's (non-categorical) aggregates."""
+
+        return 'uint32' if self.reduction=='count' else 'float64'
+
+    def shade(self, request, agg, bbox, path, layer_name, style_name):
+        if is_empty(agg):
+            return None
+
+        with self._data(path) as data:
+            return self._shade(data, agg, bbox, style_name)
+
+    def _aggregate_tile(self, data, w, h, bbox):
+        """Return the aggregate of a tile, or None if it's empty."""
+
+        n = data.points.count(bbox)
+        if n==0:
+            return None
+
+        west, south, east, north = bbox
+        cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=(west, east), y_range=(south, north))
+        if self._draft(data, n):
+            util.mark_draft()
+            util.metrics.inc(f'layer_{self.name}_draft')
+            agg = self._aggregate_draft(data, cvs)
+        else:
+            t0 = time.perf_counter()
+            with util.metrics.time(f'layer_{self.name}_aggregate'):
+                agg = self._aggregate(data, cvs)
+
+            # Learn how many points per second this layer aggregates, to decide when to draw drafts.
+            #
+            rate = n / max(time.perf_counter()-t0, 1e-6)
+            self._rate = rate if self._rate is None else (1-RATE_SMOOTHING)*self._rate + RATE_SMOOTHING*rate
+
+        return None if is_empty(agg) else agg
+
+    def _shade(self, data, agg, bbox, style_name):
+        spec = self.spec
+        pal = self._cmap(style_name)
+        with util.metrics.time(f'layer_{self.name}_shade'):
+            if data.categories is not None:
+                ckey = self._color_key(data, pal, list(agg.coords[CATEGORY].values))
+                if data.lut:
+                    img = data.lut.shade_cat(agg, ckey, bbox)
+                else:
+                    img = tf.shade(agg, color_key=ckey, how=spec.get('how', 'eq_hist'))
+            elif data.lut:
+                img = data.lut.shade(agg, pal, bbox)
+            else:
+                img = tf.shade(agg, cmap=pal, how=spec.get('how', 'eq_hist'))
+
+            spread = spec.get('spread', 4)
+            if spread:
+                img = dynspread(img, shape=spec.get('spread_shape', 'circle'), threshold=spec.get('spread_threshold', 0.5), max_px=spread)
+
+        return img.to_pil()
+
+    def feature_info(self, request, x, y, rx, ry, path, layer_name, feature_count):
+        with self._data(path) as data:
+            df = data.points.nearest(x, y, rx, ry)
+            categories = self._request_categories(data, request)
+            if categories:
+                df = df[df[self.spec['column']].isin(categories)]
+            elif data.categories is not None:
+                df = df[df[CATEGORY]!=OTHER]
+            df = df.head(feature_count)
+
+        x, y = self.spec['x'], self.spec['y']
+        info = self.spec['info']
+
+        return [
+            (row[0], row[1], {k:_json_value(v) for k,v in zip(info, row[2:])})
+            for row in df[[x, y]+info].itertuples(index=False)
+        ]
+
+class TrackData:
+    """One loaded version of the tracks of a TrackLayer."""
+
+    def __init__(self, fnam, spec, read=None):
+        x, y, track, time = spec['x'], spec['y'], spec['track'], spec['time']
+        info = spec.get('info', [])
+        columns = list(dict.fromkeys([x, y, track, time] + info))
+
+        df = (read or _read_parquet)(fnam, columns)
+        self.tracks = TrackSet(df, x, y, track, time, max_gap=spec.get('max_gap'))
+        self.bounds = self.tracks.bounds
+        self.categories = None
+
+        # GetFeatureInfo finds the nearest point, so the points are only kept if the layer is queryable.
+        #
+        self.points = PointSet(df, x, y) if info else None
+        self.points_nbytes = util.sizeof(df) if info else 0
+
+    @property
+    def nbytes(self):
+        return self.tracks.nbytes + self.points_nbytes
+
+    def frames(self):
+        return [self.tracks.lines]
+
+class TrackLayer(PointLayer):
+    """A layer of tracks defined by a [layers.NAME] table with type = "tracks".
+
+    The tracks are precomputed by a TrackSet when the data is loaded,
+    and each tile draws the tracks that intersect it with cvs.line().
+    Otherwise, the layer behaves as a PointLayer: it can be reloaded,
+    partitioned by the WMS path, cached, and queried.
+    """
+
+    def __init__(self, name, spec):
+        for key in ['track', 'time']:
+            if key not in spec:
+                raise ValueError(f'Layer "{name}": "{key}" is required for tracks')
+        if spec.get('reduction', 'count')!='count':
+            raise ValueError(f'Layer "{name}": the reduction of tracks must be "count"')
+
+        super().__init__(name, {'abstract': f'Tracks from {spec.get("file")}', 'spread': 0, **spec})
+
+    def _streams(self):
+        return False
+
+    def _dtype(self, path):
+        # Antialiased lines have fractional counts.
+        #
+        return 'float32' if self.spec.get('line_width', 0) else 'uint32'
+
+    def _load(self, fnam):
+        return TrackData(fnam, self.spec, self._read)
+
+    def _aggregate_tile(self, data, w, h, bbox):
+        lines = data.tracks.select(bbox)
+        if lines is None:
+            return None
+
+        spec = self.spec
+        west, south, east, north = bbox
+        cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=(west, east), y_range=(south, north))
+        line_width = spec.get('line_width', 0)
+        with util.metrics.time(f'layer_{self.name}_aggregate'):
+            if line_width:
+                agg = cvs.line(lines, spec['x'], spec['y'], agg=ds.count(), line_width=line_width)
+            else:
+                agg = cvs.line(lines, spec['x'], spec['y'], agg=ds.count())
+
+        return None if is_empty(agg) else agg
+
+    def _shade(self, data, agg, bbox, style_name):
+        spec = self.spec
+        with util.metrics.time(f'layer_{self.name}_shade'):
+            img = tf.shade(agg, cmap=self._cmap(style_name), how=spec.get('how', 'eq_hist'))
+            spread = spec.get('spread', 0)
+            if spread:
+                img = dynspread(img, shape=spec.get('spread_shape', 'circle'), threshold=spec.get('spread_threshold', 0.5), max_px=spread)
+
+        return img.to_pil()
+
+class VectorData:
+    """One loaded version of the shapes of a VectorLayer."""
+
+    def __init__(self, fnam, spec):
+        import geopandas
+
+        columns = list(dict.fromkeys(([spec['column']] if 'column' in spec else []) + spec.get('info', [])))
+        if fnam.endswith('.parquet'):
+            gdf = geopandas.read_parquet(fnam, columns=columns+['geometry'])
+        else:
+            gdf = geopandas.read_file(fnam, columns=columns)
+
+        if gdf.crs is not None and gdf.crs.to_epsg()!=4326:
+            gdf = gdf.to_crs(4326)
+        if not spec.get('fill', True):
+            gdf = gdf.set_geometry(gdf.boundary)
+
+        self.shapes = VectorSet(gdf, band=spec.get('band', 4), min_tolerance=spec.get('min_tolerance', 1e-5))
+        self.bounds = self.shapes.bounds
+        self.categories = None
+
+    @property
+    def nbytes(self):
+        return self.shapes.nbytes
+
+    def frames(self):
+        return [self.shapes.gdf]
+
+class VectorLayer(PointLayer):
+    """A layer of polygons or lines defined by a [layers.NAME] table with type = "vector".
+
+    The shapes are read from a shapefile (or any file geopandas can read, or a GeoParquet file),
+    and simplified for a series of zoom bands and indexed by a VectorSet when they are loaded.
+    Each tile draws the simplified features that intersect it with cvs.polygons()
+    or cvs.line(). Otherwise, the layer behaves as a PointLayer: it can be reloaded,
+    partitioned by the WMS path, cached, and queried.
+    """
+
+    def __init__(self, name, spec):
+        if spec.get('reduction', 'count')=='count_cat':
+            raise ValueError(f'Layer "{name}": the reduction of a vector layer can\'t be "count_cat"')
+
+        super().__init__(name, {'abstract': f'Shapes from {spec.get("file")}', 'spread': 0, 'how': 'linear', **spec})
+
+    def _streams(self):
+        return 'span' in self.spec and self.spec['how']!='eq_hist'
+
+    def _dtype(self, path):
+        if self.reduction!='count':
+            return 'float64'
+        if not self.spec.get('line_width', 0):
+            return 'uint32'
+
+        # Polygons are filled, but antialiased lines have fractional counts.
+        #
+        with self._data(path) as data:
+            return 'float32' if data.shapes.kind=='lines' else 'uint32'
+
+    def _load(self, fnam):
+        return VectorData(fnam, self.spec)
+
+    def _reduction(self):
+        column = self.spec.get('column')
+        if self.reduction=='count':
+            return ds.count()
+        elif self.reduction=='sum':
+            return ds.sum(column)
+        elif self.reduction=='max':
+            return ds.max(column)
+        else:
+            return ds.mean(column)
+
+    def _aggregate_tile(self, data, w, h, bbox):
+        west, south, east, north = bbox
+        cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=(west, east), y_range=(south, north))
+        with util.metrics.time(f'layer_{self.name}_aggregate'):
+            agg = data.shapes.aggregate(cvs, self._reduction(), line_width=self.spec.get('line_width', 0))
+
+        return None if agg is None or is_empty(agg) else agg
+
+    def _shade(self, data, agg, bbox, style_name):
+        spec = self.spec
+
+        # Most pixels of a count of shapes are 1 (or 0), which would have the first color of the colormap.
+        #
+        span = spec.get('span')
+        if span is None and self.reduction=='count':
+            span = 0, max(1, int(agg.data.max()))
+
+        with util.metrics.time(f'layer_{self.name}_shade'):
+            img = tf.shade(agg, cmap=self._cmap(style_name), how=spec['how'], span=span)
+            spread = spec['spread']
+            if spread:
+                img = dynspread(img, shape=spec.get('spread_shape', 'circle'), threshold=spec.get('spread_threshold', 0.5), max_px=spread)
+
+        return img.to_pil()
+
+    def feature_info(self, request, x, y, rx, ry, path, layer_name, feature_count):
+        with self._data(path) as data:
+            gdf, xs, ys = data.shapes.nearest(x, y, rx, ry, feature_count)
+
+        info = self.spec['info']
+
+        return [
+            (px, py, {k:_json_value(v) for k,v in zip(info, row)})
+            for px,py,row in zip(xs, ys, gdf[info].itertuples(index=False))
+        ]
+
+LAYER_TYPES = {'points': PointLayer, 'tracks': TrackLayer, 'vector': VectorLayer}
+
+def _json_value(v):
+    if hasattr(v, 'isoformat'):
+        return v.isoformat()
+    if isinstance(v, np.generic):
+        return v.item()
+
+    return v
+
+def point_layers(config):
+    """Create the layers defined in the [layers] section of config.toml."""
+
+    layers = []
+    for name,spec in config.get('layers', {}).items():
+        layer_type = spec.get('type', 'points')
+        if layer_type not in LAYER_TYPES:
+            raise ValueError(f'Layer "{name}": type must be one of {list(LAYER_TYPES)}')
+        layers.append(LAYER_TYPES[layer_type](name, {k:v for k,v in spec.items() if k!='type'}))
+
+    return layers
@@ -1,35 +1,244 @@
+from io import BytesIO
+import threading
+
 import pandas as pd
-from util import wms, categorical_legend, linear_legend, LayerNode
+from litestar import Litestar, Response, post
+
+from util import wms, categorical_legend, linear_legend, LayerNode, tile_cache, DatasetHandle, dataset_handles, registry, request_categories, WmsError
 
 import datashader as ds
 from datashader import transfer_functions as tf
 from datashader.colors import inferno, Hot, viridis
 from colorcet import fire, bmw, glasbey
 
+from dsutil import EqHistLut, PointSet, dynspread, is_empty, union_bounds
+
 LON = 'LON'
 LAT = 'LAT'
 TYPE = 'TYPE'
+TS = 'TS'
+
+FNAM = 'D:/data/AIS/March2024.parquet'
+
+# The category layer shows the ten most common types. Rather than copying the rows
+# with those types, add a categorical column (one byte per row) where the other types
+# are in the last category, OTHER, which is dropped from the aggregate.
+#
+# A request can instead choose any types with the CATEGORIES vendor parameter.
+# The points are sorted by type, so each type is a slice of the DataFrame,
+# and only the slices of the chosen types are aggregated.
+#
+TOP10 = 'TOP10'
+OTHER = '(other)'
 
 class AIS:
-    def __init__(self):
-        self.df = pd.read_parquet('D:/data/AIS/March2024.parquet', columns=[LON, LAT, TYPE])
+    def __init__(self, fnam=FNAM, *, global_shading=True):
+        self.df = pd.read_parquet(fnam, columns=[LON, LAT, TYPE, TS])
         print(f'@shape {self.df.shape=}')
 
-        df_counts = self.df.groupby(TYPE, as_index=False).size().sort_values(by='size', ascending=False).reset_index().head(10)
-        self.top10_df = self.df[self.df[TYPE].isin(df_counts[TYPE])].copy()
-        self.top10_df[TYPE] = self.top10_df[TYPE].astype('category')
-        self.top10_cats = list(self.top10_df[TYPE].cat.categories)
+        self.type_counts = self.df[TYPE].value_counts()
+        self._set_categories(self._top_types())
+        self.df[TOP10] = self._top10(self.df[TYPE])
+
+        print(f'@cats {self.top10_cats=}')
+
+        # The points are held in a PointSet, which indexes the points (so GetFeatureInfo
+        # doesn't have to scan the DataFrame), allows new points to be appended,
+        # and partitions the points by type.
+        #
+        self.points = PointSet(self.df, LON, LAT, partition=TYPE)
+        self.df = self.points.frames()[0]
+        self.minx, self.miny, self.maxx, self.maxy = self.points.bounds
+
+        # Shade using a histogram precomputed over the whole dataset (per zoom level),
+        # rather than equalising each tile separately.
+        #
+        self.total_lut = None
+        self.cat_lut = None
+        if global_shading:
+            bounds = self.minx, self.miny, self.maxx, self.maxy
+            self.total_lut = EqHistLut(self.df, LON, LAT, bounds)
+            self.cat_lut = self._cat_lut(self.df)
+
+        # The number of appended batches (see append()) this version holds.
+        #
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def _top_types(self):
+        """The ten most common types, in alphabetical order."""
+
+        return sorted(self.type_counts.sort_values(ascending=False).head(10).index)
+
+    def _set_categories(self, cats):
+        self.top10_cats = cats
         self.pal = glasbey[:len(self.top10_cats)]
         self.ckey = {k:v for k,v in zip(self.top10_cats, self.pal)}
 
-        print(f'@shape {self.top10_df.shape=}')
-        print(f'@cats {self.top10_cats=}')
+    def types(self):
+        """All of the types, sorted."""
+
+        return self.points.values()
+
+    def subset_key(self, cats):
+        """The colors of some of the types. The top 10 types keep their colors,
+        and the other types have the colors after them in the palette.
+        """
+
+        others = [t for t in self.types() if t not in self.ckey]
+
+        return {c:self.ckey[c] if c in self.ckey else glasbey[len(self.ckey)+others.index(c)] for c in cats}
+
+    def _top10(self, types, cats=None):
+        """Return the TOP10 column for a TYPE column (with the current top 10 types, or cats)."""
+
+        cats = self.top10_cats if cats is None else cats
+
+        return pd.Categorical(types.where(types.isin(cats), OTHER), categories=cats+[OTHER])
+
+    def _cat_lut(self, df):
+        bounds = self.minx, self.miny, self.maxx, self.maxy
+
+        return EqHistLut(df, LON, LAT, bounds, agg=ds.count_cat(TOP10), categories=self.top10_cats)
+
+    def append(self, df):
+        """Add a batch of new points.
+
+        The bounds, categories, and shading aggregates are updated incrementally.
+        Returns the bounds of the new points, and whether the top 10 categories changed.
+        """
+
+        df = df[[LON, LAT, TYPE, TS]].copy()
+        with self._lock:
+            self.type_counts = self.type_counts.add(df[TYPE].value_counts(), fill_value=0)
+            cats = self._top_types()
+            cats_changed = cats!=self.top10_cats
+            if cats_changed:
+                # Recode the existing points. Renders may be reading the chunks,
+                # so they are replaced rather than changed.
+                #
+                self.points.assign(**{TOP10: lambda chunk: self._top10(chunk[TYPE], cats)})
+                self._set_categories(cats)
+
+            df[TOP10] = self._top10(df[TYPE])
+            extent = self.points.append(df)
+            self.minx, self.miny, self.maxx, self.maxy = self.points.bounds
+            if self.total_lut:
+                self.total_lut.update(df)
+            if self.cat_lut:
+                if cats_changed:
+                    self.cat_lut = self._cat_lut(self.points.frames())
+                else:
+                    self.cat_lut.update(df)
+            self.batches += 1
+
+        return extent, cats_changed
+
+    def features(self, df):
+        """Return GetFeatureInfo features for the rows of df."""
+
+        return [(x, y, {TYPE: t, TS: ts.isoformat()}) for x,y,t,ts in zip(df[LON], df[LAT], df[TYPE], df[TS])]
+
+LAYER_NAMES = ['total_ais', 'category_ais']
+
+# The batches appended while the server is running aren't in the file, so a new version
+# of the dataset (a reload, or the file changing) would lose them. They are kept here
+# (as well as in the PointSet they were appended to), and each version is caught up
+# with them: the load replays them, and the swap and append() replay any that were
+# appended to the previous version in the meantime. They are discarded when the server restarts.
+#
+_appended = []
+_append_lock = threading.Lock()
+
+def _catch_up(ais):
+    """Append the batches that ais doesn't have yet.
+
+    Returns the bounds of their points (or None), and whether the top 10 categories changed.
+    """
+
+    extent, cats_changed = None, False
+    for df in _appended[ais.batches:]:
+        e, changed = ais.append(df)
+        extent = e if extent is None else union_bounds(extent, e)
+        cats_changed = cats_changed or changed
 
-        self.minx, self.miny = self.df[['LON', 'LAT']].min()
-        self.maxx, self.maxy = self.df[['LON', 'LAT']].max()
+    return extent, cats_changed
 
-ais = AIS()
-print(f'@AIS XY {ais.minx=} {ais.miny=} {ais.maxx=} {ais.maxy=}')
+def _load(fnam):
+    ais = AIS(fnam)
+    _catch_up(ais)
+
+    return ais
+
+def _swapped(ais):
+    """A new version of the dataset has been loaded."""
+
+    # Batches appended to the previous version while this one was loading.
+    #
+    with _append_lock:
+        _catch_up(ais)
+
+    for name in LAYER_NAMES:
+        wms.update_layer(name, minx=ais.minx, miny=ais.miny, maxx=ais.maxx, maxy=ais.maxy)
+    tile_cache.invalidate(LAYER_NAMES, generation=dataset_handles['ais'].fingerprint)
+    registry.register('ais', ais.points.frames)
+    print(f'@AIS XY {ais.points.bounds=}')
+
+# Layer functions must use dataset.current once per request
+# so the dataset can be replaced while the server is running.
+#
+# The dataset is loaded in the background, so the layers are registered (with the
+# whole world as their bounds) straight away; _swapped() sets their bounds once it has loaded.
+#
+dataset = DatasetHandle('ais', _load, FNAM, on_swap=_swapped, background=True)
+
+def append(df):
+    """Add a batch of new points to the AIS layers.
+
+    The layer bounding boxes are updated, and only the cached images that
+    intersect the new points are invalidated, unless the layer is shaded with a global
+    histogram: the new points change the histogram, and so the colors of every image.
+    (If the top 10 categories change, all cached category_ais images are invalidated.)
+
+    The batch is kept, so that it is replayed into a new version of the dataset.
+
+    Returns the number of invalidated images.
+    """
+
+    df = df[[LON, LAT, TYPE, TS]]
+    with _append_lock:
+        ais = dataset.current
+        _appended.append(df)
+        extent, cats_changed = _catch_up(ais)
+
+    for name in LAYER_NAMES:
+        wms.update_layer(name, minx=ais.minx, miny=ais.miny, maxx=ais.maxx, maxy=ais.maxy)
+
+    n = tile_cache.invalidate(['total_ais'], None if ais.total_lut else extent)
+    n += tile_cache.invalidate(['category_ais'], None if ais.cat_lut or cats_changed else extent)
+    print(f'@AIS append {len(df)=} {extent=} {cats_changed=} invalidated={n}')
+
+    return n
+
+@post('/ais/append', sync_to_thread=True)
+def append_handler(body: bytes) -> Response:
+    """Append the points in the parquet file in the request body to the AIS layers.
+
+    Until the dataset has loaded, the response is 503 (Service Unavailable).
+    """
+
+    df = pd.read_parquet(BytesIO(body), columns=[LON, LAT, TYPE, TS])
+    try:
+        n = append(df)
+    except WmsError as e:
+        return Response(e.message, status_code=503, media_type='text/plain', headers={'Retry-After': '10'})
+
+    return Response({'appended': len(df), 'total': len(dataset.current.points), 'invalidated': n})
+
+def register(app: Litestar):
+    """Allow Litestar to register handlers."""
+
+    app.register(append_handler)
 
 @wms.style('nyc_bmw')
 def legend_bmy(path, legend):
@@ -42,53 +251,108 @@ def legend_fire(path, legend):
 @wms.layer(
     'total_ais',
     title='AIS Counts',
-    minx=ais.minx,
-    maxx=ais.maxx,
-    miny=ais.miny,
-    maxy=ais.maxy,
     priority=2,
-    style='nyc_fire'
+    style='nyc_fire',
+    cache=True
 )
 def _total_ais(request, w, h, bbox, path, layer_name, style_name):
+    ais = dataset.current
+
+    # Much of the map is open ocean: if the index says there are no points, don't aggregate.
+    #
+    if ais.points.count(bbox)==0:
+        return None
+
     west, south, east, north = bbox
     x_range = west, east
     y_range = south, north
     cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=x_range, y_range=y_range)
-    agg = cvs.points(ais.df, LON, LAT, ds.count())
+    agg = ais.points.aggregate(cvs, ds.count())
+    if is_empty(agg):
+        return None
+
     # cmap = bmw if style_name=='nyc_bmw' else fire
     cmap = fire
-    img = tf.shade(agg, cmap=cmap, how='eq_hist')
-    img = tf.dynspread(img, shape='circle', threshold=0.3, max_px=4)
+    if ais.total_lut:
+        img = ais.total_lut.shade(agg, cmap, bbox)
+    else:
+        img = tf.shade(agg, cmap=cmap, how='eq_hist')
+    img = dynspread(img, shape='circle', threshold=0.3, max_px=4)
 
     return img.to_pil()
 
-@wms.style('cat_ais')
-def cat_legend(path, legend):
+@wms.feature_info('total_ais')
+def _total_ais_info(request, x, y, rx, ry, path, layer_name, feature_count):
+    ais = dataset.current
+
+    return ais.features(ais.points.nearest(x, y, rx, ry, feature_count))
+
+@wms.style('cat_ais', categories=True)
+def cat_legend(path, legend, categories=None):
+    ais = dataset.current
+    if categories:
+        ckey = ais.subset_key([c for c in categories if c in ais.types()])
+
+        return categorical_legend(list(ckey), list(ckey.values()))
+
     return categorical_legend(ais.top10_cats, ais.pal)
 
+def _categories(ais, request):
+    """The types chosen by the request's CATEGORIES parameter, or None."""
+
+    cats = request_categories(request)
+    if cats:
+        unknown = [c for c in cats if c not in ais.types()]
+        if unknown:
+            raise WmsError(None, f'Unknown categories: {unknown}')
+
+    return cats
+
 @wms.layer(
     'category_ais',
     title='AIS Categories',
-    minx=ais.minx,
-    maxx=ais.maxx,
-    miny=ais.miny,
-    maxy=ais.maxy,
     priority=3,
-    style='cat_ais'
+    style='cat_ais',
+    cache=True
 )
 def _category_ais(request, w, h, bbox, path, layer_name, style_name):
+    ais = dataset.current
+    if ais.points.count(bbox)==0:
+        return None
+
     west, south, east, north = bbox
     x_range = west, east
     y_range = south, north
     cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=x_range, y_range=y_range)
-    agg = cvs.points(ais.top10_df, LON, LAT,  ds.count_cat(TYPE))
-    # cmap = bmw if style_name=='nyc_bmw' else fire
-    cmap = ais.pal # bmw
-    img = tf.shade(agg, color_key=ais.ckey, how='eq_hist')
-    img = tf.dynspread(img, shape='circle', threshold=0.3, max_px=4)
+    cats = _categories(ais, request)
+    if cats:
+        agg = ais.points.aggregate_values(cvs, cats, TYPE)
+        ckey = ais.subset_key(cats)
+    else:
+        agg = ais.points.aggregate(cvs, ds.count_cat(TOP10))
+        agg = agg.isel({TOP10: slice(0, -1)})
+        ckey = ais.ckey
+    if is_empty(agg):
+        return None
+
+    if ais.cat_lut:
+        img = ais.cat_lut.shade_cat(agg, ckey, bbox)
+    else:
+        img = tf.shade(agg, color_key=ckey, how='eq_hist')
+    img = dynspread(img, shape='circle', threshold=0.3, max_px=4)
 
     return img.to_pil()
 
+@wms.feature_info('category_ais')
+def _category_ais_info(request, x, y, rx, ry, path, layer_name, feature_count):
+    ais = dataset.current
+
+    df = ais.points.nearest(x, y, rx, ry)
+    cats = _categories(ais, request)
+    df = df[df[TYPE].isin(cats)] if cats else df[df[TOP10]!=OTHER]
+
+    return ais.features(df.head(feature_count))
+
 @wms.layer_provider
 def _layers():
     total_ais_layer = LayerNode(name='total_ais')
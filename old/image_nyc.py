@@ -8,6 +8,7 @@ import seaborn as sns
 
 import util
 from util import wms
+from dsutil import EqHistLut, aggregate, dynspread, is_empty
 
 # Drop-offs are reddish.
 # Pickups are blueish-greenish.
@@ -21,12 +22,18 @@ PAL_PICKS = [tuple(int(c*255) for c in col)[:3] for col in sns.color_palette('vi
 
 FNAM = '/data/nyctaxi/yellow_tripdata_2015-01.parquet'
 
+PICKUP_DROPOFF = [['pickup', 'pickup_x', 'pickup_y'], ['dropoff', 'dropoff_x', 'dropoff_y']]
+
+# The total counts treat the pickups and dropoffs as one set of points with columns x and y.
+#
+util.registry.union('nyc_xy', 'nyc', [(xcol, ycol) for _,xcol,ycol in PICKUP_DROPOFF])
+
 class NycTaxiImages:
-    def __init__(self, *, fnam=FNAM, logger=None, **kwargs):
+    def __init__(self, *, fnam=FNAM, logger=None, global_shading=True, **kwargs):
         info = logger.info if logger else print
 
-        info(f'Loading {FNAM} ...')
-        self.df = pd.read_parquet(FNAM, columns=['passenger_count', 'pickup_x', 'pickup_y', 'dropoff_x', 'dropoff_y'])
+        info(f'Loading {fnam} ...')
+        self.df = pd.read_parquet(fnam, columns=['passenger_count', 'pickup_x', 'pickup_y', 'dropoff_x', 'dropoff_y'])
         # self.df = self.df.dropna(axis='index')
         info(f'Rows: {len(self.df):,}')
 
@@ -36,10 +43,45 @@ class NycTaxiImages:
         self.y1 = max(self.df.dropoff_y.max(), self.df.pickup_y.max())
         info(f'Bounding box: w={self.x0}, e={self.x1}, s={self.y0}, n={self.y1}')
 
-        self.df_count = self.df[['pickup_x', 'pickup_y']].append(self.df[['dropoff_x', 'dropoff_y']].rename(columns={'pickup_y':'pickup_y'}), ignore_index=True, sort=False)
-        self.df_count = self.df_count.rename(columns={'pickup_x':'x', 'pickup_y':'y'})
+        # Shade the total counts using a histogram precomputed over the whole dataset.
+        #
+        self.count_lut = EqHistLut(self.count_frames, 'x', 'y', (self.x0, self.y0, self.x1, self.y1)) if global_shading else None
+
+    @property
+    def count_frames(self):
+        """The pickups and dropoffs as one set of points (the nyc_xy view of this version's df).
+
+        The view is resolved each time it's used, as registry views are meant to be,
+        rather than when the dataset is loaded. The frames share the columns of df.
+        """
+
+        return util.registry.resolve('nyc_xy', frames=[self.df])
+
+def _layer_bounds(taxis):
+    """Return the (minx, miny, maxx, maxy) bounds of each layer."""
+
+    bounds = {name:(taxis.x0, taxis.y0, taxis.x1, taxis.y1) for name in ['total_counts', 'merged_layer']}
+    for lname,xcol,ycol in PICKUP_DROPOFF:
+        # Discover the bounding box for this xcol,ycol.
+        #
+        minx, miny = taxis.df[[xcol, ycol]].min()
+        maxx, maxy = taxis.df[[xcol, ycol]].max()
+        bounds[lname] = minx, miny, maxx, maxy
+
+    return bounds
+
+def _swapped(taxis):
+    """A new version of the dataset has been loaded."""
 
-taxis = NycTaxiImages()
+    for name,(minx, miny, maxx, maxy) in _layer_bounds(taxis).items():
+        wms.update_layer(name, minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+    util.registry.register('nyc', taxis.df)
+
+# Layer functions must use dataset.current once per request
+# so the dataset can be replaced while the server is running.
+#
+dataset = util.DatasetHandle('nyc', lambda fnam: NycTaxiImages(fnam=fnam), FNAM, on_swap=_swapped)
+util.registry.register('nyc', dataset.current.df)
 
 @wms.style('nyc_bmw')
 def legend_bmy(path, legend):
@@ -52,22 +94,28 @@ def legend_fire(path, legend):
 @wms.layer('total_counts',
         abstract='Shows total pickup/dropoff counts from the NYC taxi data.',
         title='Total counts',
-        minx = taxis.x0,
-        maxx = taxis.x1,
-        miny = taxis.y0,
-        maxy = taxis.y1,
+        minx = dataset.current.x0,
+        maxx = dataset.current.x1,
+        miny = dataset.current.y0,
+        maxy = dataset.current.y1,
         priority=2,
         style=['nyc_bmw', 'nyc_fire'])
 def _total_counts(request, w, h, bbox, path, layer_name, style_name):
+    taxis = dataset.current
     west, south, east, north = bbox
     x_range = west, east
     y_range = south, north
-    df = taxis.df_count
     cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=x_range, y_range=y_range)
-    agg = cvs.points(df, 'x', 'y',  ds.count())
+    agg = aggregate(cvs, taxis.count_frames, 'x', 'y', ds.count())
+    if is_empty(agg):
+        return None
+
     cmap = bmw if style_name=='nyc_bmw' else fire
-    img = tf.shade(agg, cmap=cmap, how='eq_hist')
-    img = tf.dynspread(img, threshold=0.3, max_px=4)
+    if taxis.count_lut:
+        img = taxis.count_lut.shade(agg, cmap, bbox)
+    else:
+        img = tf.shade(agg, cmap=cmap, how='eq_hist')
+    img = dynspread(img, threshold=0.3, max_px=4)
 
     return img.to_pil()
 
@@ -85,6 +133,7 @@ def _create_image90(request, w, h, bbox, path, layer_name, style_name):
         xcol, ycol = 'dropoff_x', 'dropoff_y'
         cmap = inferno
 
+    taxis = dataset.current
     west, south, east, north = bbox
     x_range = west, east
     y_range = south, north
@@ -92,7 +141,7 @@ def _create_image90(request, w, h, bbox, path, layer_name, style_name):
     cvs = ds.Canvas(plot_width=w, plot_height=h, x_range=x_range, y_range=y_range)
     agg = cvs.points(df, xcol, ycol, ds.count('passenger_count'))
     img = tf.shade(agg.where(agg>np.percentile(agg, 90)), cmap=cmap, how='eq_hist')
-    img = tf.dynspread(img, threshold=0.3, max_px=4)
+    img = dynspread(img, threshold=0.3, max_px=4)
 
     return img.to_pil()
 
@@ -105,12 +154,9 @@ def _register_passenger_counts():
     """
 
     lnames = []
-    for lname,xcol,ycol in [['pickup', 'pickup_x', 'pickup_y'], ['dropoff', 'dropoff_x', 'dropoff_y']]:
-
-        # Discover the bounding box for this xcol,ycol.
-        #
-        minx, miny = taxis.df[[xcol, ycol]].min()
-        maxx, maxy = taxis.df[[xcol, ycol]].max()
+    bounds = _layer_bounds(dataset.current)
+    for lname,xcol,ycol in PICKUP_DROPOFF:
+        minx, miny, maxx, maxy = bounds[lname]
 
         # Now we can manually pass the unique function to the layer decorator.
         #
@@ -121,7 +167,8 @@ def _register_passenger_counts():
             miny=miny,
             maxx=maxx,
             maxy=maxy,
-            priority=10+len(lnames)
+            priority=10+len(lnames),
+            stream=False
         )(_create_image90)
         lnames.append(lname)
 
@@ -133,14 +180,16 @@ print(f'LNAMES: {_lnames}')
 @wms.layer('merged_layer',
         abstract='Shows pickups vs dropoffs.',
         title='Pickup / dropoff passenger counts',
-        minx = taxis.x0,
-        maxx = taxis.x1,
-        miny = taxis.y0,
-        maxy = taxis.y1,
-        priority=5)
+        minx = dataset.current.x0,
+        maxx = dataset.current.x1,
+        miny = dataset.current.y0,
+        maxy = dataset.current.y1,
+        priority=5,
+        stream=False)
 def _merged_images(request, w, h, bbox, path, layer_name, style_name):
     """Show the places with more dropoffs than pickups, and vice versa."""
 
+    taxis = dataset.current
     west, south, east, north = bbox
     x_range = west, east
     y_range = south, north
@@ -157,7 +206,7 @@ def _merged_images(request, w, h, bbox, path, layer_name, style_name):
     more_drops = tf.shade(drops.where(drops > picks), cmap=PAL_DROPS, how='log')
 
     img = tf.stack(more_picks, more_drops)
-    img = tf.dynspread(img, threshold=0.3, max_px=4)
+    img = dynspread(img, threshold=0.3, max_px=4)
 
     return img.to_pil()
 
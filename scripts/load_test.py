@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import httpx
+
+# End-to-end load test of the WMS server.
+#
+# Simulates QGIS-like sessions over HTTP, so the measurements include the
+# event loop, the render scheduler, PNG encoding, and the tile cache, rather
+# than just the layer functions. Each session fetches the capabilities and
+# the legends of a layer, then pans and zooms around the layer, requesting
+# the tiles of each view as a parallel burst.
+#
+# The sessions are run at one or more concurrency levels (the number of
+# sessions running at once), and the throughput, latency percentiles,
+# error rates, and server memory (from /metrics) are reported for each level.
+#
+# The levels are run one after the other against the same server, so later
+# levels may find some tiles in the tile cache; layers registered without
+# cache=True are always rendered.
+#
+# The request shapes can be recorded to a JSON lines file and replayed later,
+# so different versions of the server can be compared on the same requests.
+#
+# Start a server, record 20 sessions, and run them at three concurrency levels:
+#
+# python scripts/load_test.py --serve --sessions 20 --concurrency 1,4,16 --record sessions.jsonl
+#
+# Replay the sessions against a server that is already running:
+#
+# python scripts/load_test.py --url http://localhost:8000 --replay sessions.jsonl --concurrency 8
+#
+
+NS = {'wms': 'http://www.opengis.net/wms', 'xlink': 'http://www.w3.org/1999/xlink'}
+
+TILE = 256
+
+def parse_capabilities(text):
+    """Return the named layers in a capabilities document as a list of dicts
+    with name, bounds (west, south, east, north), and styles.
+    """
+
+    root = ET.fromstring(text)
+    layers = []
+    for layer_el in root.iter(f'{{{NS["wms"]}}}Layer'):
+        name = layer_el.findtext('wms:Name', namespaces=NS)
+        bbox_el = layer_el.find('wms:EX_GeographicBoundingBox', NS)
+        if name is None or bbox_el is None:
+            continue
+
+        bounds = [float(bbox_el.findtext(f'wms:{tag}', namespaces=NS)) for tag in [
+            'westBoundLongitude', 'southBoundLatitude', 'eastBoundLongitude', 'northBoundLatitude'
+        ]]
+        styles = [
+            (style_el.findtext('wms:Name', namespaces=NS), style_el.find('wms:LegendURL/wms:OnlineResource', NS))
+            for style_el in layer_el.findall('wms:Style', NS)
+        ]
+        styles = [
+            (sname, httpx.URL(el.get(f'{{{NS["xlink"]}}}href')).path if el is not None else None)
+            for sname,el in styles
+        ]
+        layers.append({'name': name, 'bounds': bounds, 'styles': styles})
+
+    return layers
+
+def view_tiles(view, viewport):
+    """Split a (west, south, east, north) view into TILE x TILE pixel tiles."""
+
+    west, south, east, north = view
+    vw, vh = viewport
+    nx = -(-vw // TILE)
+    ny = -(-vh // TILE)
+    dx = (east-west) / vw * TILE
+    dy = (north-south) / vh * TILE
+
+    return [
+        [west+i*dx, north-(j+1)*dy, west+(i+1)*dx, north-j*dy]
+        for j in range(ny)
+        for i in range(nx)
+    ]
+
+def make_session(rng, session, layers, path, moves, viewport):
+    """Generate the requests of one session, as a list of steps.
+
+    Each step is a list of requests that are sent in parallel.
+    """
+
+    layer = rng.choice(layers)
+    style, _ = rng.choice(layer['styles']) if layer['styles'] else ('', None)
+
+    def req(step, kind, **kwargs):
+        return {'session': session, 'step': step, 'kind': kind, 'path': path, **kwargs}
+
+    steps = [[req(0, 'GetCapabilities')]]
+    legends = [req(1, 'legend', url=url) for _,url in layer['styles'] if url]
+    if legends:
+        steps.append(legends)
+
+    # Start with a view of the whole layer, with the viewport's aspect ratio.
+    #
+    west, south, east, north = layer['bounds']
+    vw, vh = viewport
+    cx, cy = (west+east)/2, (south+north)/2
+    half_w = max(east-west, (north-south) * vw/vh) / 2
+    for move in range(moves+1):
+        if move>0:
+            action = rng.choice(['pan', 'pan', 'zoom_in', 'zoom_out'])
+            if action=='pan':
+                angle = rng.uniform(0, 6.283)
+                dist = rng.uniform(0.25, 0.5) * half_w * 2
+                cx += dist * math.cos(angle)
+                cy += dist * math.sin(angle)
+            elif action=='zoom_in':
+                half_w /= 2
+            else:
+                half_w *= 2
+
+        half_h = half_w * vh/vw
+        view = cx-half_w, cy-half_h, cx+half_w, cy+half_h
+        step = len(steps)
+        steps.append([
+            req(step, 'GetMap', layers=layer['name'], styles=style, bbox=bbox, width=TILE, height=TILE)
+            for bbox in view_tiles(view, viewport)
+        ])
+
+    return steps
+
+def request_url(r):
+    """The URL path and query parameters of a recorded request."""
+
+    wms = f'/WMS/{r["path"]}/' if r['path'] else '/WMS/'
+    if r['kind']=='GetCapabilities':
+        return wms, {'SERVICE': 'WMS', 'REQUEST': 'GetCapabilities'}
+    elif r['kind']=='legend':
+        return r['url'], {}
+    else:
+        west, south, east, north = r['bbox']
+
+        # EPSG:4326 is latitude, longitude.
+        #
+        return wms, {
+            'SERVICE': 'WMS',
+            'VERSION': '1.3.0',
+            'REQUEST': 'GetMap',
+            'FORMAT': 'image/png',
+            'CRS': 'EPSG:4326',
+            'LAYERS': r['layers'],
+            'STYLES': r['styles'],
+            'BBOX': f'{south},{west},{north},{east}',
+            'WIDTH': r['width'],
+            'HEIGHT': r['height']
+        }
+
+async def send(client, r, results):
+    url, params = request_url(r)
+    t0 = time.perf_counter()
+    try:
+        resp = await client.get(url, params=params)
+        status = resp.status_code
+
+        # WMS exceptions are returned with status 200.
+        #
+        if status==200 and r['kind']=='GetMap' and 'xml' in resp.headers.get('content-type', ''):
+            status = 'exception'
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    results.append((r['kind'], status, time.perf_counter()-t0))
+
+async def run_session(client, steps, results, think):
+    for step in steps:
+        await asyncio.gather(*[send(client, r, results) for r in step])
+        if think:
+            await asyncio.sleep(think)
+
+async def sample_rss(client, samples, stop):
+    while not stop.is_set():
+        try:
+            rss = (await client.get('/metrics')).json().get('rss_bytes')
+            if rss is not None:
+                samples.append(rss)
+        except (httpx.HTTPError, ValueError):
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+
+    return values[min(len(values)-1, int(p/100 * len(values)))]
+
+async def run_level(url, sessions, concurrency, think, timeout):
+    """Run the sessions with at most concurrency sessions at once."""
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        results = []
+        samples = []
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(client, samples, stop))
+        sem = asyncio.Semaphore(concurrency)
+
+        async def limited(steps):
+            async with sem:
+                await run_session(client, steps, results, think)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[limited(steps) for steps in sessions])
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await sampler
+
+    latencies = [t*1000 for _,_,t in results]
+    getmap = [t*1000 for kind,_,t in results if kind=='GetMap']
+    errors = sum(1 for _,status,_ in results if status not in (200, 503))
+    rejected = sum(1 for _,status,_ in results if status==503)
+
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'seconds': elapsed,
+        'throughput': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'getmap_p50_ms': percentile(getmap, 50),
+        'getmap_p99_ms': percentile(getmap, 99),
+        'max_ms': max(latencies, default=float('nan')),
+        'errors': errors,
+        'error_rate': errors / max(1, len(results)),
+        'rejected': rejected,
+        'rss_max_mb': max(samples) / 2**20 if samples else None,
+        'rss_end_mb': samples[-1] / 2**20 if samples else None
+    }
+
+def read_sessions(fnam):
+    """Read recorded requests, grouped into sessions of steps."""
+
+    sessions = {}
+    with open(fnam) as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                sessions.setdefault(r['session'], {}).setdefault(r['step'], []).append(r)
+
+    return [[steps[k] for k in sorted(steps)] for _,steps in sorted(sessions.items())]
+
+def write_sessions(fnam, sessions):
+    with open(fnam, 'w') as f:
+        for steps in sessions:
+            for step in steps:
+                for r in step:
+                    f.write(json.dumps(r) + '\n')
+
+def wait_ready(url, timeout):
+    """Wait for the server to answer /ready with 200."""
+
+    t0 = time.perf_counter()
+    while time.perf_counter()-t0<timeout:
+        try:
+            if httpx.get(f'{url}/ready', timeout=5).status_code==200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+
+    raise RuntimeError(f'{url} was not ready after {timeout}s')
+
+def serve_in_process(port):
+    """Run the app with uvicorn in a background thread of this process."""
+
+    import uvicorn
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app
+
+    server = uvicorn.Server(uvicorn.Config(app.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate QGIS sessions against the WMS server and report throughput and latency.')
+    server = parser.add_mutually_exclusive_group(required=True)
+    server.add_argument('--url', help='URL of a running server, such as http://localhost:8000')
+    server.add_argument('--serve', action='store_true', help='Start the server with uvicorn in a subprocess (in the current directory, using its config.toml)')
+    server.add_argument('--in-process', action='store_true', help='Start the server with uvicorn in this process')
+    parser.add_argument('--port', type=int, default=8765, help='Port for --serve and --in-process')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of sessions to generate')
+    parser.add_argument('--moves', type=int, default=10, help='Pans and zooms per session')
+    parser.add_argument('--viewport', default='1024x768', help='Map canvas size, split into 256 pixel tiles')
+    parser.add_argument('--layers', default=None, help='Comma-separated layers to use (default: all layers)')
+    parser.add_argument('--path', default='', help='The WMS path to request')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma-separated numbers of concurrent sessions')
+    parser.add_argument('--think', type=float, default=0.0, help='Seconds between the steps of a session')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for generating sessions')
+    parser.add_argument('--record', default=None, help='Write the generated requests to this JSON lines file')
+    parser.add_argument('--replay', default=None, help='Replay the requests in this JSON lines file instead of generating sessions')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    proc = None
+    url = args.url
+    if args.serve:
+        url = f'http://127.0.0.1:{args.port}'
+        proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(args.port), '--log-level', 'warning'])
+    elif args.in_process:
+        url = f'http://127.0.0.1:{args.port}'
+        serve_in_process(args.port)
+    url = url.rstrip('/')
+
+    try:
+        wait_ready(url, 600)
+
+        if args.replay:
+            sessions = read_sessions(args.replay)
+        else:
+            layers = parse_capabilities(httpx.get(f'{url}/WMS/', params={'SERVICE': 'WMS', 'REQUEST': 'GetCapabilities'}, timeout=args.timeout).text)
+            if args.layers:
+                wanted = args.layers.split(',')
+                layers = [layer for layer in layers if layer['name'] in wanted]
+            if not layers:
+                raise SystemExit('No layers to request')
+
+            rng = random.Random(args.seed)
+            viewport = tuple(int(v) for v in args.viewport.split('x'))
+            sessions = [make_session(rng, i, layers, args.path, args.moves, viewport) for i in range(args.sessions)]
+
+        if args.record:
+            write_sessions(args.record, sessions)
+
+        n = sum(len(step) for steps in sessions for step in steps)
+        print(f'{len(sessions)} sessions, {n} requests per run')
+        print(f'{"conc":>5} {"reqs":>6} {"req/s":>8} {"p50ms":>8} {"p90ms":>8} {"p99ms":>8} {"maxms":>8} {"err%":>6} {"503s":>5} {"rssMB":>7}')
+        results = []
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            r = asyncio.run(run_level(url, sessions, concurrency, args.think, args.timeout))
+            results.append(r)
+            rss = f'{r["rss_max_mb"]:7.0f}' if r['rss_max_mb'] is not None else f'{"n/a":>7}'
+            print(f'{r["concurrency"]:5} {r["requests"]:6} {r["throughput"]:8.1f} {r["p50_ms"]:8.1f} {r["p90_ms"]:8.1f} {r["p99_ms"]:8.1f} {r["max_ms"]:8.1f} {r["error_rate"]*100:6.2f} {r["rejected"]:5} {rss}')
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import itertools
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+import fiona
+
+# Convert AIS point shapefiles to a parquet file for image_ais.py.
+#
+# This is the command line version of shape_to_parquet.ipynb.
+# Instead of reading the whole month into memory:
+#
+# - each input file is split into batches of features, and the batches are
+#   read and normalised in parallel worker processes;
+# - each batch is written to a temporary parquet file, sorted by a spatial
+#   (Morton / Z-order) key, with one row group per spatial bucket;
+# - the buckets are then merged one at a time into the output file,
+#   so the output is spatially sorted, and its row groups have tight
+#   LON / LAT min/max statistics.
+#
+# Memory is bounded by the batch size and the largest bucket.
+#
+# python scripts/shape_to_parquet.py March2024.shp -o March2024.parquet
+#
+
+LON = 'LON'
+LAT = 'LAT'
+TYPE = 'TYPE'
+TS = 'TS'
+
+# Spatial keys interleave 16 bits of x and y.
+#
+KEY_BITS = 16
+KEY = '_key'
+BUCKET = '_bucket'
+
+def short_type(t):
+    """Convert types such as 'Tanker - this', 'Tanker - that' to 'Tanker'."""
+
+    if t is None or t.startswith('unknown'):
+        return 'Other'
+    elif t.startswith('Towing'):
+        return 'Towing'
+    elif t.startswith('Local'):
+        return 'Local'
+    elif t:
+        return t.partition('-')[0].strip()
+    else:
+        return t
+
+def short_types(types):
+    """Vectorised short_type().
+
+    short_type() is called once per distinct type rather than once per row.
+    """
+
+    cat = pd.Categorical(types)
+    short = np.array([short_type(t) for t in cat.categories] + [short_type(None)], dtype=object)
+
+    # Missing values have code -1, which conveniently indexes short_type(None).
+    #
+    return pd.Categorical(short[cat.codes])
+
+def _spread_bits(v):
+    """Spread the low 16 bits of v so there is a zero bit between each bit."""
+
+    v = v.astype(np.uint32)
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+
+    return v
+
+def spatial_key(lon, lat, bounds):
+    """Return the Morton (Z-order) key of each point relative to the bounds."""
+
+    minx, miny, maxx, maxy = bounds
+    n = (1 << KEY_BITS) - 1
+    ix = np.clip(np.nan_to_num((lon-minx) / ((maxx-minx) or 1) * n), 0, n)
+    iy = np.clip(np.nan_to_num((lat-miny) / ((maxy-miny) or 1) * n), 0, n)
+
+    return _spread_bits(ix) | (_spread_bits(iy) << 1)
+
+def read_batch(fnam, start, stop, ts_field, type_field, extra):
+    """Read features [start, stop) of a shapefile into a DataFrame."""
+
+    ts, types, xs, ys = [], [], [], []
+    extras = {f:[] for f in extra}
+    with fiona.open(fnam) as src:
+        for _, feature in src.items(start, stop):
+            geom = feature.geometry
+            if geom is None:
+                continue
+
+            props = feature['properties']
+            x, y = geom.coordinates[:2]
+            ts.append(props[ts_field])
+            types.append(props[type_field])
+            xs.append(x)
+            ys.append(y)
+            for f in extra:
+                extras[f].append(props[f])
+
+    return pd.DataFrame({
+        TS: pd.to_datetime(pd.Series(ts, dtype=object), errors='coerce'),
+        TYPE: short_types(types),
+        LON: np.array(xs, dtype='f8'),
+        LAT: np.array(ys, dtype='f8'),
+        **extras
+    })
+
+def convert_batch(task):
+    """Worker: read a batch of features and write it as a temporary parquet file,
+    sorted by spatial key, with one row group per bucket.
+    """
+
+    fnam, start, stop, out, bounds, bucket_bits, ts_field, type_field, extra = task
+
+    df = read_batch(fnam, start, stop, ts_field, type_field, extra)
+    df[KEY] = spatial_key(df[LON].values, df[LAT].values, bounds)
+    df[BUCKET] = (df[KEY].values >> (2*KEY_BITS - bucket_bits)).astype(np.int32)
+    df = df.sort_values(KEY, kind='stable', ignore_index=True)
+
+    # TYPE is written as strings so the categories of different batches don't have to agree.
+    #
+    df[TYPE] = df[TYPE].astype(object)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    buckets = df[BUCKET].values
+    edges = np.flatnonzero(np.diff(buckets)) + 1
+    with pq.ParquetWriter(out, table.schema) as writer:
+        for a,b in zip(itertools.chain([0], edges), itertools.chain(edges, [len(df)])):
+            writer.write_table(table.slice(a, b-a))
+
+    return len(df)
+
+def plan(fnams, batch):
+    """Split the input files into batches of features.
+
+    Returns the batches as (fnam, start, stop), and the union of the bounds of the files.
+    """
+
+    batches = []
+    minx = miny = np.inf
+    maxx = maxy = -np.inf
+    for fnam in fnams:
+        with fiona.open(fnam) as src:
+            n = len(src)
+            x0, y0, x1, y1 = src.bounds
+        minx, miny, maxx, maxy = min(minx, x0), min(miny, y0), max(maxx, x1), max(maxy, y1)
+        print(f'{fnam}: {n:,} features, bounds {x0}, {y0}, {x1}, {y1}')
+
+        for start in range(0, n, batch):
+            batches.append((fnam, start, min(start+batch, n)))
+
+    return batches, (minx, miny, maxx, maxy)
+
+def merge(tmp, out, bucket_bits, row_group_size):
+    """Merge the temporary files into the output, one bucket at a time.
+
+    Small buckets are combined so the row groups have row_group_size rows.
+    """
+
+    dataset = pds.dataset(tmp, format='parquet')
+    writer = None
+    pending = []
+    rows = 0
+    try:
+        for bucket in range(1 << bucket_bits):
+            table = dataset.to_table(filter=pds.field(BUCKET)==bucket)
+            if table.num_rows==0:
+                continue
+
+            pending.append(table.sort_by(KEY).drop_columns([KEY, BUCKET]))
+            if sum(t.num_rows for t in pending)>=row_group_size:
+                table = pa.concat_tables(pending)
+                full = table.num_rows // row_group_size * row_group_size
+                if writer is None:
+                    writer = pq.ParquetWriter(out, table.schema, write_statistics=True, compression='zstd')
+                writer.write_table(table.slice(0, full), row_group_size=row_group_size)
+                pending = [table.slice(full)]
+                rows += full
+
+        if pending:
+            table = pa.concat_tables(pending)
+            if writer is None:
+                writer = pq.ParquetWriter(out, table.schema, write_statistics=True, compression='zstd')
+            writer.write_table(table, row_group_size=row_group_size)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert AIS point shapefiles to a spatially sorted parquet file.')
+    parser.add_argument('shp', nargs='+', help='Input shapefiles')
+    parser.add_argument('-o', '--output', required=True, help='Output parquet file')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--batch', type=int, default=1_000_000, help='Features read per batch')
+    parser.add_argument('--row-group', type=int, default=1_000_000, help='Maximum rows per output row group')
+    parser.add_argument('--bucket-bits', type=int, default=8, help='Bits of the spatial key used to bucket the merge')
+    parser.add_argument('--ts-field', default='TIMESTAMP', help='Timestamp property')
+    parser.add_argument('--type-field', default='TYPE', help='Vessel type property')
+    parser.add_argument('--extra', nargs='*', default=[], help='Further properties to copy unchanged')
+    parser.add_argument('--tmp', default=None, help='Directory for temporary files')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    batches, bounds = plan(args.shp, args.batch)
+    tmp = Path(tempfile.mkdtemp(prefix='shape_to_parquet_', dir=args.tmp))
+    try:
+        tasks = [
+            (fnam, start, stop, tmp / f'part-{i:06}.parquet', bounds, args.bucket_bits, args.ts_field, args.type_field, args.extra)
+            for i,(fnam,start,stop) in enumerate(batches)
+        ]
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            done = 0
+            for n in executor.map(convert_batch, tasks):
+                done += n
+                print(f'Read {done:,} points ({time.perf_counter()-t0:.1f}s)')
+
+        rows = merge(tmp, args.output, args.bucket_bits, args.row_group)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'Wrote {rows:,} rows to {args.output} ({time.perf_counter()-t0:.1f}s)')
+
+if __name__=='__main__':
+    main()
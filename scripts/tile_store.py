@@ -0,0 +1,96 @@
+import argparse
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import tilestore
+
+# A shared tile store served over HTTP.
+#
+# WMS servers on several hosts can share rendered tiles by listing one or more
+# of these in the [cache] shared setting of config.toml. Tiles are spread over
+# the stores by consistent hashing, so each tile is rendered once by the cluster
+# (see tilestore.py for the protocol).
+#
+# This is meant as a local stand-in for testing a cluster on one machine,
+# and for small deployments; the tiles are kept in a tilestore.FileTileStore.
+#
+# Start two stores:
+#
+# python scripts/tile_store.py --port 8801 --dir tiles1
+# python scripts/tile_store.py --port 8802 --dir tiles2
+#
+# and in config.toml:
+#
+# [cache]
+# shared = ["http://localhost:8801", "http://localhost:8802"]
+#
+
+def handler(store):
+    class Handler(BaseHTTPRequestHandler):
+        def _key(self, prefix):
+            if not self.path.startswith(prefix):
+                return None
+            h = self.path[len(prefix):]
+            digest = h[:-len(tilestore.PINNED)] if h.endswith(tilestore.PINNED) else h
+
+            return h if len(digest)>2 and all(c in '0123456789abcdef' for c in digest) else None
+
+        def _reply(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            h = self._key('/tiles/')
+            data = None if h is None else store.get(h)
+            if data is None:
+                self._reply(404)
+            else:
+                self._reply(200, data)
+
+        def do_PUT(self):
+            h = self._key('/tiles/')
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if h is None:
+                self._reply(404)
+            else:
+                store.put(h, data)
+                self._reply(204)
+
+        def do_POST(self):
+            h = self._key('/claims/')
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if h is None:
+                self._reply(404)
+            else:
+                self._reply(201 if store.claim(h) else 409)
+
+        def do_DELETE(self):
+            h = self._key('/claims/')
+            if h is None:
+                self._reply(404)
+            else:
+                store.release(h)
+                self._reply(204)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Serve a shared tile store over HTTP.')
+    parser.add_argument('--host', default='0.0.0.0', help='The address to listen on')
+    parser.add_argument('--port', type=int, default=8800, help='The port to listen on')
+    parser.add_argument('--dir', default='tiles', help='The directory to store tiles in')
+    parser.add_argument('--max-mb', type=float, default=1024, help='The maximum size of the stored tiles')
+    args = parser.parse_args()
+
+    store = tilestore.FileTileStore(args.dir, max_bytes=int(args.max_mb * 1024 * 1024))
+    server = ThreadingHTTPServer((args.host, args.port), handler(store))
+    print(f'Serving {store} on {args.host}:{args.port}')
+    server.serve_forever()
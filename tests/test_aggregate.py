@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import datashader as ds
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # util loads its templates from the app package, so import it first.
+import dsutil
+import util
+
+# Aggregating in row partitions (or chunks) and combining the partial grids
+# must give the same result as one pass over all of the points.
+#
+
+@pytest.fixture
+def partitioned(monkeypatch):
+    monkeypatch.setitem(util.config, 'render', {'aggregate_threads': 4, 'aggregate_min_rows': 10_000})
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    n = 100_000
+    df = pd.DataFrame({'x': rng.uniform(0, 1, n), 'y': rng.uniform(0, 1, n), 'v': rng.uniform(1, 2, n)})
+
+    # Sort by y, so most pixels only have points in one row partition.
+    #
+    return df.sort_values('y', ignore_index=True)
+
+def canvas():
+    return ds.Canvas(plot_width=200, plot_height=200, x_range=(0, 1), y_range=(0, 1))
+
+def assert_same(a, b):
+    np.testing.assert_array_equal(np.isnan(a), np.isnan(b))
+    np.testing.assert_allclose(np.nan_to_num(a), np.nan_to_num(b))
+
+def test_sum(partitioned, points):
+    single = canvas().points(points, 'x', 'y', ds.sum('v'))
+    parts = dsutil.aggregate(canvas(), [points], 'x', 'y', ds.sum('v'))
+
+    assert_same(parts.data, single.data)
+
+def test_mean(partitioned, points):
+    agg = ds.summary(total=ds.sum('v'), n=ds.count('v'))
+    single = canvas().points(points, 'x', 'y', ds.mean('v'))
+    parts = dsutil.aggregate(canvas(), [points], 'x', 'y', agg)
+
+    assert_same((parts['total'].where(parts['n']>0) / parts['n']).data, single.data)
+
+def test_point_set_chunks(points):
+    ps = dsutil.PointSet(points.iloc[:50_000], 'x', 'y')
+    ps.append(points.iloc[50_000:])
+    single = canvas().points(points, 'x', 'y', ds.sum('v'))
+
+    assert_same(ps.aggregate(canvas(), ds.sum('v')).data, single.data)
+
+def test_combine_numpy():
+    a = np.array([1.0, np.nan, np.nan])
+    b = np.array([2.0, 3.0, np.nan])
+
+    assert_same(dsutil.combine(ds.sum('v'), a, b), np.array([3.0, 3.0, np.nan]))
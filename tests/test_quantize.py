@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import datashader as ds
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # util loads its templates from the app package, so import it first.
+import dsutil
+
+# Quantised coordinates decode to within a step of the originals, and aggregating them
+# gives the same grid as aggregating the float coordinates.
+#
+
+SCALE = 2.0 ** -10
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    n = 50_000
+
+    return pd.DataFrame({'x': rng.uniform(0, 1, n), 'y': rng.uniform(0, 1, n), 'v': rng.uniform(1, 2, n)})
+
+def test_encode_decode(points):
+    q = dsutil.Quantizer((0, 0, 1, 1), SCALE)
+    qx, qy = q.encode(points['x'].values, points['y'].values)
+    x, y = q.decode(qx, qy)
+
+    assert qx.dtype==np.uint16
+    assert np.all((points['x'].values-x>=0) & (points['x'].values-x<SCALE))
+    assert np.all((points['y'].values-y>=0) & (points['y'].values-y<SCALE))
+
+def test_dtype():
+    assert dsutil.Quantizer((0, 0, 1, 1), 1e-6).dtype==np.uint32
+    assert dsutil.Quantizer.for_bounds((0, 0, 360, 180), 1e-9) is None
+
+@pytest.mark.parametrize('agg', [ds.count(), ds.sum('v')])
+def test_aggregate(points, agg):
+    # The pixels are whole numbers of steps, so quantising doesn't move a point to another pixel.
+    #
+    q = dsutil.Quantizer((0, 0, 1, 1), SCALE)
+    qx, qy = q.encode(points['x'].values, points['y'].values)
+    quantised = points.assign(x=qx, y=qy)
+    cvs = ds.Canvas(plot_width=256, plot_height=128, x_range=(0, 1), y_range=(0, 1))
+
+    single = cvs.points(points, 'x', 'y', agg)
+    result = q.aggregate(cvs, [quantised], 'x', 'y', agg)
+
+    np.testing.assert_allclose(np.nan_to_num(result.data), np.nan_to_num(single.data))
+    np.testing.assert_allclose(result.coords['x'].values, single.coords['x'].values)
+    np.testing.assert_allclose(result.coords['y'].values, single.coords['y'].values)
+
+def test_point_set(points):
+    ps = dsutil.PointSet(points.iloc[:30_000], 'x', 'y', precision=1e-5)
+    ps.append(points.iloc[30_000:])
+    cvs = ds.Canvas(plot_width=64, plot_height=64, x_range=(0, 1), y_range=(0, 1))
+
+    assert all(df['x'].dtype==np.uint32 for df in ps.frames())
+    decoded = pd.concat(ps.frames(decode=True), ignore_index=True)
+    np.testing.assert_allclose(decoded['x'], points['x'], atol=1e-5)
+    assert ps.aggregate(cvs, ds.count()).data.sum()==len(points)
+    assert ps.aggregate(cvs, ds.sum('v')).data.sum()==pytest.approx(points['v'].sum())
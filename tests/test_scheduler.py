@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # util loads its templates from the app package, so import it first.
+import util
+
+# The render scheduler refuses renders beyond its workers and queue,
+# and drops renders that can't finish by their deadline.
+#
+
+def test_rejects_beyond_the_queue():
+    async def main():
+        scheduler = util.RenderScheduler(max_concurrent=2, max_queue=8, deadline=10)
+        results = await asyncio.gather(*[scheduler.run(time.sleep, 0.05) for _ in range(40)], return_exceptions=True)
+
+        return results, scheduler.status()
+
+    results, status = asyncio.run(main())
+
+    assert sum(isinstance(r, util.Overloaded) for r in results)==30
+    assert sum(r is None for r in results)==10
+    assert status['running']==0 and status['queued']==0
+
+def test_queued_render_misses_its_deadline():
+    release = threading.Event()
+    ran = []
+
+    async def main():
+        scheduler = util.RenderScheduler(max_concurrent=1, max_queue=4, deadline=0.2)
+        blocker = asyncio.ensure_future(scheduler.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+        try:
+            with pytest.raises(util.Overloaded):
+                await scheduler.run(ran.append, 1)
+        finally:
+            release.set()
+            await asyncio.gather(blocker, return_exceptions=True)
+
+    asyncio.run(main())
+
+    assert ran==[]
+
+def test_running_render_is_cancelled_at_its_deadline():
+    cancelled = threading.Event()
+
+    def render():
+        for _ in range(100):
+            time.sleep(0.01)
+            try:
+                util.check_cancelled()
+            except util.RenderCancelled:
+                cancelled.set()
+                raise
+
+    async def main():
+        scheduler = util.RenderScheduler(max_concurrent=1, max_queue=4, deadline=0.1)
+        with pytest.raises(util.Overloaded):
+            await scheduler.run(render)
+
+        # The worker is released when the render returns.
+        #
+        await asyncio.sleep(0.1)
+
+        return scheduler.status()
+
+    status = asyncio.run(main())
+
+    assert cancelled.is_set()
+    assert status['running']==0
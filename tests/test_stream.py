@@ -0,0 +1,78 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import datashader as ds
+from datashader import transfer_functions as tf
+from PIL import Image
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # util loads its templates from the app package, so import it first.
+import dsutil
+import util
+
+# An image streamed in strips (each rendered with a halo, and encoded by a PngStream)
+# must decode to the same pixels as the image rendered in one go.
+#
+
+WIDTH, HEIGHT = 300, 250
+BBOX = (0.0, 0.0, 3.0, 2.5)
+
+def points():
+    # Keep the points away from the pixel edges, so they fall in the same pixel
+    # of a strip as of the whole image, whatever the rounding of the strip's bounds.
+    #
+    rng = np.random.default_rng(0)
+    n = 20_000
+    px = rng.integers(0, WIDTH, n) + rng.uniform(0.2, 0.8, n)
+    py = rng.integers(0, HEIGHT//2, n) + rng.uniform(0.2, 0.8, n)
+
+    return pd.DataFrame({'x': px/100, 'y': py/100})
+
+def render(df, lut, width, height, bbox):
+    west, south, east, north = bbox
+    cvs = ds.Canvas(plot_width=width, plot_height=height, x_range=(west, east), y_range=(south, north))
+    agg = cvs.points(df, 'x', 'y', ds.count())
+    img = tf.spread(lut.shade(agg, dsutil.colormap('fire'), bbox), px=1)
+
+    return np.asarray(img.to_pil().convert('RGBA'))
+
+def stream(df, lut, rows):
+    png = util.PngStream(WIDTH, HEIGHT)
+    out = [png.header()]
+    for r0,r1,top,bottom,bbox in util.strips(WIDTH, HEIGHT, BBOX, rows):
+        img = render(df, lut, WIDTH, bottom-top, bbox)
+        out.append(png.rows(img[r0-top:r1-top].tobytes()))
+    out.append(png.finish())
+
+    return np.asarray(Image.open(io.BytesIO(b''.join(out))).convert('RGBA'))
+
+def test_strips_match_one_shot():
+    df = points()
+    lut = dsutil.EqHistLut(df, 'x', 'y', dsutil.data_bounds(df, 'x', 'y'))
+    whole = render(df, lut, WIDTH, HEIGHT, BBOX)
+
+    # The points only cover the southern half (spread by a pixel), so some strips are blank.
+    #
+    assert whole[:HEIGHT//2-1, :, 3].max()==0
+    for rows in (HEIGHT, 64, 37):
+        np.testing.assert_array_equal(stream(df, lut, rows), whole)
+
+def test_blank_rows():
+    png = util.PngStream(20, 10)
+    data = png.header() + png.blank(4) + png.blank(6) + png.finish()
+    img = Image.open(io.BytesIO(data))
+
+    assert img.size==(20, 10)
+    assert not np.asarray(img.convert('RGBA')).any()
+
+def test_finish_checks_the_rows():
+    png = util.PngStream(20, 10)
+    png.header()
+    png.blank(4)
+    with pytest.raises(ValueError):
+        png.finish()
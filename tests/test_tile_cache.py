@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # util loads its templates from the app package, so import it first.
+import util
+
+# Invalidating a layer drops its cached tiles, and the renders that were
+# in progress mustn't cache tiles from the old data afterwards.
+# The shared cache keeps its tiles when another process loads the same data.
+#
+
+def test_put_after_invalidate_is_dropped():
+    cache = util.TileCache()
+    version = cache.version(['a', 'b'])
+    cache.invalidate(['b'])
+
+    cache.put('stale', ['a', 'b'], (0, 0, 1, 1), b'tile', version=version)
+    cache.put('fresh', ['a', 'b'], (0, 0, 1, 1), b'tile', version=cache.version(['a', 'b']))
+
+    assert cache.get('stale') is None
+    assert cache.get('fresh')==b'tile'
+
+def test_other_layers_keep_their_version():
+    cache = util.TileCache()
+    version = cache.version(['a'])
+    cache.invalidate(['b'])
+    cache.put('tile', ['a'], (0, 0, 1, 1), b'tile', version=version)
+
+    assert cache.get('tile')==b'tile'
+
+def test_invalidate_bbox():
+    cache = util.TileCache()
+    cache.put('west', ['a'], (0, 0, 1, 1), b'west')
+    cache.put('east', ['a'], (10, 0, 11, 1), b'east')
+
+    assert cache.invalidate(['a'], (0.5, 0.5, 2, 2))==1
+    assert cache.get('west') is None
+    assert cache.get('east')==b'east'
+
+def shared(tmp_path):
+    cache = util.SharedTileCache()
+    cache.configure(str(tmp_path))
+    cache.generation_ttl = 0
+
+    return cache
+
+def render(data):
+    return lambda: (data, False, 0.1)
+
+def test_shared_generation(tmp_path):
+    first = shared(tmp_path)
+    second = shared(tmp_path)
+    first.invalidate(['a'], ('file', 1, 1))
+    assert first.render('tile', ['a'], render(b'tile'))==(b'tile', False, 0.1)
+
+    # Another worker loading the same file keeps the tile; a new file doesn't.
+    #
+    second.invalidate(['a'], ('file', 1, 1))
+    assert second.render('tile', ['a'], render(b'other'))==(b'tile', False, 0.0)
+    second.invalidate(['a'], ('file', 1, 2))
+    assert first.render('tile', ['a'], render(b'new'))==(b'new', False, 0.1)
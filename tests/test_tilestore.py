@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tilestore
+
+# The shared tile stores: consistent hashing over several stores,
+# and the claims and size limit of a FileTileStore.
+#
+
+class Store:
+    def __init__(self):
+        self.tiles = {}
+
+    def get(self, h):
+        return self.tiles.get(h)
+
+    def put(self, h, data):
+        self.tiles[h] = data
+
+def keys(n):
+    return [tilestore.tile_hash('tile', i) for i in range(n)]
+
+def test_hash_ring_spreads_keys():
+    ring = tilestore.HashRing({name:Store() for name in 'abc'})
+    for h in keys(3000):
+        ring.put(h, b'tile')
+
+    counts = [len(store.tiles) for store in ring.stores.values()]
+    assert sum(counts)==3000
+    assert min(counts)>500
+    for h in keys(3000):
+        assert ring.get(h)==b'tile'
+
+def test_hash_ring_moves_only_the_removed_stores_keys():
+    stores = {name:Store() for name in 'abcd'}
+    ring = tilestore.HashRing(stores)
+    smaller = tilestore.HashRing({name:store for name,store in stores.items() if name!='d'})
+
+    for h in keys(2000):
+        if ring.store_for(h) is not stores['d']:
+            assert smaller.store_for(h) is ring.store_for(h)
+
+def test_claim(tmp_path):
+    store = tilestore.FileTileStore(tmp_path)
+    h = tilestore.tile_hash('tile')
+
+    assert store.claim(h)
+    assert not store.claim(h)
+    store.release(h)
+    assert store.claim(h)
+
+def test_stale_claim_is_taken_over(tmp_path):
+    store = tilestore.FileTileStore(tmp_path, claim_timeout=60)
+    h = tilestore.tile_hash('tile')
+    assert store.claim(h)
+
+    # The process that claimed the tile died a while ago.
+    #
+    path = store._path(h) + '.claim'
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    assert store.claim(h)
+    assert not store.claim(h)
+
+def test_sweep_keeps_newest_and_pinned(tmp_path):
+    store = tilestore.FileTileStore(tmp_path, max_bytes=3000)
+    token = tilestore.pinned_hash('generation', 'layer')
+    store.put(token, b'1' * 1000)
+    tiles = keys(5)
+    for i,h in enumerate(tiles):
+        store.put(h, b'x' * 1000)
+        t = time.time() - 100 + i
+        os.utime(store._path(h), (t, t))
+
+    store.sweep()
+
+    assert [store.get(h) is not None for h in tiles]==[False, False, True, True, True]
+    assert store.get(token)==b'1' * 1000
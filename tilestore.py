@@ -0,0 +1,257 @@
+from bisect import bisect
+import hashlib
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Stores for encoded tiles that are shared by several server processes.
+#
+# A store maps a key (a hex digest, see tile_hash()) to bytes, and has:
+#
+#   get(h)       The stored bytes, or None.
+#   put(h, data) Store the bytes.
+#   claim(h)     Claim the right to render a tile: True if this process should render it,
+#                False if another process is already rendering it.
+#   release(h)   Give up a claim.
+#
+# Keys ending in PINNED (see pinned_hash()) are small entries, such as the generation
+# tokens of util.SharedTileCache, that must outlive the tiles: a store shouldn't evict them
+# to save space.
+#
+# FileTileStore is shared by the worker processes on a host. HttpTileStore talks
+# to a store on another host (scripts/tile_store.py serves a FileTileStore over HTTP,
+# and can stand in for a memcached-like service). HashRing spreads the keys over
+# several stores with consistent hashing, so each tile is stored (and rendered) once.
+#
+# This module only uses the standard library, so the stand-in server doesn't
+# need the WMS server's dependencies.
+#
+
+def tile_hash(*parts):
+    """Return the hex digest identifying a tile (or other entry) in a store."""
+
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+PINNED = '.pinned'
+
+def pinned_hash(*parts):
+    """Return the key of an entry that isn't evicted when the store is full."""
+
+    return tile_hash(*parts) + PINNED
+
+class FileTileStore:
+    """Tiles stored as files in a directory.
+
+    Writes go to a temporary file that is renamed into place with os.replace(),
+    which is atomic, so readers never see a partial tile and don't need a lock.
+    A claim is a file created with O_EXCL; claims older than claim_timeout seconds
+    are assumed to belong to a process that died, and are taken over.
+
+    When the files use more than max_bytes, the oldest are deleted
+    (at most every sweep_interval seconds, by whichever process is writing).
+    Pinned entries aren't deleted, or counted.
+
+    :param root: The directory; it is created if necessary.
+    :param max_bytes: The maximum total size of the stored tiles, or None for no limit.
+    :param claim_timeout: Seconds after which a claim is stale.
+    :param sweep_interval: The minimum number of seconds between size checks.
+    """
+
+    def __init__(self, root, *, max_bytes=None, claim_timeout=60.0, sweep_interval=30.0):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.claim_timeout = claim_timeout
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def __repr__(self):
+        return f'FileTileStore({self.root!r})'
+
+    def _path(self, h):
+        return os.path.join(self.root, h[:2], h[2:])
+
+    def get(self, h):
+        try:
+            with open(self._path(h), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, h, data):
+        path = self._path(h)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        if self.max_bytes is not None and time.monotonic()-self._last_sweep>self.sweep_interval:
+            self.sweep()
+
+    def claim(self, h):
+        path = self._path(h) + '.claim'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+
+                return True
+            except FileExistsError:
+                try:
+                    if time.time()-os.stat(path).st_mtime<self.claim_timeout:
+                        return False
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        return False
+
+    def release(self, h):
+        try:
+            os.remove(self._path(h) + '.claim')
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Delete the oldest tiles until the store fits in max_bytes. Pinned entries are kept."""
+
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._last_sweep = time.monotonic()
+            files = []
+            total = 0
+            for subdir in os.scandir(self.root):
+                if not subdir.is_dir():
+                    continue
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith(('.claim', '.tmp', PINNED)):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+
+            files.sort()
+            for _, size, path in files:
+                if total<=self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            self._sweep_lock.release()
+
+class HttpTileStore:
+    """A store on another host, such as scripts/tile_store.py.
+
+    The protocol is GET and PUT /tiles/{h}, and POST (claim) and DELETE (release)
+    /claims/{h}; a claim is granted with 201, and refused with 409.
+    Network errors are treated as misses (and refused claims are treated as granted),
+    so an unavailable store makes the server render tiles rather than fail.
+
+    :param url: The base URL, such as http://cache1:8800.
+    :param timeout: The timeout of each request in seconds.
+    """
+
+    def __init__(self, url, *, timeout=2.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.errors = 0
+
+    def __repr__(self):
+        return f'HttpTileStore({self.url!r})'
+
+    def _request(self, method, path, data=None):
+        """Return (status, body), or (None, None) if the store can't be reached."""
+
+        req = urllib.request.Request(f'{self.url}{path}', data=data, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        except (urllib.error.URLError, OSError):
+            self.errors += 1
+
+            return None, None
+
+    def get(self, h):
+        status, body = self._request('GET', f'/tiles/{h}')
+
+        return body if status==200 else None
+
+    def put(self, h, data):
+        self._request('PUT', f'/tiles/{h}', data)
+
+    def claim(self, h):
+        status, _ = self._request('POST', f'/claims/{h}', b'')
+
+        return status!=409
+
+    def release(self, h):
+        self._request('DELETE', f'/claims/{h}')
+
+class HashRing:
+    """Spread keys over several stores using consistent hashing.
+
+    Each store is placed at replicas points on a ring of hashes, and a key
+    belongs to the store at the next point after the key's hash. Adding or
+    removing a store only moves the keys of the neighbouring points.
+
+    The HashRing is itself a store, which passes each call to the key's store.
+
+    :param stores: The stores, with names (such as their URLs) as a dictionary.
+    :param replicas: The number of points of each store on the ring.
+    """
+
+    def __init__(self, stores, *, replicas=100):
+        self.stores = stores
+        points = sorted(
+            (int(tile_hash(name, i)[:16], 16), name)
+            for name in stores
+            for i in range(replicas)
+        )
+        self._hashes = [p for p,_ in points]
+        self._names = [name for _,name in points]
+
+    def __repr__(self):
+        return f'HashRing({list(self.stores)!r})'
+
+    def store_for(self, h):
+        """Return the store that owns the key."""
+
+        i = bisect(self._hashes, int(h[:16], 16)) % len(self._hashes)
+
+        return self.stores[self._names[i]]
+
+    def get(self, h):
+        return self.store_for(h).get(h)
+
+    def put(self, h, data):
+        self.store_for(h).put(h, data)
+
+    def claim(self, h):
+        return self.store_for(h).claim(h)
+
+    def release(self, h):
+        self.store_for(h).release(h)
+
+def open_stores(locations, *, max_bytes=None):
+    """Return a store for a list of locations: directories, or http:// URLs."""
+
+    stores = {
+        location:HttpTileStore(location) if location.startswith(('http://', 'https://')) else FileTileStore(location, max_bytes=max_bytes)
+        for location in locations
+    }
+
+    return next(iter(stores.values())) if len(stores)==1 else HashRing(stores)
@@ -1,13 +1,32 @@
-from dataclasses import dataclass
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from functools import lru_cache
+import gc
+import itertools
+import os
+import struct
+import threading
+import time
+import zlib
 from typing import List, Optional, Callable
 from PIL import Image, ImageColor, ImageDraw, ImageFont
 
 from io import BytesIO
+import json
 
 import xml.etree.ElementTree as ET
 
+import tilestore
+
 FONT = ImageFont.truetype('arial.ttf', 12)
 
+# GetFeatureInfo searches for features within this many pixels of the queried point.
+#
+INFO_RADIUS_PX = 5
+
 NS = 'http://www.opengis.net/wms'
 NS_MS = '"http://mapserver.gis.umn.edu/mapserver'
 NS_SLD = 'http://www.opengis.net/sld'
@@ -21,6 +40,10 @@ ET.register_namespace('xsi', NS_XSI)
 
 ns = {'wms':NS, 'sld':NS_SLD}
 
+# The contents of config.toml, set by the app at startup before the modules are imported.
+#
+config = {}
+
 
 from jinja2 import Environment, PackageLoader, select_autoescape
 env = Environment(
@@ -51,6 +74,8 @@ class Layer:
     attribution: str = 'WMS server'
     priority: Optional[int] = None
     style: Optional[str] = None
+    cache: bool = False
+    stream: bool = True
 
 def intersects(bbox, layer):
     """Do the bounding box and layer intersect?"""
@@ -63,6 +88,17 @@ def intersects(bbox, layer):
 
     return True
 
+def request_categories(request):
+    """Return the categories listed in the CATEGORIES vendor parameter of a request, or None.
+
+    A layer with categories can draw a subset of them, such as CATEGORIES=Tanker,Cargo.
+    (Warm-up renders have no request.)
+    """
+
+    value = None if request is None else request.query_params.get('CATEGORIES')
+
+    return [c.strip() for c in value.split(',') if c.strip()] if value else None
+
 def blank_image(request, width, height):
     """Create a blank image.
 
@@ -72,6 +108,71 @@ def blank_image(request, width, height):
 
     return Image.new('RGBA', (width, height), color=(0, 255, 0, 0))
 
+@lru_cache(maxsize=64)
+def blank_png(width, height):
+    """The PNG encoding of a transparent image.
+
+    Clients tend to use a handful of tile sizes, so the encoded bytes are
+    kept rather than creating and encoding a new blank image per request.
+    """
+
+    return byte_buffer(Image.new('RGBA', (width, height), color=(0, 0, 0, 0))).read()
+
+class Metrics:
+    """Thread-safe counters, such as how GetMap requests were served."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def get(self, name):
+        return self._counts.get(name, 0)
+
+    @contextmanager
+    def time(self, name):
+        """Count the calls of a block of code as name_count, and its total time as name_seconds."""
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self._lock:
+                self._counts[f'{name}_count'] = self._counts.get(f'{name}_count', 0) + 1
+                self._counts[f'{name}_seconds'] = self._counts.get(f'{name}_seconds', 0) + dt
+
+    def snapshot(self):
+        """Return a copy of the counters."""
+
+        with self._lock:
+            return dict(self._counts)
+
+metrics = Metrics()
+
+def rss_bytes():
+    """The resident set size of this process, or None if it can't be determined."""
+
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
 class Wms:
     """Gather layer hierarchies and the layer definitions."""
 
@@ -80,6 +181,10 @@ class Wms:
         self._layer_trees = []
         self._layers_by_name = {}
         self._styles = {}
+        self._category_styles = set()
+        self._info_funcs = {}
+        self._agg_funcs = {}
+        self._empty_aggs = {}
 
         # Database name.
         #
@@ -106,7 +211,9 @@ class Wms:
         maxy=90,
         attribution='WMS server',
         priority=None,
-        style=None):
+        style=None,
+        cache=False,
+        stream=True):
         """Decorator for layer functions.
 
         A client can ask for more than layer in a single request.
@@ -120,6 +227,13 @@ class Wms:
         :param name: The visible name of the layer. If not provided,
             defaults to the wrapped function's __name__ property.
         :param priority: The priority of the layer.
+        :param cache: If True, rendered images of the layer are cached in tile_cache.
+            Only set this if the image depends on nothing but the GetMap parameters.
+            Modules that change the data must call tile_cache.invalidate().
+        :param stream: If False, images larger than the streaming threshold are refused
+            rather than rendered in strips. Set this if the colors depend on the whole image
+            (for example, tf.shade(how='eq_hist') without a global histogram), since each strip
+            would be normalised separately, and the strips would show as bands.
         """
 
         def decorator(func):
@@ -158,17 +272,23 @@ class Wms:
             maxy=maxy,
             attribution=attribution,
             priority=p,
-            style=s)
+            style=s,
+            cache=cache,
+            stream=stream)
             self._layers_by_name[n] = layer
 
             return func
 
         return decorator
 
-    def style(self, name=None):
+    def style(self, name=None, *, categories=False):
         """Decorator for style functions.
 
         Style legends return an image to be used as a legend by the client.
+
+        :param categories: If True, the style function draws the legend of a subset of
+            the categories of a layer (see request_categories()), and is called as
+            func(path, legend, categories=categories) when the legend request has a CATEGORIES parameter.
         """
 
         def decorator(func):
@@ -181,11 +301,152 @@ class Wms:
 
             print('STYLE', n, func)
             self._styles[n] = func
+            if categories:
+                self._category_styles.add(n)
+
+            return func
+
+        return decorator
+
+    def update_layer(self, name, **changes):
+        """Change properties of a registered layer, such as its bounding box,
+        for example when new data has been loaded.
+        """
+
+        self._layers_by_name[name] = replace(self.get_layer(name), **changes)
+
+    def feature_info(self, name):
+        """Decorator for feature info functions.
+
+        A feature info function makes a layer queryable using GetFeatureInfo.
+        It is called as func(request, x, y, rx, ry, path, layer_name, feature_count),
+        and must return a list of up to feature_count (x, y, properties) tuples
+        for the features nearest to (x, y) within the radii (rx, ry),
+        nearest first. The properties are a dictionary.
+
+        :param name: The name of a registered layer.
+        """
+
+        def decorator(func):
+            if name not in self._layers_by_name:
+                raise ValueError(f'Layer "{name}" is not registered')
+
+            if name in self._info_funcs:
+                raise ValueError(f'Feature info for layer "{name}" is already registered.')
+
+            print('FEATURE INFO', name, func)
+            self._info_funcs[name] = func
 
             return func
 
         return decorator
 
+    def aggregate(self, name, *, shade, empty=None):
+        """Decorator for aggregate functions.
+
+        A layer that renders by aggregating then shading can register the two steps
+        separately, so that several tiles of the layer can share one aggregation
+        (see render_tiles()). The aggregate function is called as
+        func(request, width, height, bbox, path, layer_name), and must return
+        an xarray aggregate with dimensions (y, x, ...), y increasing, as datashader
+        produces, or None if there is nothing to draw. The shade function is called as
+        shade(request, agg, bbox, path, layer_name, style_name) with the part of
+        the aggregate covering a tile, and returns an image, or None.
+
+        :param name: The name of a registered layer.
+        :param shade: The layer's shade function.
+        :param empty: A function called as empty(request, width, height, path, layer_name)
+            that returns the aggregate of a tile with nothing in it, with the dtype,
+            dimensions, and categories of the layer's aggregates. Without it,
+            empty tiles are sent as a 2-D grid of uint32 zeros.
+        """
+
+        def decorator(func):
+            if name not in self._layers_by_name:
+                raise ValueError(f'Layer "{name}" is not registered')
+
+            if name in self._agg_funcs:
+                raise ValueError(f'Aggregate function for layer "{name}" is already registered.')
+
+            print('AGGREGATE', name, func)
+            self._agg_funcs[name] = func, shade
+            if empty is not None:
+                self._empty_aggs[name] = empty
+
+            return func
+
+        return decorator
+
+    def get_aggregate(self, name):
+        """Return the (aggregate, shade) functions of a layer, or None."""
+
+        return self._agg_funcs.get(name)
+
+    def get_empty_aggregate(self, name):
+        """Return the function that makes the empty aggregate of a layer, or None."""
+
+        return self._empty_aggs.get(name)
+
+    def aggregate_names(self):
+        """Return the names of the layers that have registered aggregate functions."""
+
+        return list(self._agg_funcs)
+
+    def render_tiles(self, request, tiles, path):
+        """Render tiles of one layer from a single aggregation.
+
+        The tiles must have been grouped by tile_groups(), so they have the same
+        pixel size, and their pixels line up. The layer is aggregated once onto a
+        canvas covering all of the tiles, and each tile shades its part.
+
+        Yields (tile, image) as each tile is shaded; the image is None if there is nothing to draw.
+        """
+
+        name = tiles[0].layer_names
+        agg_func, shade_func = self._agg_funcs[name]
+        bbox, width, height = group_canvas(tiles)
+        west, south, east, north = bbox
+        agg = agg_func(request, width, height, bbox, path, name)
+        for tile in tiles:
+            check_cancelled()
+            if agg is None:
+                yield tile, None
+                continue
+
+            twest, tsouth, _, _ = tile.bbox
+            col = round((twest-west) / (east-west) * width)
+            row = round((tsouth-south) / (north-south) * height)
+            ydim, xdim = agg.dims[:2]
+            part = agg.isel({ydim: slice(row, row+tile.height), xdim: slice(col, col+tile.width)})
+
+            yield tile, shade_func(request, part, tile.bbox, path, name, tile.style_names)
+
+    def get_feature_info(self, request, width, height, bbox, i, j, path, layer_names, feature_count):
+        """Return the features near pixel (i, j) of the map in each of the listed layers.
+
+        The result is a list of (layer_name, features) tuples,
+        where features is the list returned by the layer's feature info function.
+
+        Raise WmsError('LayerNotQueryable') if a layer is not queryable.
+        """
+
+        west, south, east, north = bbox
+        x = west + (i+0.5) * (east-west) / width
+        y = north - (j+0.5) * (north-south) / height
+        rx = INFO_RADIUS_PX * (east-west) / width
+        ry = INFO_RADIUS_PX * (north-south) / height
+
+        result = []
+        for name in layer_names:
+            self.get_layer(name)
+            if name not in self._info_funcs:
+                raise WmsError('LayerNotQueryable', f'Layer "{name}" is not queryable')
+
+            features = self._info_funcs[name](request, x, y, rx, ry, path, name, feature_count)
+            result.append((name, features[:feature_count]))
+
+        return result
+
     def get_layer_providers(self):
         """Return a list of layer provider functions."""
 
@@ -218,8 +479,16 @@ class Wms:
 
         raise WmsError('StyleNotDefined', f'Style "{name}" is not defined')
 
+    def style_categories(self, name):
+        """Does the style draw legends for subsets of categories?"""
+
+        return name in self._category_styles
+
     def multi_layer(self, request, width, height, bbox, path, layer_names, style_names):
-        """Return the union of the listed layers."""
+        """Return the union of the listed layers.
+
+        Returns None if none of the layers drew anything.
+        """
 
         def intersection(bbox, layer):
             if intersects(bbox, layer):
@@ -246,14 +515,21 @@ class Wms:
         # Create a transparent image to draw on.
         #
         img_base = Image.new('RGBA', (width, height), color=(0, 0, 0, 0))
+        drawn = False
         for name,sname in names:
+            check_cancelled()
             layer = self._layers_by_name[name]
             bbox2 = intersection(bbox, layer)
             if bbox2:
                 minx2, miny2, maxx2, maxy2 = bbox2
                 width2 = int(width / (east-west) * (maxx2-minx2))
                 height2 = int(height / (north-south) * (maxy2-miny2))
-                img = layer.img_func(request, width2, height2, bbox2, path, name, sname).copy()
+                img = layer.img_func(request, width2, height2, bbox2, path, name, sname)
+                if img is None:
+                    continue
+
+                img = img.copy()
+                drawn = True
                 print('SIZE', img.size)
                 if 'A' not in img.getbands():
                     alpha = Image.new('L', img.size, color=255)
@@ -264,7 +540,7 @@ class Wms:
                 y2 = int((north-maxy2) / (north-south) * height)
                 img_base.paste(img, (x2,y2), img)
 
-        return img_base
+        return img_base if drawn else None
 
     def register_missing_layers(self, hiers):
         """Create Layer instances in the hierarchy list for layer functions
@@ -291,7 +567,9 @@ class Wms:
         find_registered_layers(hiers, registered_names)
         print('REGISTERED', registered_names)
 
-        layers = self.get_layers()
+        # Modules may still be registering layers in other threads.
+        #
+        layers = list(self.get_layers())
         for layer_name in layers:
             print(f'LAYER {layer_name}')
             if layer_name not in registered_names:
@@ -330,7 +608,7 @@ class Wms:
                         add_text(layer_el, 'Abstract', layer.abstract)
                     else:
                         layer_data = self._layers_by_name[layer.name]
-                        layer_el.set('queryable', '0')
+                        layer_el.set('queryable', '1' if layer.name in self._info_funcs else '0')
                         layer_el.set('opaque', '0')
                         layer_el.set('cascaded', '0')
                         add_text(layer_el, 'Name', layer_data.name)
@@ -361,10 +639,20 @@ class Wms:
                                 style_el = ET.SubElement(layer_el, 'Style')
                                 add_text(style_el, 'Name', sname)
                                 add_text(style_el, 'Title', f'{layer_data.title} (style {sname})')
-                                img = self._styles[sname](path, sname)
+                                # The legend's size isn't known until the layer's data has loaded.
+                                # A legend that fails to draw is still advertised, without a size.
+                                #
+                                try:
+                                    img = self._styles[sname](path, sname)
+                                except WmsError:
+                                    img = None
+                                except Exception as e:
+                                    print(f'Legend {sname} for path {path!r} failed: {e!r}')
+                                    img = None
                                 legend_el = ET.SubElement(style_el, 'LegendURL')
-                                legend_el.set('width', str(img.width))
-                                legend_el.set('height', str(img.height))
+                                if img is not None:
+                                    legend_el.set('width', str(img.width))
+                                    legend_el.set('height', str(img.height))
                                 add_text(legend_el, 'Format', 'image/png')
                                 resource_el = ET.SubElement(legend_el, 'OnlineResource')
                                 resource_el.set('xlink:type', 'simple')
@@ -399,6 +687,979 @@ class Wms:
 
 wms = Wms()
 
+def bbox_intersects(a, b):
+    """Do two (west, south, east, north) bounding boxes intersect?"""
+
+    return not (a[0]>b[2] or a[2]<b[0] or a[1]>b[3] or a[3]<b[1])
+
+class MemoryBudget:
+    """One memory budget shared by the caches and datasets in the process.
+
+    Each cache or dataset ("tier") has its own limit, but together they can still
+    use more memory than the machine has. Tiers register with util.memory, and call
+    check() when they grow. If the total is over the budget (the max_mb setting
+    of the [memory] section of config.toml), entries are evicted from any tier,
+    cheapest to lose first, until the total fits.
+
+    The value of an entry is the time it would take to recreate it (rendering
+    a tile, loading a partition), multiplied by how often it has been used,
+    and discounted by how long it has been idle, per byte:
+
+        score = cost * (1 + hits) / (nbytes * (1 + idle_seconds))
+
+    so a large partition that loads quickly and hasn't been used for a while
+    is evicted before a slow tile that is requested every few seconds.
+
+    A tier is an object with the methods:
+
+    - memory_usage(): the number of bytes it holds.
+    - memory_candidates() (optional): the entries that could be evicted now,
+      as (key, nbytes, cost_seconds, hits, last_used) tuples, where last_used
+      is a time.monotonic() value.
+    - memory_evict(key) (optional): evict an entry, returning the number of bytes freed
+      (0 if the entry has gone or is in use).
+
+    Tiers must not call check() while holding their own locks.
+    """
+
+    def __init__(self):
+        self.max_bytes = 0
+        self.evictions = {}
+        self.evicted_bytes = 0
+        self._tiers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_mb=None):
+        """Set the budget; None or 0 means no global budget."""
+
+        self.max_bytes = int((max_mb or 0) * 1024 * 1024)
+
+    def register(self, name, tier):
+        """Add a tier (replacing any tier with the same name)."""
+
+        self._tiers[name] = tier
+
+    def unregister(self, name):
+        self._tiers.pop(name, None)
+
+    def usage(self):
+        """Return the bytes held by each tier."""
+
+        return {name:tier.memory_usage() for name,tier in list(self._tiers.items())}
+
+    @staticmethod
+    def score(nbytes, cost, hits, last_used, now):
+        return max(cost, 0.001) * (1+hits) / (max(nbytes, 1) * (1 + now-last_used))
+
+    def check(self):
+        """Evict the least valuable entries if the tiers are over the budget.
+
+        Returns the number of bytes freed.
+        """
+
+        if not self.max_bytes:
+            return 0
+
+        with self._lock:
+            total = sum(self.usage().values())
+            if total<=self.max_bytes:
+                return 0
+
+            now = time.monotonic()
+            candidates = sorted(
+                (self.score(nbytes, cost, hits, last_used, now), name, key, nbytes)
+                for name,tier in list(self._tiers.items()) if hasattr(tier, 'memory_candidates')
+                for key,nbytes,cost,hits,last_used in tier.memory_candidates()
+            )
+
+            freed = 0
+            for _, name, key, _ in candidates:
+                if total-freed<=self.max_bytes:
+                    break
+
+                n = self._tiers[name].memory_evict(key)
+                if n:
+                    freed += n
+                    self.evictions[name] = self.evictions.get(name, 0) + 1
+
+            self.evicted_bytes += freed
+            if total-freed>self.max_bytes:
+                metrics.inc('memory_over_budget')
+
+            return freed
+
+    def status(self):
+        """Return the budget and the bytes held by each tier."""
+
+        usage = self.usage()
+
+        return {
+            'max_bytes': self.max_bytes,
+            'bytes': sum(usage.values()),
+            'rss_bytes': rss_bytes(),
+            'tiers': {
+                name:{'bytes': nbytes, 'evictions': self.evictions.get(name, 0)}
+                for name,nbytes in usage.items()
+            },
+            'evicted_bytes': self.evicted_bytes
+        }
+
+memory = MemoryBudget()
+
+class TileCache:
+    """An LRU cache of encoded images.
+
+    Each entry remembers the layers and bounding box it was rendered from,
+    so that when a module changes some of its data, only the entries
+    that overlap the change need to be invalidated.
+
+    A render that started before an invalidation may have used the old data,
+    so it must not be cached afterwards. Each layer has a version, which invalidation
+    increments: take version() before rendering, and pass it to put().
+
+    The cache is also a util.memory tier: if the process is over its memory budget,
+    images that were quick to render and are rarely used may be evicted early.
+
+    :param max_bytes: The maximum total size of the cached images.
+    """
+
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached data for key, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            entry[4] += 1
+            entry[5] = time.monotonic()
+
+            return entry[2]
+
+    def version(self, layer_names):
+        """Return the version of the layers, which changes when any of them is invalidated."""
+
+        with self._lock:
+            return tuple(self._versions.get(name, 0) for name in layer_names)
+
+    def put(self, key, layer_names, bbox, data, cost=0.0, version=None):
+        """Cache data rendered for the layers in the bbox.
+
+        :param cost: The time in seconds it took to render the data.
+        :param version: The layers' version() when the render started. If any of the layers
+            has been invalidated since, the data isn't cached.
+        """
+
+        if len(data)>self.max_bytes:
+            return
+
+        with self._lock:
+            if version is not None and version!=tuple(self._versions.get(name, 0) for name in layer_names):
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old[2])
+
+            # [layer_names, bbox, data, cost, hits, last_used]
+            #
+            self._entries[key] = [frozenset(layer_names), tuple(bbox), data, cost, 0, time.monotonic()]
+            self.nbytes += len(data)
+            while self.nbytes>self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted[2])
+
+        memory.check()
+
+    def invalidate(self, layer_names, bbox=None, *, generation=None):
+        """Remove the entries that include any of the layers and intersect the bbox.
+
+        If bbox is None, remove all entries that include any of the layers.
+        Returns the number of entries removed.
+
+        :param generation: Passed to shared_cache.invalidate(). Pass the fingerprint
+            of a dataset that has been loaded from a file, so that loading the same file
+            in another process doesn't invalidate the shared tiles.
+        """
+
+        layer_names = set(layer_names)
+        with self._lock:
+            for name in layer_names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+            keys = [
+                key for key,(names,ebbox,*_) in self._entries.items()
+                if names & layer_names and (bbox is None or bbox_intersects(ebbox, bbox))
+            ]
+            for key in keys:
+                entry = self._entries.pop(key)
+                self.nbytes -= len(entry[2])
+
+        shared_cache.invalidate(layer_names, generation)
+
+        return len(keys)
+
+    def memory_usage(self):
+        return self.nbytes
+
+    def memory_candidates(self):
+        with self._lock:
+            return [(key, len(data), cost, hits, last_used) for key,(_,_,data,cost,hits,last_used) in self._entries.items()]
+
+    def memory_evict(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return 0
+            self.nbytes -= len(entry[2])
+
+            return len(entry[2])
+
+tile_cache = TileCache()
+memory.register('tile_cache', tile_cache)
+
+class SharedTileCache:
+    """A tile cache shared by the worker processes on a host, and optionally by several hosts.
+
+    The tiles are kept in a tilestore store (a directory, the HTTP stores in a cluster,
+    or a mixture of them) rather than in memory. Tiles are rendered once: the first
+    process to miss a tile claims it, and the other processes wait for it
+    (for up to wait seconds, after which they render it themselves).
+
+    The store can't be searched by bounding box, so invalidating any part of a layer
+    invalidates all of the layer's shared tiles. Each layer has a generation token
+    that is part of the tiles' keys, and invalidation writes a new token. The tokens
+    are pinned (see tilestore.pinned_hash()), so they aren't evicted with the tiles.
+    Other processes read the tokens at most every generation_ttl seconds, so they may
+    serve tiles from before an invalidation for that long.
+
+    Empty tiles are stored as no bytes, so other processes don't render them either.
+    """
+
+    def __init__(self):
+        self.store = None
+        self.wait = 5.0
+        self.generation_ttl = 1.0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def configure(self, locations, *, max_mb=None, wait=5.0):
+        """Use the stores at the locations (directories, or http:// URLs).
+
+        :param max_mb: The maximum size of each directory store.
+        """
+
+        if isinstance(locations, str):
+            locations = [locations]
+        self.store = tilestore.open_stores(locations, max_bytes=None if max_mb is None else int(max_mb * 1024 * 1024)) if locations else None
+        self.wait = wait
+        if self.store is not None:
+            print(f'Shared tile cache: {self.store}')
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def _generation(self, layer_name):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._generations.get(layer_name)
+        if cached is not None and now-cached[1]<self.generation_ttl:
+            return cached[0]
+
+        h = tilestore.pinned_hash('generation', layer_name)
+        token = self.store.get(h)
+        if token is None:
+            # The token is new (or was lost, for example with a store that was restarted).
+            # Either way, a new token makes sure no old tiles are used.
+            #
+            self.store.put(h, os.urandom(8).hex().encode())
+            token = self.store.get(h) or b''
+        with self._lock:
+            self._generations[layer_name] = (token, now)
+
+        return token
+
+    def _hash(self, key, layer_names):
+        return tilestore.tile_hash(key, [self._generation(name) for name in layer_names])
+
+    def invalidate(self, layer_names, generation=None):
+        """Invalidate the shared tiles of the layers.
+
+        :param generation: Identifies the layers' new data, such as DatasetHandle.fingerprint.
+            Every process that loads the same data derives the same token from it, so loading
+            data that the other processes already have (when a worker starts, for example)
+            keeps their tiles. If None, the data has changed in this process only,
+            and the token is random.
+        """
+
+        if self.store is None:
+            return
+
+        for name in layer_names:
+            h = tilestore.pinned_hash('generation', name)
+            if generation is None:
+                token = os.urandom(8).hex().encode()
+            else:
+                token = tilestore.tile_hash('generation', name, generation)[:16].encode()
+            if generation is None or self.store.get(h)!=token:
+                self.store.put(h, token)
+            with self._lock:
+                self._generations[name] = (token, time.monotonic())
+
+    def render(self, key, layer_names, render_func):
+        """Return render_func()'s result of (data, draft, seconds) for a tile,
+        using the shared tile if there is one, and sharing the tile if it is rendered here.
+
+        Call this in a worker thread: it may wait for another process to render the tile.
+        """
+
+        h = self._hash(key, layer_names)
+        data = self.store.get(h)
+        if data is not None:
+            metrics.inc('shared_hits')
+
+            return data or None, False, 0.0
+
+        metrics.inc('shared_misses')
+        deadline = time.monotonic() + self.wait
+        while not self.store.claim(h):
+            # Another process is rendering the tile.
+            #
+            if time.monotonic()>deadline:
+                metrics.inc('shared_wait_timeouts')
+
+                return render_func()
+
+            time.sleep(0.05)
+            check_cancelled()
+            data = self.store.get(h)
+            if data is not None:
+                metrics.inc('shared_waits')
+
+                return data or None, False, 0.0
+
+        try:
+            data, draft, seconds = render_func()
+            if not draft:
+                self.store.put(h, data or b'')
+        finally:
+            self.store.release(h)
+
+        return data, draft, seconds
+
+shared_cache = SharedTileCache()
+
+@dataclass(frozen=True)
+class Tile:
+    """One of the images requested from the batch endpoint."""
+
+    index: int
+    layer_names: str
+    style_names: str
+    bbox: tuple
+    width: int
+    height: int
+
+def group_canvas(tiles):
+    """Return the (bbox, width, height) of a canvas covering a group of tiles."""
+
+    west = min(tile.bbox[0] for tile in tiles)
+    south = min(tile.bbox[1] for tile in tiles)
+    east = max(tile.bbox[2] for tile in tiles)
+    north = max(tile.bbox[3] for tile in tiles)
+    tile = tiles[0]
+    px = (tile.bbox[2]-tile.bbox[0]) / tile.width
+    py = (tile.bbox[3]-tile.bbox[1]) / tile.height
+
+    return (west, south, east, north), max(1, round((east-west)/px)), max(1, round((north-south)/py))
+
+def tile_groups(tiles, max_pixels):
+    """Group the tiles that can share an aggregation.
+
+    Tiles can be aggregated together if they show the same single layer,
+    the layer has an aggregate function, their pixels are the same size,
+    and their pixel edges line up, as the tiles of a tile grid do.
+    Tiles are added to a group while its canvas has at most max_pixels pixels,
+    and at most twice the pixels of its tiles, so a group of scattered tiles
+    doesn't aggregate the space between them.
+
+    Returns a list of groups (lists of tiles), and a list of the other tiles.
+    """
+
+    keyed = {}
+    others = []
+    for tile in tiles:
+        if ',' in tile.layer_names or wms.get_aggregate(tile.layer_names) is None:
+            others.append(tile)
+            continue
+
+        west, south, east, north = tile.bbox
+        px = (east-west) / tile.width
+        py = (north-south) / tile.height
+        phase = round((west/px)%1 * 1000)%1000, round((south/py)%1 * 1000)%1000
+        key = tile.layer_names, f'{px:.9g}', f'{py:.9g}', phase
+        keyed.setdefault(key, []).append(tile)
+
+    groups = []
+    for key_tiles in keyed.values():
+        group = []
+        pixels = 0
+        for tile in sorted(key_tiles, key=lambda t:(t.bbox[1], t.bbox[0])):
+            if group:
+                _, width, height = group_canvas(group+[tile])
+                canvas = width * height
+                if canvas<=max_pixels and canvas<=2*(pixels+tile.width*tile.height):
+                    group.append(tile)
+                    pixels += tile.width * tile.height
+                    continue
+
+                groups.append(group)
+
+            group = [tile]
+            pixels = tile.width * tile.height
+
+        groups.append(group)
+
+    return groups, others
+
+class Overloaded(Exception):
+    """A render was refused or abandoned because the server is too busy.
+
+    The client should be told to retry after retry_after seconds.
+    """
+
+    def __init__(self, message, retry_after):
+        self.message = message
+        self.retry_after = retry_after
+
+class Disconnected(Exception):
+    """The client went away before its render finished."""
+
+class RenderCancelled(Exception):
+    """Raised by check_cancelled() in a render that is no longer wanted."""
+
+_render_state = threading.local()
+
+def check_cancelled():
+    """Raise RenderCancelled if the render running in this thread has been abandoned.
+
+    A running datashader call can't be interrupted, so long renders should call this
+    between stages (for example, between the chunks of an aggregation) to give up early.
+    Outside a scheduled render this does nothing.
+    """
+
+    event = getattr(_render_state, 'cancelled', None)
+    if event is not None and event.is_set():
+        raise RenderCancelled()
+
+class RenderQuality:
+    """The quality requested for the images rendered in a render_quality() block,
+    and whether any layer drew a draft.
+
+    The mode is "auto" (layers may draw a draft if a full render would take
+    longer than their time budget), "full" (layers must not draw drafts),
+    or "draft" (layers that can draw drafts should). strip is True when the
+    images are strips of a larger streamed image.
+    """
+
+    def __init__(self, mode, strip=False):
+        self.mode = mode
+        self.strip = strip
+        self.draft = False
+
+@contextmanager
+def render_quality(mode='auto', *, strip=False):
+    """Render the layer functions called in this block (in this thread) with the given mode.
+
+    Yields the RenderQuality, whose draft attribute is set if any layer called mark_draft().
+
+    :param strip: The images are strips of a larger image (see rendering_strip()).
+    """
+
+    quality = RenderQuality(mode, strip)
+    previous = getattr(_render_state, 'quality', None)
+    _render_state.quality = quality
+    try:
+        yield quality
+    finally:
+        _render_state.quality = previous
+
+def render_mode():
+    """Return the quality mode of the render running in this thread ("auto" outside render_quality())."""
+
+    quality = getattr(_render_state, 'quality', None)
+
+    return 'auto' if quality is None else quality.mode
+
+def rendering_strip():
+    """Is the render running in this thread a strip of a larger streamed image?
+
+    Layer functions must then shade consistently across strips: for example,
+    spread by a fixed number of pixels rather than with tf.dynspread().
+    """
+
+    quality = getattr(_render_state, 'quality', None)
+
+    return quality is not None and quality.strip
+
+def mark_draft():
+    """Called by a layer function that has drawn an approximate image, so that
+    the image isn't cached, and is replaced by a full render later.
+    """
+
+    quality = getattr(_render_state, 'quality', None)
+    if quality is not None:
+        quality.draft = True
+
+class RenderScheduler:
+    """Admission control between the WMS endpoint and the layer functions.
+
+    At most max_concurrent renders run at once, in worker threads, so the event loop
+    stays free to answer cached and empty tiles. Up to max_queue further renders wait
+    for a worker; beyond that, requests are refused immediately (Overloaded) so the
+    client can retry, rather than queueing behind work that may no longer be wanted.
+
+    Each render has a deadline, measured from when it was submitted. A render that is
+    still queued at its deadline, or whose client disconnects, is dropped without running.
+    A render that is already running is flagged as cancelled (see check_cancelled())
+    and its result is discarded; its worker isn't released until it returns.
+
+    :param max_concurrent: The number of worker threads (default: the number of CPUs).
+    :param max_queue: The number of renders that can wait for a worker.
+    :param deadline: Seconds a request may wait for its image.
+    :param retry_after: Seconds a refused client is asked to wait before retrying.
+    """
+
+    def __init__(self, *, max_concurrent=None, max_queue=64, deadline=30.0, retry_after=1):
+        self.queued = 0
+        self.running = 0
+        self._executor = None
+        self.configure(max_concurrent=max_concurrent, max_queue=max_queue, deadline=deadline, retry_after=retry_after)
+
+    def configure(self, *, max_concurrent=None, max_queue=64, deadline=30.0, retry_after=1):
+        """Set the limits. This must not be called while renders are in progress."""
+
+        self.max_concurrent = max_concurrent or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.retry_after = retry_after
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='render')
+
+        # The semaphore binds to the event loop that first waits on it,
+        # so configure() must be called again if the loop is replaced.
+        #
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+
+    def status(self):
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue
+        }
+
+    async def _race(self, future, deadline, watch):
+        """Wait for the future, the deadline, or the watch task (the client disconnecting),
+        whichever comes first.
+
+        Returns True if the future is done, False if the deadline passed,
+        and raises Disconnected if the client disconnected.
+        """
+
+        await asyncio.wait(
+            [t for t in (future, watch) if t is not None],
+            timeout=max(0, deadline-time.monotonic()),
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        if future.done():
+            return True
+        if watch is not None and watch.done():
+            metrics.inc('render_disconnected')
+            raise Disconnected()
+
+        return False
+
+    def _overloaded(self, reason):
+        metrics.inc(f'render_{reason}')
+
+        return Overloaded(f'Render {reason}', self.retry_after)
+
+    def _watch(self, disconnected):
+        """Refuse the render if the queue is full; otherwise return a task watching for disconnection (or None).
+
+        An admitted render is counted as queued straight away, until _acquire() returns:
+        the semaphore doesn't count a waiter until its acquire() task first runs,
+        so the renders submitted in one iteration of the event loop would all be admitted.
+        """
+
+        if self.running+self.queued>=self.max_concurrent+self.max_queue:
+            if disconnected is not None:
+                disconnected.close()
+            raise self._overloaded('rejected')
+
+        metrics.inc('render_submitted')
+        self.queued += 1
+
+        return asyncio.ensure_future(disconnected) if disconnected is not None else None
+
+    async def _acquire(self, deadline, watch):
+        """Wait for a worker, for a render admitted by _watch()."""
+
+        acquire = asyncio.ensure_future(self._slots.acquire())
+        try:
+            acquired = await self._race(acquire, deadline, watch)
+        finally:
+            self.queued -= 1
+            if not acquire.done():
+                acquire.cancel()
+
+        if not acquired:
+            raise self._overloaded('deadline')
+
+    def _release(self):
+        self.running -= 1
+        self._slots.release()
+
+    async def _execute(self, func, args, deadline, watch, done):
+        """Run func(*args) in an acquired worker, and return its result.
+
+        done(future) is called when the function returns, even if the result is no longer wanted.
+        """
+
+        cancelled = threading.Event()
+
+        def work():
+            _render_state.cancelled = cancelled
+            try:
+                return func(*args)
+            except RenderCancelled:
+                metrics.inc('render_cancelled')
+                raise
+            finally:
+                _render_state.cancelled = None
+
+        def finished(future):
+            # Retrieve the exception of abandoned renders so asyncio doesn't log it.
+            #
+            if not future.cancelled():
+                future.exception()
+            done(future)
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, work)
+        future.add_done_callback(finished)
+        try:
+            finished_in_time = await self._race(future, deadline, watch)
+        except (Disconnected, asyncio.CancelledError):
+            cancelled.set()
+            raise
+
+        if not finished_in_time:
+            cancelled.set()
+            raise self._overloaded('deadline')
+
+        return future.result()
+
+    async def run(self, func, *args, disconnected=None):
+        """Run func(*args) in a worker thread and return its result.
+
+        Raises Overloaded if the queue is full or the deadline passes,
+        and Disconnected if the disconnected awaitable completes first.
+
+        :param disconnected: An awaitable that completes when the client disconnects.
+        """
+
+        deadline = time.monotonic() + self.deadline
+        watch = self._watch(disconnected)
+        try:
+            await self._acquire(deadline, watch)
+            self.running += 1
+
+            return await self._execute(func, args, deadline, watch, lambda future: self._release())
+        finally:
+            if watch is not None:
+                watch.cancel()
+
+    async def reserve(self, *, disconnected=None):
+        """Wait for a worker, and keep it for a series of renders, such as the strips of a large image.
+
+        Returns a Reservation, which must be released. Raises Overloaded and Disconnected as run() does;
+        once the worker is reserved, the renders don't wait in the queue behind other requests.
+
+        :param disconnected: An awaitable that completes when the client disconnects.
+        """
+
+        deadline = time.monotonic() + self.deadline
+        watch = self._watch(disconnected)
+        try:
+            await self._acquire(deadline, watch)
+        finally:
+            if watch is not None:
+                watch.cancel()
+        self.running += 1
+
+        return Reservation(self)
+
+class Reservation:
+    """A worker reserved by RenderScheduler.reserve().
+
+    Each render has the scheduler's deadline, measured from when it starts.
+    A render that is abandoned (for example, because the task awaiting it was cancelled
+    when the client disconnected) is flagged as cancelled, and the worker isn't
+    released until it returns.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._busy = False
+        self._released = False
+
+    async def run(self, func, *args, disconnected=None):
+        """Run func(*args) in the reserved worker and return its result.
+
+        Raises Overloaded if the deadline passes, and Disconnected if the disconnected awaitable completes first.
+
+        :param disconnected: An awaitable that completes when the client disconnects.
+        """
+
+        if self._released or self._busy:
+            if disconnected is not None:
+                disconnected.close()
+            raise ValueError('The reservation has been released, or is in use')
+
+        self._busy = True
+        deadline = time.monotonic() + self.scheduler.deadline
+        watch = asyncio.ensure_future(disconnected) if disconnected is not None else None
+        try:
+            return await self.scheduler._execute(func, args, deadline, watch, self._finished)
+        finally:
+            if watch is not None:
+                watch.cancel()
+
+    def _finished(self, future):
+        self._busy = False
+        if self._released:
+            self.scheduler._release()
+
+    def release(self):
+        """Release the worker, when the current render (if any) has returned."""
+
+        if self._released:
+            return
+        self._released = True
+        if not self._busy:
+            self.scheduler._release()
+
+scheduler = RenderScheduler()
+
+# Stages of rendering reported by profile(): a stage is the cumulative time
+# of the functions with these names in files whose paths end with these suffixes.
+#
+PROFILE_STAGES = {
+    'aggregate': [('datashader/core.py', 'points'), ('datashader/core.py', 'line'), ('datashader/core.py', 'polygons')],
+    'shade': [('datashader/transfer_functions/__init__.py', 'shade'), ('dsutil.py', 'shade'), ('dsutil.py', 'shade_cat')],
+    'spread': [('datashader/transfer_functions/__init__.py', 'dynspread'), ('datashader/transfer_functions/__init__.py', 'spread')],
+    'to_pil': [('datashader/transfer_functions/__init__.py', 'to_pil')],
+    'encode': [('util.py', 'byte_buffer')]
+}
+
+_profile_ids = itertools.count(1)
+
+# Only one profiler can be active at a time in Python 3.12 and later.
+#
+_profile_lock = threading.Lock()
+
+def new_profile_id():
+    return f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{next(_profile_ids)}'
+
+def profile_stages(stats):
+    """Return the cumulative seconds of each of the PROFILE_STAGES in a pstats.Stats.
+
+    Calls from another function of the same stage (such as dynspread() calling spread())
+    are not counted twice.
+    """
+
+    def stage_of(key):
+        fnam, _, func = key
+        fnam = fnam.replace('\\', '/')
+        for stage,funcs in PROFILE_STAGES.items():
+            if any(fnam.endswith(suffix) and func==name for suffix,name in funcs):
+                return stage
+
+        return None
+
+    stages = {stage:0.0 for stage in PROFILE_STAGES}
+    for key, (_, _, _, _, callers) in stats.stats.items():
+        stage = stage_of(key)
+        if stage is not None:
+            stages[stage] += sum(ct for caller,(_, _, _, ct) in callers.items() if stage_of(caller)!=stage)
+
+    return stages
+
+def profiling():
+    """Is the render running in this thread being profiled?
+
+    cProfile only sees the thread that enabled it, so work that would be
+    handed to other threads (such as dsutil.aggregate()'s row partitions)
+    should be done in this thread instead.
+    """
+
+    return getattr(_render_state, 'profiling', False)
+
+def profile(func, dirname, profile_id, info):
+    """Call func() under cProfile, and return its result.
+
+    The profile is written to dirname as profile_id.prof (for pstats, snakeviz, etc),
+    and a summary as profile_id.json, containing info, the total time,
+    the time spent in each of the PROFILE_STAGES, and the slowest functions.
+    While profiling() is true, the render runs in this one thread.
+    """
+
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    with _profile_lock:
+        t0 = time.perf_counter()
+        _render_state.profiling = True
+        profiler.enable()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            _render_state.profiling = False
+            seconds = time.perf_counter() - t0
+
+            os.makedirs(dirname, exist_ok=True)
+            base = os.path.join(dirname, profile_id)
+            profiler.dump_stats(f'{base}.prof')
+
+            stats = pstats.Stats(profiler)
+            top = sorted(stats.stats.items(), key=lambda item:item[1][3], reverse=True)[:30]
+            summary = {
+                'id': profile_id,
+                **info,
+                'seconds': seconds,
+                'stages': profile_stages(stats),
+                'top': [
+                    {'function': f'{fnam}:{line}({func_name})', 'calls': nc, 'seconds': tt, 'cumulative': ct}
+                    for (fnam, line, func_name), (_, nc, tt, ct, _) in top
+                ]
+            }
+            with open(f'{base}.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            print(f'Profile {profile_id}: {seconds:.3f}s {summary["stages"]}')
+
+class Warmup:
+    """Render a small tile of each layer and style in a background thread.
+
+    Datashader compiles a numba kernel the first time each combination of
+    glyph, reduction, and column types is used, which can take seconds.
+    Rendering a dummy tile of every layer at startup moves that cost out of
+    the first real requests. Each tile is rendered at full quality and as a draft,
+    so layers with a time budget compile both, and measure how fast they are.
+    Kernels that datashader compiles with cache=True are also saved in NUMBA_CACHE_DIR,
+    but most of its aggregation kernels are generated at runtime and can't be cached,
+    so they are compiled on each start.
+    """
+
+    def __init__(self):
+        self.state = 'idle'
+        self.done = 0
+        self.total = 0
+        self.errors = {}
+        self.skipped = []
+        self.seconds = None
+
+    @property
+    def ready(self):
+        return self.state in ('idle', 'done')
+
+    def start(self, size=64):
+        """Start warming up the registered layers."""
+
+        jobs = [
+            (layer, style)
+            for layer in wms.get_layers().values()
+            for style in (layer.style or [''])
+        ]
+        self.state = 'running'
+        self.done = 0
+        self.total = len(jobs)
+        self.errors = {}
+        self.skipped = []
+        threading.Thread(target=self._run, args=(jobs, size), name='warmup', daemon=True).start()
+
+    def _run(self, jobs, size):
+        t0 = time.perf_counter()
+
+        # Datasets loading in the background must be loaded before their layers can be drawn.
+        #
+        for handle in list(dataset_handles.values()):
+            handle.wait()
+
+        for layer,style in jobs:
+            bbox = max(layer.minx, -180.0), max(layer.miny, -90.0), min(layer.maxx, 180.0), min(layer.maxy, 90.0)
+            t1 = time.perf_counter()
+            try:
+                for mode in ['full', 'draft']:
+                    with render_quality(mode):
+                        img = layer.img_func(None, size, size, bbox, '', layer.name, style)
+                    if img is not None:
+                        byte_buffer(img)
+                print(f'Warmed up {layer.name} {style} in {time.perf_counter()-t1:.1f}s')
+            except WmsError as e:
+                # The layer can't be drawn without a path or other request parameters.
+                #
+                print(f'Warm-up of {layer.name} {style} skipped: {e.message}')
+                self.skipped.append(f'{layer.name} {style}'.strip())
+            except Exception as e:
+                print(f'Warm-up of {layer.name} {style} failed: {e!r}')
+                self.errors[f'{layer.name} {style}'.strip()] = repr(e)
+            self.done += 1
+
+        self.seconds = time.perf_counter() - t0
+        self.state = 'done'
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'seconds': self.seconds,
+            'skipped': self.skipped,
+            'errors': self.errors
+        }
+
+warmup = Warmup()
+
+async def wait_for_disconnect(request):
+    """Return when the client of request disconnects.
+
+    This reads the ASGI receive channel, so it must only be used
+    when the request body has been read (or there isn't one).
+    """
+
+    while True:
+        message = await request.receive()
+        if message['type']=='http.disconnect':
+            return
+
 @dataclass(frozen=True)
 class LayerNode:
     """Specify a WMS layer in a layer tree.
@@ -421,6 +1682,33 @@ def build_exception(e):
 
     return text
 
+def features_json(layer_features):
+    """Encode the result of Wms.get_feature_info as a GeoJSON FeatureCollection."""
+
+    features = []
+    for name,fs in layer_features:
+        for x,y,props in fs:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [x, y]},
+                'properties': {'layer': name, **props}
+            })
+
+    return json.dumps({'type': 'FeatureCollection', 'features': features}, default=str)
+
+def features_xml(layer_features):
+    """Encode the result of Wms.get_feature_info as an XML document."""
+
+    root = ET.Element('FeatureInfoResponse')
+    for name,fs in layer_features:
+        layer_el = ET.SubElement(root, 'Layer', name=name)
+        for x,y,props in fs:
+            feature_el = ET.SubElement(layer_el, 'Feature', x=str(x), y=str(y))
+            for k,v in props.items():
+                ET.SubElement(feature_el, 'Attribute', name=str(k), value=str(v))
+
+    return ET.tostring(root, encoding='unicode', xml_declaration=True)
+
 def byte_buffer(img):
     """Save an image into a byte buffer and return the buffer."""
 
@@ -430,6 +1718,89 @@ def byte_buffer(img):
 
     return buf
 
+# Strips of a large image are rendered with this many extra rows above and below,
+# so points just outside a strip are spread into it. It must be at least
+# the largest spread (in pixels) of a layer function.
+#
+STRIP_HALO_PX = 8
+
+def strips(width, height, bbox, rows, halo=STRIP_HALO_PX):
+    """Split an image into horizontal strips of at most rows rows.
+
+    Returns a list of (r0, r1, top, bottom, strip_bbox), where rows [r0, r1)
+    of the image are rows [r0-top, r1-top) of an image rendered from rows
+    [top, bottom) with the bounding box strip_bbox. The halo isn't added
+    at the top and bottom of the image, where there is nothing to spread in.
+    """
+
+    west, south, east, north = bbox
+    dy = (north-south) / height
+    result = []
+    for r0 in range(0, height, rows):
+        r1 = min(r0+rows, height)
+        top = max(0, r0-halo)
+        bottom = min(height, r1+halo)
+        result.append((r0, r1, top, bottom, (west, north-bottom*dy, east, north-top*dy)))
+
+    return result
+
+class PngStream:
+    """Encode an RGBA PNG incrementally, a band of rows at a time.
+
+    Only the compressor state and the current band are held in memory,
+    so the encoded image can be sent as it is produced. Bands must be
+    encoded in order, from the top of the image.
+    """
+
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, width, height, level=6):
+        self.width = width
+        self.height = height
+        self.encoded = 0
+        self._stride = width * 4
+        self._z = zlib.compressobj(level)
+
+    @staticmethod
+    def _chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)))
+
+    def header(self):
+        """The PNG signature and header (8-bit RGBA, not interlaced)."""
+
+        return self.SIGNATURE + self._chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 6, 0, 0, 0))
+
+    def rows(self, data):
+        """Encode whole rows of RGBA bytes. Returns the IDAT chunk (which may be empty)."""
+
+        stride = self._stride
+        n = len(data) // stride
+        data = memoryview(data)
+
+        # Each row starts with its filter type (0, none).
+        #
+        buf = bytearray((stride+1) * n)
+        for i in range(n):
+            buf[i*(stride+1)+1:(i+1)*(stride+1)] = data[i*stride:(i+1)*stride]
+        self.encoded += n
+
+        compressed = self._z.compress(buf)
+
+        return self._chunk(b'IDAT', compressed) if compressed else b''
+
+    def blank(self, n):
+        """Encode n transparent rows."""
+
+        return self.rows(bytes(self._stride * n))
+
+    def finish(self):
+        """Flush the compressor and end the image."""
+
+        if self.encoded!=self.height:
+            raise ValueError(f'Encoded {self.encoded} rows of {self.height}')
+
+        return self._chunk(b'IDAT', self._z.flush()) + self._chunk(b'IEND', b'')
+
 def linear_legend(pal, low='Low', high='High'):
     """Create a linear colorbar and low / high labels.
 
@@ -505,3 +1876,617 @@ def tuple_to_rgb(palette):
     """
 
     return [f'#{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}' for rgb in palette]
+
+class DatasetHandle:
+    """A dataset that can be replaced while the server is running.
+
+    The dataset is whatever load(fnam) returns. reload() loads a new version
+    in a background thread while the current version keeps serving requests,
+    then replaces the current version in a single assignment.
+
+    Layer functions must get the dataset once, using handle.current,
+    and use that for the whole request, so that a request that is being
+    rendered during a swap finishes on the old version. The old version's
+    memory is released when the last such request finishes.
+
+    :param name: The name of the dataset, used by the admin endpoints.
+    :param load: A function that loads the dataset from a file.
+    :param fnam: The file to load.
+    :param on_swap: If specified, called with the new version after a swap,
+        for example to update layer bounding boxes and invalidate cached images.
+    :param background: If True, the first version is loaded in the background
+        (and on_swap is called when it has loaded), so a module can register
+        its layers without waiting for its data. Until then, handle.current raises
+        WmsError('LayerNotReady'), which is returned to the client.
+
+    The current version is counted against util.memory, but is never evicted.
+    handle.fingerprint identifies the file the current version was loaded from
+    (see file_fingerprint()); pass it to tile_cache.invalidate() in on_swap.
+    """
+
+    def __init__(self, name, load, fnam, *, on_swap=None, background=False):
+        if name in dataset_handles:
+            raise ValueError(f'Dataset "{name}" is already registered.')
+
+        self.name = name
+        self.fnam = fnam
+        self.on_swap = on_swap
+        self.version = 0
+        self.fingerprint = None
+        self.error = None
+        self.loaded_at = None
+        self.load_time = None
+        self.nbytes = 0
+        self._current = None
+        self._load = load
+        self._lock = threading.Lock()
+        self._loading = False
+        self._watching = False
+        self._ready = threading.Event()
+
+        dataset_handles[name] = self
+        memory.register(f'dataset:{name}', self)
+
+        if background:
+            self.reload()
+        else:
+            t0 = time.perf_counter()
+            fingerprint = file_fingerprint(fnam)
+            self._current = load(fnam)
+            self.fingerprint = fingerprint
+            self.version = 1
+            self.loaded_at = time.time()
+            self.load_time = time.perf_counter() - t0
+            self.nbytes = sizeof(self._current)
+            self._ready.set()
+            memory.check()
+
+    @property
+    def current(self):
+        """The current version of the dataset."""
+
+        data = self._current
+        if data is None:
+            if self.error:
+                raise WmsError('LayerNotReady', f'The layer\'s data (dataset "{self.name}") failed to load: {self.error}')
+            raise WmsError('LayerNotReady', f'The layer\'s data (dataset "{self.name}") is still loading')
+
+        return data
+
+    @property
+    def ready(self):
+        """Has the first version been loaded?"""
+
+        return self._current is not None
+
+    def wait(self, timeout=None):
+        """Wait until the first version has loaded (or failed to load).
+
+        Returns True if the dataset is ready.
+        """
+
+        self._ready.wait(timeout)
+
+        return self.ready
+
+    def reload(self, fnam=None):
+        """Load a new version of the dataset in the background and swap it in.
+
+        :param fnam: The file to load; defaults to the current file.
+        Returns False if a reload is already in progress.
+        """
+
+        with self._lock:
+            if self._loading:
+                return False
+            self._loading = True
+
+        threading.Thread(target=self._reload, args=(fnam or self.fnam,), name=f'reload-{self.name}', daemon=True).start()
+
+        return True
+
+    def _reload(self, fnam):
+        try:
+            print(f'{"Reloading" if self.version else "Loading"} dataset {self.name} from {fnam} ...')
+            t0 = time.perf_counter()
+            fingerprint = file_fingerprint(fnam)
+            new = self._load(fnam)
+            load_time = time.perf_counter() - t0
+
+            # Assigning the attribute is atomic: requests see either the old or the new version.
+            #
+            self._current = new
+            self.fnam = fnam
+            self.fingerprint = fingerprint
+            self.version += 1
+            self.loaded_at = time.time()
+            self.load_time = load_time
+            self.nbytes = sizeof(new)
+            self.error = None
+            del new
+            if self.on_swap:
+                self.on_swap(self.current)
+            gc.collect()
+            memory.check()
+            print(f'Dataset {self.name} version {self.version} loaded in {load_time:.1f}s')
+        except Exception as e:
+            # Keep serving the current version.
+            #
+            self.error = f'{type(e).__name__}: {e}'
+            print(f'{"Reloading" if self.version else "Loading"} dataset {self.name} failed: {self.error}')
+        finally:
+            with self._lock:
+                self._loading = False
+            self._ready.set()
+
+    def watch(self, interval=5.0):
+        """Reload the dataset when its file changes.
+
+        The file is polled every interval seconds. A reload starts when the
+        modification time has changed and the file has stopped changing.
+        """
+
+        if self._watching:
+            return
+        self._watching = True
+
+        def stat():
+            try:
+                st = os.stat(self.fnam)
+                return st.st_mtime_ns, st.st_size
+            except OSError:
+                return None
+
+        def poll():
+            last = stat()
+            pending = None
+            while True:
+                time.sleep(interval)
+                current = stat()
+                if current is None or current==last:
+                    pending = None
+                elif current==pending:
+                    # Unchanged since the previous poll, so it has probably finished being written.
+                    #
+                    if self.reload():
+                        last = current
+                    pending = None
+                else:
+                    pending = current
+
+        threading.Thread(target=poll, name=f'watch-{self.name}', daemon=True).start()
+
+    def status(self):
+        """Return a dictionary describing the dataset."""
+
+        return {
+            'name': self.name,
+            'fnam': str(self.fnam),
+            'version': self.version,
+            'loaded_at': self.loaded_at,
+            'load_time': self.load_time,
+            'bytes': self.nbytes,
+            'ready': self.ready,
+            'loading': self._loading,
+            'error': self.error
+        }
+
+    def memory_usage(self):
+        return self.nbytes
+
+dataset_handles = {}
+
+def file_fingerprint(fnam):
+    """Identify the contents of a file by its path, size, and modification time
+    (taken before it is read), or None if it can't be read.
+    """
+
+    try:
+        st = os.stat(fnam)
+    except (OSError, TypeError):
+        return None
+
+    return os.path.abspath(fnam), st.st_size, st.st_mtime_ns
+
+def sizeof(data):
+    """Estimate the memory used by a dataset: a DataFrame, or an object with nbytes or a df attribute.
+
+    For an object with a df attribute, the size of its other arrays and DataFrames
+    (such as precomputed aggregates and samples) is included.
+    """
+
+    if hasattr(data, 'memory_usage'):
+        # A DataFrame's memory usage is a Series (one value per column); a Series' is a number.
+        #
+        usage = data.memory_usage(index=True, deep=True)
+
+        return int(usage.sum() if hasattr(usage, 'sum') else usage)
+    if hasattr(data, 'nbytes'):
+        return int(data.nbytes)
+    if hasattr(data, 'df'):
+        return sizeof(data.df) + sum(
+            sizeof(v) for k,v in vars(data).items()
+            if k!='df' and (hasattr(v, 'nbytes') or hasattr(v, 'memory_usage'))
+        )
+
+    return 0
+
+class PartitionedDataset:
+    """A dataset split into partitions, one per WMS path, that are loaded on first use.
+
+    For example, /WMS/2024-03-01/ and /WMS/2024-03-02/ can show different days
+    of data. A partition is loaded by load(path) the first time it is used.
+    All partitioned datasets share one memory budget, the partition_max_mb setting
+    of the [datasets] section of config.toml: when the loaded partitions exceed it,
+    the least recently used partitions that aren't in use are evicted.
+    A partition that is larger than the budget by itself is still loaded,
+    and is evicted when it is no longer in use.
+    Each dataset is also a util.memory tier, so idle partitions may be evicted
+    to keep the process within its overall memory budget.
+
+    Layer functions use a partition for the duration of a request with::
+
+        with dataset.use(path) as data:
+            ...
+
+    Concurrent requests for a partition that isn't loaded wait for a single load.
+
+    :param name: The name of the dataset, used by the admin endpoints.
+    :param load: A function that loads the partition for a path.
+        It should raise WmsError if the path isn't valid.
+    :param sizeof: A function that returns the size of a loaded partition in bytes.
+    """
+
+    # All partitioned datasets are protected by one lock, so eviction can compare their partitions.
+    #
+    _lock = threading.Lock()
+
+    def __init__(self, name, load, *, sizeof=sizeof):
+        if name in partitioned_datasets:
+            raise ValueError(f'Dataset "{name}" is already registered.')
+
+        self.name = name
+        self.nbytes = 0
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._load = load
+        self._sizeof = sizeof
+
+        # path -> [data, nbytes, users, last_used, load_time, hits]
+        #
+        self._parts = {}
+        self._loading = {}
+
+        partitioned_datasets[name] = self
+        memory.register(f'partitions:{name}', self)
+
+    @staticmethod
+    def max_bytes():
+        return int(config.get('datasets', {}).get('partition_max_mb', 4096) * 1024 * 1024)
+
+    def _get(self, path):
+        """Return the loaded partition and count a user, or None."""
+
+        entry = self._parts.get(path)
+        if entry is None:
+            return None
+
+        entry[2] += 1
+        entry[3] = time.monotonic()
+        entry[5] += 1
+        self.hits += 1
+
+        return entry[0]
+
+    def _acquire(self, path):
+        with self._lock:
+            data = self._get(path)
+            if data is not None:
+                return data
+
+            loading = self._loading.setdefault(path, threading.Lock())
+
+        with loading:
+            with self._lock:
+                data = self._get(path)
+                if data is not None:
+                    return data
+
+            try:
+                t0 = time.perf_counter()
+                data = self._load(path)
+                nbytes = self._sizeof(data)
+                load_time = time.perf_counter() - t0
+                print(f'Loaded {self.name} partition {path!r}: {nbytes:,} bytes in {load_time:.1f}s')
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(path, None)
+                raise
+
+            # The partition is added in the same step as the load is forgotten,
+            # so a request arriving in between doesn't load it again.
+            #
+            with self._lock:
+                self._parts[path] = [data, nbytes, 1, time.monotonic(), load_time, 0]
+                self._loading.pop(path, None)
+                self.nbytes += nbytes
+                self.loads += 1
+                _evict_partitions()
+
+        memory.check()
+
+        return data
+
+    def _release(self, path):
+        with self._lock:
+            entry = self._parts.get(path)
+            if entry is not None:
+                entry[2] -= 1
+            _evict_partitions()
+
+    def _drop(self, path):
+        nbytes = self._parts.pop(path)[1]
+        self.nbytes -= nbytes
+        self.evictions += 1
+        print(f'Evicted {self.name} partition {path!r}')
+
+    @contextmanager
+    def use(self, path):
+        """Use the partition for path, loading it if necessary."""
+
+        data = self._acquire(path)
+        try:
+            yield data
+        finally:
+            self._release(path)
+
+    def evict(self, path=None):
+        """Drop a partition (or all idle partitions), for example after its file has changed."""
+
+        with self._lock:
+            for p in [path] if path is not None else list(self._parts):
+                entry = self._parts.get(p)
+                if entry is not None and entry[2]==0:
+                    self._drop(p)
+
+    def status(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'partitions': {path:{'bytes': nbytes, 'users': users, 'hits': hits} for path,(_,nbytes,users,_,_,hits) in self._parts.items()},
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes(),
+                'hits': self.hits,
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
+
+    def memory_usage(self):
+        return self.nbytes
+
+    def memory_candidates(self):
+        with self._lock:
+            return [
+                (path, nbytes, load_time, hits, last_used)
+                for path,(_,nbytes,users,last_used,load_time,hits) in self._parts.items()
+                if users==0
+            ]
+
+    def memory_evict(self, path):
+        with self._lock:
+            entry = self._parts.get(path)
+            if entry is None or entry[2]>0:
+                return 0
+            self._drop(path)
+
+            return entry[1]
+
+def _evict_partitions():
+    """Evict idle partitions of all partitioned datasets, least recently used first,
+    until they fit in the budget. The caller must hold PartitionedDataset._lock.
+    """
+
+    datasets = list(partitioned_datasets.values())
+    total = sum(dataset.nbytes for dataset in datasets)
+    max_bytes = PartitionedDataset.max_bytes()
+    if total<=max_bytes:
+        return
+
+    idle = sorted(
+        (last_used, dataset, path)
+        for dataset in datasets
+        for path,(_,_,users,last_used,_,_) in dataset._parts.items()
+        if users==0
+    )
+    for _, dataset, path in idle:
+        if total<=max_bytes:
+            break
+
+        total -= dataset._parts[path][1]
+        dataset._drop(path)
+
+partitioned_datasets = {}
+
+class DatasetView:
+    """A view on a registered dataset. See DatasetRegistry."""
+
+    def __init__(self, name, dataset, *, columns=None, rows=None, rename=None, parts=None):
+        self.name = name
+        self.dataset = dataset
+        self.columns = columns
+        self.rows = rows
+        self.rename = rename or {}
+        self.parts = parts
+
+        # Runs of consecutive rows can be resolved as slices, which don't copy.
+        #
+        self.runs = None
+        if rows is not None:
+            import numpy as np
+
+            self.rows = np.asarray(rows, dtype=np.int32 if len(rows)<2**31 else np.int64)
+            breaks = np.flatnonzero(np.diff(self.rows)!=1) + 1
+            if len(breaks)<=max(1, len(self.rows)//1024):
+                starts = np.concatenate([[0], breaks])
+                stops = np.concatenate([breaks, [len(self.rows)]])
+                self.runs = [(int(self.rows[a]), int(self.rows[b-1])+1) for a,b in zip(starts, stops)]
+
+    @property
+    def copies(self):
+        """Does resolving the view copy data?"""
+
+        return self.rows is not None and self.runs is None
+
+    def _select(self, df, columns, rename):
+        """Return the columns of df, renamed, without copying them."""
+
+        import pandas as pd
+
+        return pd.DataFrame({rename.get(c, c):df[c] for c in columns}, copy=False)
+
+    def resolve(self, frames):
+        """Return the view of the dataset's frames as a list of DataFrames."""
+
+        if self.rows is not None:
+            if len(frames)!=1:
+                raise ValueError(f'View "{self.name}": row filters need a single-frame dataset')
+            df = frames[0]
+            if self.runs is not None:
+                frames = [df.iloc[a:b] for a,b in self.runs]
+            else:
+                frames = [df.take(self.rows)]
+
+        if self.parts is not None:
+            return [self._select(df, columns, dict(zip(columns, names))) for df in frames for columns,names in self.parts]
+
+        return [self._select(df, self.columns or list(df.columns), self.rename) for df in frames]
+
+    def nbytes(self):
+        """The memory held by the view itself (not the dataset)."""
+
+        return 0 if self.rows is None else self.rows.nbytes
+
+class DatasetRegistry:
+    """Named datasets shared by layers, and views on them.
+
+    A module registers a dataset (a DataFrame, or a function that returns
+    a list of DataFrames, such as dsutil.PointSet.frames) once.
+    Layers declare views on the dataset: column subsets (optionally renamed),
+    row filters given as arrays of row numbers, and unions of column pairs,
+    such as pickup and dropoff coordinates treated as one set of points.
+    Views are resolved when used, to a list of DataFrames that share
+    the dataset's column buffers rather than copying them. (A row filter
+    whose rows are not mostly consecutive has to be copied when resolved;
+    report() shows this.)
+
+    Registering a dataset with an existing name replaces it,
+    for example after a new version has been loaded.
+    Views can be declared before their dataset is registered.
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, data):
+        """Register (or replace) a dataset."""
+
+        with self._lock:
+            self._datasets[name] = data
+
+    def frames(self, name):
+        """Return the dataset as a list of DataFrames."""
+
+        if name not in self._datasets:
+            raise KeyError(f'Dataset "{name}" is not registered')
+
+        data = self._datasets[name]
+
+        return list(data()) if callable(data) else [data]
+
+    def _add_view(self, view):
+        with self._lock:
+            self._views[view.name] = view
+
+        return view
+
+    def view(self, name, dataset, *, columns=None, rows=None, rename=None):
+        """Declare a view of some of the columns and / or rows of a dataset.
+
+        :param columns: The columns in the view; defaults to all columns.
+        :param rows: The row numbers in the view; defaults to all rows.
+        :param rename: A dictionary mapping dataset column names to view column names.
+        """
+
+        return self._add_view(DatasetView(name, dataset, columns=columns, rows=rows, rename=rename))
+
+    def union(self, name, dataset, pairs, names=('x', 'y')):
+        """Declare a view that is the union of pairs of columns of a dataset.
+
+        For example, union('taxi_xy', 'taxi', [('pickup_x', 'pickup_y'), ('dropoff_x', 'dropoff_y')])
+        treats the pickups and dropoffs as one set of points with columns x and y.
+        """
+
+        return self._add_view(DatasetView(name, dataset, parts=[(list(pair), list(names)) for pair in pairs]))
+
+    def resolve(self, name, frames=None):
+        """Return the view (or dataset) as a list of DataFrames.
+
+        :param frames: If specified, resolve the view against these DataFrames
+            rather than the registered dataset (for example, a new version
+            of the dataset that is being loaded).
+        """
+
+        if name in self._views:
+            view = self._views[name]
+
+            return view.resolve(self.frames(view.dataset) if frames is None else frames)
+
+        return self.frames(name) if frames is None else frames
+
+    def report(self):
+        """Return the memory held by each dataset and view, in bytes.
+
+        Column buffers shared by several DataFrames are counted once.
+        Object (string) columns are counted as their array of pointers.
+        """
+
+        import numpy as np
+
+        def buffers(df):
+            """Yield (id, nbytes) for the buffers underlying the columns."""
+
+            for c in df.columns:
+                values = df[c].array
+                if hasattr(values, 'codes'):
+                    values = values.codes
+                elif not hasattr(values, '_ndarray'):
+                    # Arrow-backed and other extension arrays.
+                    #
+                    yield id(values), values.nbytes
+                    continue
+
+                base = np.asarray(values)
+                while isinstance(base.base, np.ndarray):
+                    base = base.base
+                yield id(base), base.nbytes
+
+        datasets = {}
+        for name in list(self._datasets):
+            seen = dict(b for df in self.frames(name) for b in buffers(df))
+            datasets[name] = sum(seen.values())
+
+        views = {}
+        for name,view in list(self._views.items()):
+            views[name] = {
+                'dataset': view.dataset,
+                'bytes': view.nbytes(),
+                'copies_on_resolve': view.copies
+            }
+
+        return {'datasets': datasets, 'views': views}
+
+registry = DatasetRegistry()
+